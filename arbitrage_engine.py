@@ -0,0 +1,460 @@
+import math
+import numpy as np
+
+
+def get_arbitration_pairs(num_venues):
+    # All (buy venue, sell venue) index pairs in row-major order of the gain matrix
+    pairs = []
+    for buy_index in range(num_venues):
+        for sell_index in range(num_venues):
+            if buy_index != sell_index:
+                pairs.append((buy_index, sell_index))
+    return pairs
+
+
+def get_arbitration_mode_str(buy_name, sell_name):
+    return "BUY_{}_SELL_{}".format(buy_name.upper(), sell_name.upper())
+
+
+def get_threshold_tiers(venue_names, min_relative_gains, min_fiat_reserves,
+                        default_min_relative_gains, default_min_fiat_reserves):
+    # Threshold ladders as (buy venue, sell venue, tier) arrays.
+    # The ladders are keyed by (buy name, sell name) and shorter ladders are padded with tiers that never match.
+    num_venues = len(venue_names)
+    ladders = {}
+    num_tiers = max(len(default_min_relative_gains), 1)
+    for buy_name in venue_names:
+        for sell_name in venue_names:
+            key = (buy_name, sell_name)
+            gains = min_relative_gains.get(key, default_min_relative_gains)
+            reserves = min_fiat_reserves.get(key, default_min_fiat_reserves)
+            assert len(gains) == len(reserves), "Threshold ladders for {} have different lengths".format(key)
+            ladders[key] = (gains, reserves)
+            num_tiers = max(num_tiers, len(gains))
+    tier_min_relative_gains = np.full((num_venues, num_venues, num_tiers), np.inf)
+    tier_min_fiat_reserves = np.full((num_venues, num_venues, num_tiers), np.inf)
+    for buy_index, buy_name in enumerate(venue_names):
+        for sell_index, sell_name in enumerate(venue_names):
+            if buy_index == sell_index:
+                continue
+            gains, reserves = ladders[(buy_name, sell_name)]
+            tier_min_relative_gains[buy_index, sell_index, :len(gains)] = gains
+            tier_min_fiat_reserves[buy_index, sell_index, :len(reserves)] = reserves
+    return tier_min_relative_gains, tier_min_fiat_reserves
+
+
+def compute_gain_matrix(ask_prices, bid_prices, fees, volumes):
+    # Expected gains for buying on venue i (row) and selling on venue j (column).
+    # ask_prices and bid_prices are either per venue or per (buy venue, sell venue) pair.
+    fees = np.asarray(fees, dtype=np.float64)
+    volumes = np.asarray(volumes, dtype=np.float64)
+    ask_prices = np.asarray(ask_prices, dtype=np.float64)
+    bid_prices = np.asarray(bid_prices, dtype=np.float64)
+    if ask_prices.ndim == 1:
+        ask_prices = ask_prices[:, np.newaxis]
+    if bid_prices.ndim == 1:
+        bid_prices = bid_prices[np.newaxis, :]
+    buy_volumes_fiat = ask_prices * (1 + fees[:, np.newaxis]) * volumes
+    sell_volumes_fiat = bid_prices * (1 - fees[np.newaxis, :]) * volumes
+    gains_fiat = sell_volumes_fiat - buy_volumes_fiat
+    with np.errstate(invalid="ignore", divide="ignore"):
+        relative_gains = gains_fiat / buy_volumes_fiat
+    relative_gains = np.where(np.isfinite(relative_gains), relative_gains, -np.inf)
+    np.fill_diagonal(relative_gains, -np.inf)
+    return gains_fiat, relative_gains, buy_volumes_fiat
+
+
+def compute_feasibility(relative_gains, buy_volumes_fiat, volumes, balances_fiat, balances_crypto,
+                        tier_min_relative_gains, tier_min_fiat_reserves, buy_safety_factor_fiat):
+    # Check every threshold tier of every (buy venue, sell venue) pair at once.
+    # Returns whether a pair is feasible and the index of the first matching tier.
+    balances_fiat = np.asarray(balances_fiat, dtype=np.float64)
+    balances_crypto = np.asarray(balances_crypto, dtype=np.float64)
+    volumes = np.asarray(volumes, dtype=np.float64)
+    fiat_reserves = balances_fiat / np.sum(balances_fiat)
+    tier_valid = (relative_gains[:, :, np.newaxis] >= tier_min_relative_gains) \
+        & (fiat_reserves[:, np.newaxis, np.newaxis] >= tier_min_fiat_reserves)
+    # buy_volumes_fiat already includes the volume: the fiat balance has to cover it with the safety factor
+    balance_valid = (balances_fiat[:, np.newaxis] / buy_safety_factor_fiat >= buy_volumes_fiat) \
+        & (balances_crypto[np.newaxis, :] >= volumes)
+    tier_valid &= balance_valid[:, :, np.newaxis]
+    feasible = np.any(tier_valid, axis=2)
+    np.fill_diagonal(feasible, False)
+    tier_indices = np.argmax(tier_valid, axis=2)
+    return feasible, tier_indices
+
+
+def select_best_pair(relative_gains, feasible):
+    # Feasible (buy venue, sell venue) pair with the highest expected relative gain or None.
+    # Both decision paths (solver and DecisionKernel) choose the mode by this criterion.
+    if not np.any(feasible):
+        return None
+    masked_relative_gains = np.where(feasible, relative_gains, -np.inf)
+    flat_index = int(np.argmax(masked_relative_gains))
+    buy_index, sell_index = np.unravel_index(flat_index, masked_relative_gains.shape)
+    return int(buy_index), int(sell_index)
+
+
+def get_volume_grid(max_volume, min_volume=0.0, grid_size=20, ndigits=4):
+    # Candidate order volumes: grid_size steps up to max_volume (rounded, without duplicates and volumes
+    # below min_volume). The largest volume is always max_volume.
+    volumes = np.round(np.linspace(max_volume / grid_size, max_volume, grid_size), ndigits)
+    volumes = np.unique(volumes[(volumes > 0) & (volumes >= min_volume)])
+    if len(volumes) == 0:
+        volumes = np.array([round(max_volume, ndigits)])
+    return volumes
+
+
+class DecisionKernel(object):
+    # The arbitrage decision for all (buy venue, sell venue) modes, threshold tiers and a grid of candidate
+    # volumes in one vectorized pass.
+    # Books enter as summaries: the fiat cost of buying and the fiat proceeds of selling each grid volume on
+    # each venue (excluding fees), so a book update only recomputes the row of its venue (update_venue).
+    # Gain prices are the conservative prices (worst price needed for min_volume_factor times the volume)
+    # or, with use_vwap_prices, the average fill prices. evaluate() does not allocate: all tables are
+    # buffers of the kernel that are overwritten by the next evaluation.
+
+    def __init__(self, fees, volumes, tier_min_relative_gains, tier_min_fiat_reserves,
+                 buy_safety_factor_fiat=1.25, min_volume_factor=10.0, use_vwap_prices=False, fiat_ndigits=2):
+        self.fees = np.asarray(fees, dtype=np.float64)
+        self.volumes = np.asarray(volumes, dtype=np.float64)
+        self.buy_safety_factor_fiat = buy_safety_factor_fiat
+        self.min_volume_factor = min_volume_factor
+        self.use_vwap_prices = use_vwap_prices
+        self.fiat_ndigits = fiat_ndigits
+        num_venues = len(self.fees)
+        num_volumes = len(self.volumes)
+        num_tiers = tier_min_relative_gains.shape[2]
+        # Thresholds as (buy venue, sell venue, volume, tier) so they broadcast without copies
+        self.tier_min_relative_gains = tier_min_relative_gains[:, :, np.newaxis, :]
+        self.tier_min_fiat_reserves = tier_min_fiat_reserves[:, :, np.newaxis, :]
+        self.buy_fee_factors = (1 + self.fees)[:, np.newaxis]
+        self.sell_fee_factors = (1 - self.fees)[:, np.newaxis]
+        # Book summaries (venue, volume), NaN where the book does not have enough volume
+        self.ask_costs = np.full((num_venues, num_volumes), np.nan)
+        self.bid_proceeds = np.full((num_venues, num_volumes), np.nan)
+        # Buffers
+        self.buy_volumes_fiat = np.empty((num_venues, num_volumes))
+        self.sell_volumes_fiat = np.empty((num_venues, num_volumes))
+        self.gains_fiat = np.empty((num_venues, num_venues, num_volumes))
+        self.relative_gains = np.empty((num_venues, num_venues, num_volumes))
+        self.fiat_reserves = np.empty(num_venues)
+        self.max_buy_volumes_fiat = np.empty(num_venues)
+        self.fiat_valid = np.empty((num_venues, num_volumes), dtype=bool)
+        self.crypto_valid = np.empty((num_venues, num_volumes), dtype=bool)
+        self.reserve_valid = np.empty((num_venues, num_venues, num_volumes, num_tiers), dtype=bool)
+        self.tier_valid = np.empty((num_venues, num_venues, num_volumes, num_tiers), dtype=bool)
+        self.feasible = np.empty((num_venues, num_venues, num_volumes), dtype=bool)
+        self.tier_indices = np.empty((num_venues, num_venues, num_volumes), dtype=np.intp)
+        self.masked_gains = np.empty((num_venues, num_venues, num_volumes))
+        self.not_feasible = np.empty((num_venues, num_venues, num_volumes), dtype=bool)
+        self.off_diagonal = ~np.eye(num_venues, dtype=bool)[:, :, np.newaxis]
+        # Per mode (buy venue, sell venue) at the volume of the mode
+        self.volume_indices = np.empty((num_venues, num_venues), dtype=np.intp)
+        self.pair_feasible = np.empty((num_venues, num_venues), dtype=bool)
+        self.pair_not_feasible = np.empty((num_venues, num_venues), dtype=bool)
+        self.pair_flat_indices = np.empty((num_venues, num_venues), dtype=np.intp)
+        self.pair_flat_offsets = np.arange(num_venues * num_venues).reshape(num_venues, num_venues) * num_volumes
+        self.pair_relative_gains = np.empty((num_venues, num_venues))
+
+    @property
+    def num_venues(self):
+        return len(self.fees)
+
+    def update_venue(self, index, ask_depth, bid_depth):
+        # Summarize the order book of a venue (ccxt_utils.OrderBookDepth of both sides)
+        if self.use_vwap_prices:
+            self.ask_costs[index] = ask_depth.get_cost(self.volumes)
+            self.bid_proceeds[index] = bid_depth.get_cost(self.volumes)
+        else:
+            min_volumes = self.min_volume_factor * self.volumes
+            ask_prices = np.round(ask_depth.get_worst_price(min_volumes), self.fiat_ndigits)
+            bid_prices = np.round(bid_depth.get_worst_price(min_volumes), self.fiat_ndigits)
+            self.ask_costs[index] = np.where(np.isfinite(ask_prices), ask_prices, np.nan) * self.volumes
+            self.bid_proceeds[index] = np.where(bid_prices > 0, bid_prices, np.nan) * self.volumes
+
+    def update_books(self, depths):
+        for index, (ask_depth, bid_depth) in enumerate(depths):
+            self.update_venue(index, ask_depth, bid_depth)
+
+    def evaluate(self, balances_fiat, balances_crypto):
+        # Fill gains_fiat, relative_gains, feasible and tier_indices (buy venue, sell venue, volume) and return
+        # the best feasible (buy index, sell index, volume index) or None. Like the solver path of decide(), every
+        # mode takes its feasible volume with the highest expected fiat gain (ties go to the smaller volume) and
+        # the mode with the highest expected relative gain at its volume is chosen (select_best_pair).
+        np.multiply(self.ask_costs, self.buy_fee_factors, out=self.buy_volumes_fiat)
+        np.multiply(self.bid_proceeds, self.sell_fee_factors, out=self.sell_volumes_fiat)
+        np.subtract(self.sell_volumes_fiat[np.newaxis, :, :], self.buy_volumes_fiat[:, np.newaxis, :],
+                    out=self.gains_fiat)
+        # Missing volume gives NaN, which fails every comparison below
+        with np.errstate(invalid="ignore", divide="ignore"):
+            np.divide(self.gains_fiat, self.buy_volumes_fiat[:, np.newaxis, :], out=self.relative_gains)
+            np.divide(balances_fiat, self.buy_safety_factor_fiat, out=self.max_buy_volumes_fiat)
+            np.greater_equal(self.max_buy_volumes_fiat[:, np.newaxis], self.buy_volumes_fiat, out=self.fiat_valid)
+            np.greater_equal(self.relative_gains[:, :, :, np.newaxis], self.tier_min_relative_gains,
+                             out=self.tier_valid)
+        np.divide(balances_fiat, np.sum(balances_fiat), out=self.fiat_reserves)
+        np.greater_equal(balances_crypto[:, np.newaxis], self.volumes[np.newaxis, :], out=self.crypto_valid)
+        np.greater_equal(self.fiat_reserves[:, np.newaxis, np.newaxis, np.newaxis], self.tier_min_fiat_reserves,
+                         out=self.reserve_valid)
+        np.logical_and(self.tier_valid, self.reserve_valid, out=self.tier_valid)
+        np.any(self.tier_valid, axis=3, out=self.feasible)
+        np.argmax(self.tier_valid, axis=3, out=self.tier_indices)
+        np.logical_and(self.feasible, self.fiat_valid[:, np.newaxis, :], out=self.feasible)
+        np.logical_and(self.feasible, self.crypto_valid[np.newaxis, :, :], out=self.feasible)
+        np.logical_and(self.feasible, self.off_diagonal, out=self.feasible)
+        np.logical_not(self.feasible, out=self.not_feasible)
+        np.copyto(self.masked_gains, self.gains_fiat)
+        np.copyto(self.masked_gains, -np.inf, where=self.not_feasible)
+        np.argmax(self.masked_gains, axis=2, out=self.volume_indices)
+        np.any(self.feasible, axis=2, out=self.pair_feasible)
+        np.add(self.pair_flat_offsets, self.volume_indices, out=self.pair_flat_indices)
+        np.take(self.relative_gains.reshape(-1), self.pair_flat_indices, out=self.pair_relative_gains)
+        np.logical_not(self.pair_feasible, out=self.pair_not_feasible)
+        np.copyto(self.pair_relative_gains, -np.inf, where=self.pair_not_feasible)
+        flat_index = int(np.argmax(self.pair_relative_gains))
+        if not self.pair_feasible.flat[flat_index]:
+            return None
+        buy_index, sell_index = np.unravel_index(flat_index, self.pair_relative_gains.shape)
+        return buy_index, sell_index, self.volume_indices[buy_index, sell_index]
+
+    def get_pair_volume_indices(self):
+        # Grid index of the volume of each mode after evaluate(): the feasible volume with the highest gain,
+        # else the largest volume
+        return np.where(self.pair_feasible, self.volume_indices, len(self.volumes) - 1)
+
+
+class ArbitrageParameters(object):
+    # Parameters of the arbitrage decision (same meaning as the module globals of ccxt_arbitration_new).
+    # Threshold ladders are relative gains (not percentages) keyed by (buy exchange, sell exchange).
+
+    def __init__(self, min_relative_gains, min_fiat_reserves,
+                 default_min_relative_gains=(0.02, 0.015, 0.01, 0.0075),
+                 default_min_fiat_reserves=(0.0, 0.4, 0.6, 0.75),
+                 min_volume_crypto=0.0, max_volume_crypto=0.5, min_volume_factor=10.0,
+                 buy_safety_factor_fiat=1.25, limit_price_safety_factor=1.05,
+                 use_vwap_prices=False, optimize_order_volume=True,
+                 fiat_ndigits=2, crypto_ndigits=4, use_decision_kernel=False, volume_grid_size=20):
+        self.min_relative_gains = min_relative_gains
+        self.min_fiat_reserves = min_fiat_reserves
+        self.default_min_relative_gains = list(default_min_relative_gains)
+        self.default_min_fiat_reserves = list(default_min_fiat_reserves)
+        self.min_volume_crypto = min_volume_crypto
+        self.max_volume_crypto = max_volume_crypto
+        self.min_volume_factor = min_volume_factor
+        self.buy_safety_factor_fiat = buy_safety_factor_fiat
+        self.limit_price_safety_factor = limit_price_safety_factor
+        self.use_vwap_prices = use_vwap_prices
+        self.optimize_order_volume = optimize_order_volume
+        self.fiat_ndigits = fiat_ndigits
+        self.crypto_ndigits = crypto_ndigits
+        # Decide with a DecisionKernel over volume_grid_size candidate volumes (instead of solving the
+        # optimal volume of each mode)?
+        self.use_decision_kernel = use_decision_kernel
+        self.volume_grid_size = volume_grid_size
+        self._tiers = {}
+        self._kernels = {}
+
+    def get_tiers(self, venue_names):
+        key = tuple(venue_names)
+        if key not in self._tiers:
+            self._tiers[key] = get_threshold_tiers(
+                venue_names, self.min_relative_gains, self.min_fiat_reserves,
+                self.default_min_relative_gains, self.default_min_fiat_reserves)
+        return self._tiers[key]
+
+    def get_kernel(self, venue_names, fees, max_volume):
+        # Kernel with a volume grid up to max_volume (one per venues, fees and max volume)
+        key = (tuple(venue_names), tuple(fees), max_volume)
+        if key not in self._kernels:
+            tier_min_relative_gains, tier_min_fiat_reserves = self.get_tiers(venue_names)
+            volumes = get_volume_grid(max_volume, self.min_volume_crypto, self.volume_grid_size, self.crypto_ndigits)
+            self._kernels[key] = DecisionKernel(
+                fees, volumes, tier_min_relative_gains, tier_min_fiat_reserves,
+                buy_safety_factor_fiat=self.buy_safety_factor_fiat, min_volume_factor=self.min_volume_factor,
+                use_vwap_prices=self.use_vwap_prices, fiat_ndigits=self.fiat_ndigits)
+        return self._kernels[key]
+
+
+def decide(venue_names, depths, fees, balances_fiat, balances_crypto, parameters, input_order_volume_crypto=None):
+    # The complete arbitrage decision for one set of order book snapshots without any side effects.
+    # depths is a list of (ask depth, bid depth) per venue (see ccxt_utils.get_order_book_depths).
+    # The result dict always has a "status" ("no_volume", "no_opportunity" or "trade") and everything
+    # that was computed up to the point of the decision so the caller can log or record it.
+    import ccxt_utils
+    num_venues = len(venue_names)
+    fees = np.asarray(fees, dtype=np.float64)
+    balances_fiat = np.asarray(balances_fiat, dtype=np.float64)
+    balances_crypto = np.asarray(balances_crypto, dtype=np.float64)
+    tier_min_relative_gains, tier_min_fiat_reserves = parameters.get_tiers(venue_names)
+    result = {"status": None}
+
+    # Compute sell and buy volumes of crypto currency
+    order_volume_crypto = input_order_volume_crypto
+    if order_volume_crypto is None:
+        order_volume_crypto = parameters.max_volume_crypto
+    order_volume_crypto = round(order_volume_crypto, parameters.crypto_ndigits)
+
+    # Get "safe" price on all venues for buying and selling crypto
+    min_volume = parameters.min_volume_factor * order_volume_crypto
+    ask_prices = np.zeros(num_venues)
+    ask_volumes = np.zeros(num_venues)
+    bid_prices = np.zeros(num_venues)
+    bid_volumes = np.zeros(num_venues)
+    for index in range(num_venues):
+        ask_prices[index], ask_volumes[index], bid_prices[index], bid_volumes[index] \
+            = ccxt_utils.get_conservative_ask_bid_price(None, min_volume, depths=depths[index])
+    result.update({
+        "min_volume": min_volume,
+        "ask_prices": ask_prices,
+        "ask_volumes": ask_volumes,
+        "bid_prices": bid_prices,
+        "bid_volumes": bid_volumes,
+    })
+    not_enough_volume = (ask_volumes < min_volume) | (bid_volumes < min_volume)
+    if np.any(not_enough_volume):
+        result["status"] = "no_volume"
+        result["venue_index"] = int(np.argmax(not_enough_volume))
+        return result
+
+    ask_prices = np.round(ask_prices, parameters.fiat_ndigits)
+    bid_prices = np.round(bid_prices, parameters.fiat_ndigits)
+    assert np.all(ask_prices >= bid_prices)
+    result["ask_prices"] = ask_prices
+    result["bid_prices"] = bid_prices
+
+    if parameters.use_decision_kernel and input_order_volume_crypto is None:
+        # All modes, tiers and a grid of volumes up to the order volume in one pass. Each mode gets its feasible
+        # volume with the highest expected gain and the best mode is the one with the highest expected relative
+        # gain (as in the solver path below).
+        kernel = parameters.get_kernel(venue_names, fees, order_volume_crypto)
+        kernel.update_books(depths)
+        best = kernel.evaluate(balances_fiat, balances_crypto)
+        volume_indices = kernel.get_pair_volume_indices()
+        buy_indices, sell_indices = np.indices((num_venues, num_venues))
+        order_volumes_crypto = kernel.volumes[volume_indices]
+        exp_gains_fiat = kernel.gains_fiat[buy_indices, sell_indices, volume_indices]
+        exp_relative_gains = kernel.relative_gains[buy_indices, sell_indices, volume_indices]
+        exp_relative_gains = np.where(np.isfinite(exp_relative_gains), exp_relative_gains, -np.inf)
+        np.fill_diagonal(exp_relative_gains, -np.inf)
+        buy_volumes_fiat = kernel.buy_volumes_fiat[buy_indices, volume_indices]
+        feasible = kernel.feasible[buy_indices, sell_indices, volume_indices]
+        tier_indices = kernel.tier_indices[buy_indices, sell_indices, volume_indices]
+        best_pair = None if best is None else (int(best[0]), int(best[1]))
+        balance_valid = kernel.fiat_valid[:, np.newaxis, :] & kernel.crypto_valid[np.newaxis, :, :]
+        volume_solutions = []
+        for buy_index, sell_index in get_arbitration_pairs(num_venues):
+            if exp_gains_fiat[buy_index, sell_index] > 0:
+                valid_volumes = kernel.volumes[balance_valid[buy_index, sell_index]]
+                volume_solutions.append((buy_index, sell_index, {
+                    "optimal_volume": float(order_volumes_crypto[buy_index, sell_index]),
+                    "volume_limit": float(valid_volumes[-1]) if len(valid_volumes) > 0 else 0.0,
+                    "gain_fiat": float(exp_gains_fiat[buy_index, sell_index]),
+                }))
+        # Average fill prices of the order volume of each pair (buy venue in rows, sell venue in columns)
+        vwap_ask_prices = np.array([depths[index][0].get_vwap(order_volumes_crypto[index, :])
+                                    for index in range(num_venues)])
+        vwap_bid_prices = np.array([depths[index][1].get_vwap(order_volumes_crypto[:, index])
+                                    for index in range(num_venues)]).T
+        with np.errstate(invalid="ignore", divide="ignore"):
+            gain_ask_prices = kernel.ask_costs[buy_indices, volume_indices] / order_volumes_crypto
+            gain_bid_prices = kernel.bid_proceeds[sell_indices, volume_indices] / order_volumes_crypto
+        result.update({
+            "volume_grid": kernel.volumes,
+            "feasibility_table": kernel.feasible.copy(),
+            "tier_index_table": kernel.tier_indices.copy(),
+            "gain_table": kernel.gains_fiat.copy(),
+        })
+    else:
+        # Find the order volume that maximizes the expected gain for each pair of venues.
+        # The solver only runs for pairs where the best prices (including fees) leave a spread at all.
+        order_volumes_crypto = np.full((num_venues, num_venues), order_volume_crypto)
+        volume_solutions = []
+        if parameters.optimize_order_volume and input_order_volume_crypto is None:
+            best_ask_prices = np.array([depth[0].get_worst_price(0.0) for depth in depths])
+            best_bid_prices = np.array([depth[1].get_worst_price(0.0) for depth in depths])
+            has_spread = best_bid_prices[np.newaxis, :] * (1 - fees[np.newaxis, :]) \
+                > best_ask_prices[:, np.newaxis] * (1 + fees[:, np.newaxis])
+            ndigits_factor = 10 ** parameters.crypto_ndigits
+            for buy_index, sell_index in zip(*np.nonzero(has_spread)):
+                solution = ccxt_utils.solve_order_volume(
+                    depths[buy_index][0], fees[buy_index], depths[sell_index][1], fees[sell_index],
+                    max_volume=order_volume_crypto, max_balance_fiat=balances_fiat[buy_index],
+                    max_balance_crypto=balances_crypto[sell_index],
+                    buy_safety_factor_fiat=parameters.buy_safety_factor_fiat)
+                solution["optimal_volume"] = math.floor(solution["volume"] * ndigits_factor) / ndigits_factor
+                volume_solutions.append((int(buy_index), int(sell_index), solution))
+                # Without a profitable volume we keep the default volume and leave the decision to the threshold ladder
+                if solution["gain_fiat"] > 0 and solution["optimal_volume"] > parameters.min_volume_crypto:
+                    order_volumes_crypto[buy_index, sell_index] = solution["optimal_volume"]
+
+        # Average fill prices of the order volume of each pair (buy venue in rows, sell venue in columns)
+        vwap_ask_prices = np.array([depths[index][0].get_vwap(order_volumes_crypto[index, :])
+                                    for index in range(num_venues)])
+        vwap_bid_prices = np.array([depths[index][1].get_vwap(order_volumes_crypto[:, index])
+                                    for index in range(num_venues)]).T
+        if parameters.use_vwap_prices:
+            gain_ask_prices, gain_bid_prices = vwap_ask_prices, vwap_bid_prices
+        else:
+            gain_ask_prices = np.repeat(ask_prices[:, np.newaxis], num_venues, axis=1)
+            gain_bid_prices = np.repeat(bid_prices[np.newaxis, :], num_venues, axis=0)
+
+        exp_gains_fiat, exp_relative_gains, buy_volumes_fiat = compute_gain_matrix(
+            gain_ask_prices, gain_bid_prices, fees, order_volumes_crypto)
+        feasible, tier_indices = compute_feasibility(
+            exp_relative_gains, buy_volumes_fiat, order_volumes_crypto, balances_fiat, balances_crypto,
+            tier_min_relative_gains, tier_min_fiat_reserves, parameters.buy_safety_factor_fiat)
+        best_pair = select_best_pair(exp_relative_gains, feasible)
+    result.update({
+        "order_volumes_crypto": order_volumes_crypto,
+        "volume_solutions": volume_solutions,
+        "vwap_ask_prices": vwap_ask_prices,
+        "vwap_bid_prices": vwap_bid_prices,
+        "gain_ask_prices": gain_ask_prices,
+        "gain_bid_prices": gain_bid_prices,
+        "exp_gains_fiat": exp_gains_fiat,
+        "exp_relative_gains": exp_relative_gains,
+        "buy_volumes_fiat": buy_volumes_fiat,
+        "feasible": feasible,
+        "tier_indices": tier_indices,
+        "tier_min_relative_gains": tier_min_relative_gains,
+        "tier_min_fiat_reserves": tier_min_fiat_reserves,
+        "best_pair": best_pair,
+    })
+    if best_pair is None:
+        result["status"] = "no_opportunity"
+        return result
+
+    buy_index, sell_index = best_pair
+    order_volume_crypto = order_volumes_crypto[buy_index, sell_index]
+    buy_volume_fiat = buy_volumes_fiat[buy_index, sell_index]
+    crypto_reduced = False
+    fiat_reduced = False
+    if order_volume_crypto > balances_crypto[sell_index]:
+        crypto_reduced = True
+        order_volume_crypto = balances_crypto[sell_index]
+    if buy_volume_fiat * parameters.buy_safety_factor_fiat > balances_fiat[buy_index]:
+        fiat_reduced = True
+        reduce_factor = balances_fiat[buy_index] / (buy_volume_fiat * parameters.buy_safety_factor_fiat)
+        order_volume_crypto = round(reduce_factor * order_volume_crypto, parameters.crypto_ndigits)
+
+    # Limit total losses if market moves extremely fast (if the market recovers again)
+    buy_limit_price_fiat = round(parameters.limit_price_safety_factor * ask_prices[buy_index],
+                                 parameters.fiat_ndigits)
+    sell_limit_price_fiat = round(bid_prices[sell_index] / parameters.limit_price_safety_factor,
+                                  parameters.fiat_ndigits)
+    result.update({
+        "status": "trade",
+        "buy_index": buy_index,
+        "sell_index": sell_index,
+        "order_volume_crypto": float(order_volume_crypto),
+        "crypto_reduced": crypto_reduced,
+        "fiat_reduced": fiat_reduced,
+        "exp_relative_gain": float(exp_relative_gains[buy_index, sell_index]),
+        "exp_gain_fiat": float(exp_gains_fiat[buy_index, sell_index]),
+        "chosen_min_relative_gain": float(tier_min_relative_gains[buy_index, sell_index,
+                                                                  tier_indices[buy_index, sell_index]]),
+        "buy_limit_price_fiat": buy_limit_price_fiat,
+        "sell_limit_price_fiat": sell_limit_price_fiat,
+    })
+    return result
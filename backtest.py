@@ -0,0 +1,253 @@
+import sys
+import time
+import json
+import argparse
+import numpy as np
+
+import ccxt_utils
+import arbitrage_engine
+import order_book_recorder
+
+
+def get_record_depths(data, index):
+    # Both sides of a recorded book as ccxt_utils.OrderBookDepth (NaN prices are padding)
+    segment, record_index = data.locate(index)
+    depths = []
+    for side, missing_price in (("ask", float("inf")), ("bid", 0.0)):
+        prices = segment["{}_prices".format(side)][record_index]
+        volumes = segment["{}_volumes".format(side)][record_index]
+        valid = ~np.isnan(prices)
+        depths.append(ccxt_utils.OrderBookDepth(prices[valid], volumes[valid], missing_price))
+    return tuple(depths)
+
+
+def align_records(datas, max_skew=2.0):
+    # Merge the records of all venues into one time line. At every record time of any venue the latest
+    # record of each venue is used. Times where a venue has no record yet or where the snapshots are more
+    # than max_skew seconds apart are dropped.
+    # Returns the times and a (num_times, num_venues) array of record indices.
+    all_times = [data.response_time for data in datas]
+    if any(len(times) == 0 for times in all_times):
+        return np.zeros(0), np.zeros((0, len(datas)), dtype=np.int64)
+    times = np.unique(np.concatenate(all_times))
+    indices = np.column_stack([np.searchsorted(venue_times, times, side="right") - 1
+                               for venue_times in all_times])
+    valid = np.all(indices >= 0, axis=1)
+    times = times[valid]
+    indices = indices[valid]
+    record_times = np.column_stack([venue_times[indices[:, venue_index]]
+                                    for venue_index, venue_times in enumerate(all_times)])
+    valid = np.max(record_times, axis=1) - np.min(record_times, axis=1) <= max_skew
+    return times[valid], indices[valid]
+
+
+def simulate_fill(depth, volume, limit_price, is_buy):
+    # Fill a limit order by walking the recorded book. Levels beyond the limit price are not taken.
+    # Returns the filled volume and its cost (excluding fees).
+    if is_buy:
+        num_levels = np.searchsorted(depth.prices, limit_price, side="right")
+    else:
+        num_levels = np.searchsorted(-depth.prices, -limit_price, side="right")
+    available_volume = depth.acc_volumes[num_levels - 1] if num_levels > 0 else 0.0
+    volume = min(volume, available_volume)
+    if volume <= 0:
+        return 0.0, 0.0
+    return volume, float(depth.get_cost(volume))
+
+
+class BacktestData(object):
+    # Aligned order book records of all venues plus the per snapshot values that do not depend on the
+    # parameters. The records stay memory maps (order_book_recorder.SegmentedRecords), so several processes
+    # share them read-only.
+
+    def __init__(self, datas, times, indices, fees):
+        self.datas = datas
+        self.times = times
+        self.indices = indices
+        self.fees = np.asarray(fees, dtype=np.float64)
+        num_venues = len(datas)
+        best_ask_prices = np.column_stack([
+            datas[venue_index].take("ask_prices", indices[:, venue_index], 0).astype(np.float64)
+            for venue_index in range(num_venues)]) if len(times) > 0 else np.zeros((0, num_venues))
+        best_bid_prices = np.column_stack([
+            datas[venue_index].take("bid_prices", indices[:, venue_index], 0).astype(np.float64)
+            for venue_index in range(num_venues)]) if len(times) > 0 else np.zeros((0, num_venues))
+        self.mid_prices = np.nanmean(0.5 * (best_ask_prices + best_bid_prices), axis=1)
+        # Relative gain of each pair at the best prices (snapshot, buy venue, sell venue).
+        # Any order volume only gets worse prices so this bounds the gain that decide() can see.
+        buy_prices = best_ask_prices * (1 + self.fees[np.newaxis, :])
+        sell_prices = best_bid_prices * (1 - self.fees[np.newaxis, :])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.max_relative_gains = sell_prices[:, np.newaxis, :] / buy_prices[:, :, np.newaxis] - 1
+        self.max_relative_gains = np.where(np.isnan(self.max_relative_gains), -np.inf, self.max_relative_gains)
+
+    @classmethod
+    def load(cls, folder, venue_names, symbol, fees, start_time=None, end_time=None, max_skew=2.0):
+        datas, times, indices = load_records(folder, venue_names, symbol, start_time, end_time, max_skew)
+        return cls(datas, times, indices, fees)
+
+    def get_candidates(self, tier_min_relative_gains):
+        # Snapshots where at least one pair could pass its lowest threshold tier
+        min_relative_gains = np.min(tier_min_relative_gains, axis=2)
+        np.fill_diagonal(min_relative_gains, np.inf)
+        return np.flatnonzero(np.any(self.max_relative_gains >= min_relative_gains[np.newaxis, :, :], axis=(1, 2)))
+
+    def get_depths(self, time_index):
+        return [get_record_depths(data, self.indices[time_index, venue_index])
+                for venue_index, data in enumerate(self.datas)]
+
+
+class Backtester(object):
+    # Replays aligned order book records through arbitrage_engine.decide with simulated balances.
+    # A trade fills both legs against the books it was decided on (no market impact between snapshots)
+    # and is followed by a cooldown in which no further trades are made, like the wait for the order
+    # fills in the live loop.
+    # Snapshots where no pair can reach its lowest threshold at the best prices are skipped, which
+    # doesn't change the result but makes runs over long periods fast.
+
+    def __init__(self, venue_names, parameters, balances_fiat, balances_crypto, cooldown=10.0):
+        self.venue_names = list(venue_names)
+        self.parameters = parameters
+        self.initial_balances_fiat = np.array(balances_fiat, dtype=np.float64)
+        self.initial_balances_crypto = np.array(balances_crypto, dtype=np.float64)
+        self.cooldown = cooldown
+
+    def run(self, data):
+        balances_fiat = self.initial_balances_fiat.copy()
+        balances_crypto = self.initial_balances_crypto.copy()
+        fees = data.fees
+        tier_min_relative_gains, _ = self.parameters.get_tiers(self.venue_names)
+        candidates = data.get_candidates(tier_min_relative_gains)
+        trades = []
+        # Total balances are constant between trades
+        trade_time_indices = [0]
+        total_balances_fiat = [np.sum(balances_fiat)]
+        total_balances_crypto = [np.sum(balances_crypto)]
+        num_no_volume = 0
+        next_trade_time = -np.inf
+        start_time = time.time()
+        for time_index in candidates:
+            snapshot_time = data.times[time_index]
+            if snapshot_time < next_trade_time:
+                continue
+            depths = data.get_depths(time_index)
+            decision = arbitrage_engine.decide(
+                self.venue_names, depths, fees, balances_fiat, balances_crypto, self.parameters)
+            if decision["status"] == "no_volume":
+                num_no_volume += 1
+            elif decision["status"] == "trade" and decision["order_volume_crypto"] > 0:
+                trade = self._execute(decision, depths, fees, balances_fiat, balances_crypto)
+                trade["time"] = float(snapshot_time)
+                trades.append(trade)
+                next_trade_time = snapshot_time + self.cooldown
+                trade_time_indices.append(time_index)
+                total_balances_fiat.append(np.sum(balances_fiat))
+                total_balances_crypto.append(np.sum(balances_crypto))
+        run_time = time.time() - start_time
+        segments = np.searchsorted(trade_time_indices, np.arange(len(data.times)), side="right") - 1
+        equities = np.asarray(total_balances_fiat)[segments] \
+            + np.asarray(total_balances_crypto)[segments] * data.mid_prices
+        report = self._report(trades, data.times, equities, run_time)
+        report["num_candidates"] = len(candidates)
+        report["num_no_volume"] = num_no_volume
+        report["balances_fiat"] = balances_fiat.tolist()
+        report["balances_crypto"] = balances_crypto.tolist()
+        return report
+
+    def _execute(self, decision, depths, fees, balances_fiat, balances_crypto):
+        buy_index = decision["buy_index"]
+        sell_index = decision["sell_index"]
+        volume = decision["order_volume_crypto"]
+        buy_volume, buy_cost = simulate_fill(depths[buy_index][0], volume, decision["buy_limit_price_fiat"], True)
+        sell_volume, sell_cost = simulate_fill(depths[sell_index][1], volume, decision["sell_limit_price_fiat"], False)
+        buy_volume_fiat = buy_cost * (1 + fees[buy_index])
+        sell_volume_fiat = sell_cost * (1 - fees[sell_index])
+        balances_fiat[buy_index] -= buy_volume_fiat
+        balances_crypto[buy_index] += buy_volume
+        balances_fiat[sell_index] += sell_volume_fiat
+        balances_crypto[sell_index] -= sell_volume
+        gain_fiat = sell_volume_fiat - buy_volume_fiat
+        return {
+            "mode": arbitrage_engine.get_arbitration_mode_str(
+                self.venue_names[buy_index], self.venue_names[sell_index]),
+            "volume": volume,
+            "buy_volume": buy_volume,
+            "sell_volume": sell_volume,
+            "gain_fiat": gain_fiat,
+            "relative_gain": gain_fiat / buy_volume_fiat if buy_volume_fiat > 0 else 0.0,
+            "exp_relative_gain": decision["exp_relative_gain"],
+        }
+
+    def _report(self, trades, times, equities, run_time):
+        if len(equities) > 0:
+            peak_equities = np.maximum.accumulate(equities)
+            max_drawdown = float(np.max(peak_equities - equities))
+            pnl = float(equities[-1] - equities[0])
+        else:
+            max_drawdown = 0.0
+            pnl = 0.0
+        return {
+            "num_snapshots": len(times),
+            "num_trades": len(trades),
+            "pnl": pnl,
+            "trade_gain_fiat": float(sum(trade["gain_fiat"] for trade in trades)),
+            "max_drawdown": max_drawdown,
+            "start_time": float(times[0]) if len(times) > 0 else None,
+            "end_time": float(times[-1]) if len(times) > 0 else None,
+            "run_time": run_time,
+            "snapshots_per_second": len(times) / run_time if run_time > 0 else 0.0,
+            "trades": trades,
+        }
+
+
+def load_records(folder, venue_names, symbol, start_time=None, end_time=None, max_skew=2.0):
+    archive = order_book_recorder.OrderBookArchive(folder)
+    datas = [archive.load(name, symbol, start_time, end_time) for name in venue_names]
+    times, indices = align_records(datas, max_skew)
+    return datas, times, indices
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Backtest the arbitrage decision on recorded order books")
+    parser.add_argument("folder", help="Record folder of order_book_recorder")
+    parser.add_argument("--symbol", default="ETH/EUR")
+    parser.add_argument("--exchanges", default="kraken,gdax")
+    parser.add_argument("--fees", default="0.0026,0.003", help="Fee ratio per exchange")
+    parser.add_argument("--balances-fiat", default="5000,5000")
+    parser.add_argument("--balances-crypto", default="5,5")
+    parser.add_argument("--start-time", type=float, default=None)
+    parser.add_argument("--end-time", type=float, default=None)
+    parser.add_argument("--max-skew", type=float, default=2.0)
+    parser.add_argument("--cooldown", type=float, default=10.0)
+    parser.add_argument("--max-volume", type=float, default=0.5)
+    parser.add_argument("--min-gains", default="2.0,1.5,1.0,0.75", help="Min gain ladder in percent")
+    parser.add_argument("--min-fiat-reserves", default="0.0,0.4,0.6,0.75")
+    parser.add_argument("--use-vwap-prices", action="store_true")
+    parser.add_argument("--json", action="store_true", help="Print the report (including trades) as JSON")
+    args = parser.parse_args(argv)
+
+    venue_names = args.exchanges.split(",")
+    parameters = arbitrage_engine.ArbitrageParameters(
+        {}, {},
+        [float(gain) / 100.0 for gain in args.min_gains.split(",")],
+        [float(reserve) for reserve in args.min_fiat_reserves.split(",")],
+        max_volume_crypto=args.max_volume, use_vwap_prices=args.use_vwap_prices)
+    data = BacktestData.load(args.folder, venue_names, args.symbol, [float(fee) for fee in args.fees.split(",")],
+                             args.start_time, args.end_time, args.max_skew)
+    backtester = Backtester(venue_names, parameters,
+                            [float(balance) for balance in args.balances_fiat.split(",")],
+                            [float(balance) for balance in args.balances_crypto.split(",")],
+                            cooldown=args.cooldown)
+    report = backtester.run(data)
+    if args.json:
+        print(json.dumps(report))
+        return
+    print("Snapshots: {:d} ({:d} candidates, {:.0f} per second)".format(
+        report["num_snapshots"], report["num_candidates"], report["snapshots_per_second"]))
+    print("Trades: {:d}".format(report["num_trades"]))
+    print("P&L: {:.2f} (trade gains {:.2f})".format(report["pnl"], report["trade_gain_fiat"]))
+    print("Max drawdown: {:.2f}".format(report["max_drawdown"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
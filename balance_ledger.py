@@ -0,0 +1,168 @@
+import time
+import logging
+import threading
+import numpy as np
+
+
+class BalanceLedger(object):
+    # Balances per venue and currency kept in process.
+    # Totals are changed by confirmed fills and their fees. Amounts for open orders are reserved,
+    # so the available balance is the total minus the reservations.
+    # A background thread reconciles the totals with the free balances of the exchange every
+    # reconcile_interval seconds. Venues with reservations are skipped then, because fills of open orders
+    # may not be applied yet (and without open orders the free balance is the whole balance). A balance is
+    # only compared if no order of the venue was reserved, released or filled while it was fetched, else it
+    # may be from before the fill (or from while the order was open) and the venue is reconciled again.
+    # A difference larger than the tolerance of the currency raises the deviation alarm and the exchange
+    # balance replaces the ledger balance.
+
+    def __init__(self, fetch_balance_fns, currencies, tolerances=None, reconcile_interval=60.0, on_deviation=None):
+        # fetch_balance_fns: venue name -> function returning a ccxt balance (or None on failure)
+        self.fetch_balance_fns = fetch_balance_fns
+        self.currencies = list(currencies)
+        self.tolerances = tolerances or {}
+        self.reconcile_interval = reconcile_interval
+        self.on_deviation = on_deviation
+        self.totals = {name: {currency: 0.0 for currency in self.currencies} for name in fetch_balance_fns}
+        self.reservations = {name: {} for name in fetch_balance_fns}
+        self.lock = threading.Lock()
+        self.reconcile_event = threading.Event()
+        self.last_reconcile_times = {name: None for name in fetch_balance_fns}
+        # Number of reservations, releases and fills per venue
+        self.update_counts = {name: 0 for name in fetch_balance_fns}
+        self.num_fills = 0
+        self.num_reconciles = 0
+        self.num_stale_balances = 0
+        self.num_fetch_errors = 0
+        self.num_deviations = 0
+        self.deviations = []
+        self._stop = False
+        self._thread = None
+
+    def set_balance(self, name, balance, update_count=None):
+        # Set the totals of a venue from the free amounts of a ccxt balance. Returns the deviations
+        # (currency, ledger, exchange), or None if update_count (of the venue when the balance was requested)
+        # shows that orders were reserved, released or filled since then.
+        deviations = []
+        with self.lock:
+            if update_count is not None and self.update_counts[name] != update_count:
+                self.num_stale_balances += 1
+                return None
+            totals = self.totals[name]
+            for currency in self.currencies:
+                exchange_total = float((balance.get(currency) or {}).get("free") or 0.0)
+                if self.last_reconcile_times[name] is not None:
+                    tolerance = self.tolerances.get(currency)
+                    if tolerance is not None and abs(exchange_total - totals[currency]) > tolerance:
+                        deviations.append((currency, totals[currency], exchange_total))
+                totals[currency] = exchange_total
+            self.last_reconcile_times[name] = time.time()
+            self.num_reconciles += 1
+        for currency, ledger_total, exchange_total in deviations:
+            self.num_deviations += 1
+            self.deviations.append((time.time(), name, currency, ledger_total, exchange_total))
+            logging.error("Balance deviation on {}: ledger {:f} {}, exchange {:f} {}".format(
+                name, ledger_total, currency, exchange_total, currency))
+            if self.on_deviation is not None:
+                self.on_deviation(name, currency, ledger_total, exchange_total)
+        return deviations
+
+    def _fetch_balance(self, name):
+        try:
+            return self.fetch_balance_fns[name]()
+        except Exception as err:
+            logging.warning("Unable to fetch {} balance ({}).".format(name, err))
+            return None
+
+    def reconcile(self, names=None, force=False, executor=None):
+        # Fetch the balances of the venues (all by default) and compare them with the ledger.
+        # With an executor the balances of all venues are fetched concurrently.
+        # Returns the names of the venues whose orders changed during the fetch (and were not compared).
+        fetch_names = []
+        update_counts = {}
+        for name in names or list(self.fetch_balance_fns.keys()):
+            with self.lock:
+                has_reservations = len(self.reservations[name]) > 0
+                update_counts[name] = self.update_counts[name]
+            if has_reservations and not force:
+                continue
+            fetch_names.append(name)
+        if executor is not None:
+            futures = [(name, executor.submit(self._fetch_balance, name)) for name in fetch_names]
+            balances = [(name, future.result()) for name, future in futures]
+        else:
+            balances = ((name, self._fetch_balance(name)) for name in fetch_names)
+        stale_names = []
+        for name, balance in balances:
+            if balance is None:
+                self.num_fetch_errors += 1
+                continue
+            if self.set_balance(name, balance, update_counts[name]) is None:
+                stale_names.append(name)
+        return stale_names
+
+    def request_reconcile(self):
+        # Reconcile on the background thread as soon as possible
+        self.reconcile_event.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="balance_ledger")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop = True
+        self.reconcile_event.set()
+
+    def _run(self):
+        while not self._stop:
+            self.reconcile_event.wait(self.reconcile_interval)
+            self.reconcile_event.clear()
+            if self._stop:
+                break
+            if self.reconcile():
+                # Orders changed during the fetch: try again with a new balance
+                self.reconcile_event.set()
+
+    def reserve(self, name, key, currency, amount):
+        with self.lock:
+            self.reservations[name][key] = (currency, amount)
+            self.update_counts[name] += 1
+
+    def release(self, name, key):
+        with self.lock:
+            self.reservations[name].pop(key, None)
+            self.update_counts[name] += 1
+
+    def apply_fill(self, name, side, base_currency, quote_currency, filled, cost, fee_cost=None, fee_currency=None,
+                   key=None):
+        # Apply a (final) fill of an order and release its reservation
+        with self.lock:
+            totals = self.totals[name]
+            if side == "buy":
+                totals[base_currency] += filled
+                totals[quote_currency] -= cost
+            else:
+                totals[base_currency] -= filled
+                totals[quote_currency] += cost
+            if fee_cost is not None and fee_currency in totals:
+                totals[fee_currency] -= fee_cost
+            if key is not None:
+                self.reservations[name].pop(key, None)
+            self.update_counts[name] += 1
+            self.num_fills += 1
+
+    def get_total(self, name, currency):
+        with self.lock:
+            return self.totals[name][currency]
+
+    def get_available(self, name, currency):
+        with self.lock:
+            reserved = sum(amount for reserved_currency, amount in self.reservations[name].values()
+                           if reserved_currency == currency)
+            return self.totals[name][currency] - reserved
+
+    def get_available_arrays(self, names, currencies):
+        # Available balances as one array per currency (in the order of names)
+        return tuple(np.array([self.get_available(name, currency) for name in names]) for currency in currencies)
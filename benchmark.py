@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import base64
+import timeit
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+import ccxt_utils
+import arbitrage_engine
+
+
+DEFAULT_LEVELS = [10, 100, 1000, 10000]
+BENCHMARK_VENUES = ["mock_kraken", "mock_gdax"]
+
+
+def make_order_book(num_levels, mid_price=400.0, spread=0.001, tick=0.01, mean_volume=2.0, seed=0):
+    # Synthetic L2 book with num_levels levels per side around mid_price
+    rng = np.random.RandomState(seed)
+    best_ask = mid_price * (1 + spread / 2)
+    best_bid = mid_price * (1 - spread / 2)
+    ask_prices = best_ask + tick * np.cumsum(rng.randint(1, 4, num_levels))
+    bid_prices = best_bid - tick * np.cumsum(rng.randint(1, 4, num_levels))
+    ask_volumes = rng.exponential(mean_volume, num_levels) + 0.001
+    bid_volumes = rng.exponential(mean_volume, num_levels) + 0.001
+    return {
+        "asks": [[float(price), float(volume)] for price, volume in zip(ask_prices, ask_volumes)],
+        "bids": [[float(price), float(volume)] for price, volume in zip(bid_prices, bid_volumes)],
+        "timestamp": None,
+    }
+
+
+def create_benchmark_parameters():
+    return arbitrage_engine.ArbitrageParameters(
+        {}, {}, [0.02, 0.015, 0.01, 0.0075], [0.0, 0.4, 0.6, 0.75], max_volume_crypto=0.5)
+
+
+def time_call(fn, repeat=5, min_time=0.2):
+    # Median and minimum time per call in seconds (each sample runs fn for at least min_time seconds)
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    samples = [elapsed / number] + [timer.timeit(number) / number for _ in range(repeat - 1)]
+    return float(np.median(samples)), float(np.min(samples)), number * repeat
+
+
+def run_micro_benchmarks(levels=DEFAULT_LEVELS, repeat=5, min_time=0.2):
+    results = []
+    fees = np.array([0.0026, 0.003])
+    balances_fiat = np.array([5000.0, 5000.0])
+    balances_crypto = np.array([5.0, 5.0])
+    parameters = create_benchmark_parameters()
+    kernel_parameters = create_benchmark_parameters()
+    kernel_parameters.use_decision_kernel = True
+    kernel = kernel_parameters.get_kernel(BENCHMARK_VENUES, fees, kernel_parameters.max_volume_crypto)
+    for num_levels in levels:
+        order_books = [make_order_book(num_levels, mid_price=400.0, seed=1),
+                       make_order_book(num_levels, mid_price=412.0, seed=2)]
+        depths = [ccxt_utils.get_order_book_depths(order_book) for order_book in order_books]
+        kernel.update_books(depths)
+        ask_prices = np.array([depth[0].get_worst_price(1.0) for depth in depths])
+        bid_prices = np.array([depth[1].get_worst_price(1.0) for depth in depths])
+        cases = [
+            ("order_book_depths", lambda: ccxt_utils.get_order_book_depths(order_books[0])),
+            ("conservative_ask_bid_price", lambda: ccxt_utils.get_conservative_ask_bid_price(order_books[0], 5.0)),
+            ("conservative_ask_bid_price_depths",
+             lambda: ccxt_utils.get_conservative_ask_bid_price(None, 5.0, depths[0])),
+            ("gain_matrix", lambda: arbitrage_engine.compute_gain_matrix(ask_prices, bid_prices, fees, 0.5)),
+            ("solve_order_volume", lambda: ccxt_utils.solve_order_volume(
+                depths[0][0], fees[0], depths[1][1], fees[1], max_volume=0.5,
+                max_balance_fiat=balances_fiat[0], max_balance_crypto=balances_crypto[1])),
+            ("decide", lambda: arbitrage_engine.decide(
+                BENCHMARK_VENUES, depths, fees, balances_fiat, balances_crypto, parameters)),
+            ("decide_kernel", lambda: arbitrage_engine.decide(
+                BENCHMARK_VENUES, depths, fees, balances_fiat, balances_crypto, kernel_parameters)),
+            ("kernel_update_venue", lambda: kernel.update_venue(0, *depths[0])),
+            ("kernel_evaluate", lambda: kernel.evaluate(balances_fiat, balances_crypto)),
+        ]
+        for name, fn in cases:
+            median_time, min_time_per_call, num_calls = time_call(fn, repeat, min_time)
+            results.append({"name": name, "levels": num_levels, "median_us": 1e6 * median_time,
+                            "min_us": 1e6 * min_time_per_call, "calls": num_calls})
+    return results
+
+
+def write_mock_key_files(folder):
+    # Key files in the formats of kraken_wrapper and gdax_wrapper (the mock servers don't check signatures,
+    # but the clients need base64 secrets to sign with)
+    secret = base64.b64encode(os.urandom(64)).decode("ascii")
+    key_files = {"kraken": os.path.join(folder, "kraken_mock.key"), "gdax": os.path.join(folder, "gdax_mock.key")}
+    with open(key_files["kraken"], "w") as fout:
+        fout.write("mock_key\n{}\n".format(secret))
+    with open(key_files["gdax"], "w") as fout:
+        fout.write("mock_passphrase\nmock_key\n{}\n".format(secret))
+    return key_files
+
+
+def get_stage_latencies(registry, name="stage_latency_seconds"):
+    # Sum and count of the stage latencies of the trading loop per stage (over all venues)
+    stages = {}
+    with registry.lock:
+        for (histogram_name, labels), histogram in registry.histograms.items():
+            if histogram_name != name:
+                continue
+            stage = dict(labels).get("stage")
+            total, count = stages.get(stage, (0.0, 0))
+            stages[stage] = (total + histogram.sum, count + histogram.count)
+    return stages
+
+
+def run_end_to_end_benchmark(num_iterations=10, num_levels=50, latency=0.05, jitter=0.01, symbol="ETH/EUR"):
+    # Iterations of the trading loop of ccxt_arbitration_new (with its logging, gains log, order registry,
+    # ledger and leg execution) against mock_exchange servers for Kraken and Gdax. The market makers quote
+    # 3 % apart, so every iteration trades. Latency is injected by the servers (plus an exponential jitter).
+    # Rate limits are off on both sides, so the times are the latencies of the loop itself.
+    import ccxt_arbitration_new as engine
+    import mock_exchange
+    import metrics
+
+    crypto, fiat = symbol.split("/")
+    servers = []
+    market_makers = []
+    folder = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        urls = {}
+        for seed, (name, mid_price) in enumerate((("kraken", 400.0), ("gdax", 412.0))):
+            server, market_maker = mock_exchange.create_server(
+                name, crypto, fiat, {crypto: 1000.0, fiat: 1000000.0}, latency=latency, jitter=jitter,
+                rate_limits=False, mid_price=mid_price, volatility=0.0, seed=seed)
+            market_maker.num_levels = num_levels
+            market_maker.start()
+            servers.append(server.start())
+            market_makers.append(market_maker)
+            urls[name] = server.url
+        engine.exchange_names = ["kraken", "gdax"]
+        engine.exchange_key_files = write_mock_key_files(folder)
+        engine.mock_exchange_urls = urls
+        engine.crypto = crypto
+        engine.fiat = fiat
+        engine.symbol = symbol
+        engine.log_filename = os.path.join(folder, "engine.log")
+        engine.log_to_console = False
+        engine.gains_log_filename = os.path.join(folder, "gains.log")
+        engine.market_cache_ttl = None
+        engine.metrics_port = None
+        engine.use_rate_limiters = False
+        engine.simulate = False
+
+        startup_start_time = time.time()
+        engine.init()
+        startup_time = time.time() - startup_start_time
+        # Warm up (thread pools, HTTP connections, first numpy calls)
+        engine.num_iterations = 1
+        engine.run()
+        stages_before = get_stage_latencies(metrics.REGISTRY)
+        num_executions_before = engine.leg_executor.num_executions
+        engine.num_iterations = num_iterations
+        start_time = time.time()
+        engine.run()
+        iteration_time = (time.time() - start_time) / num_iterations
+        stages_after = get_stage_latencies(metrics.REGISTRY)
+        num_trades = engine.leg_executor.num_executions - num_executions_before
+    except SystemExit:
+        raise RuntimeError("The trading loop stopped, see {}".format(os.path.join(folder, "engine.log")))
+    finally:
+        for market_maker in market_makers:
+            market_maker.stop()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if engine.gains_log_writer is not None:
+            engine.gains_log_writer.close()
+
+    stages = {"startup": {"mean_ms": 1000 * startup_time, "count": 1},
+              "iteration": {"mean_ms": 1000 * iteration_time, "count": num_iterations}}
+    for stage, (total, count) in stages_after.items():
+        total_before, count_before = stages_before.get(stage, (0.0, 0))
+        if count > count_before:
+            stages[stage] = {"mean_ms": 1000 * (total - total_before) / (count - count_before),
+                             "count": count - count_before}
+    return {
+        "iterations": num_iterations,
+        "levels": num_levels,
+        "latency_ms": 1000 * latency,
+        "jitter_ms": 1000 * jitter,
+        "num_trades": num_trades,
+        "log_folder": folder,
+        "stages": stages,
+    }
+
+
+def get_benchmark_values(results):
+    # Flat (key -> time) view of the results for comparisons
+    values = {}
+    for result in results.get("micro", []):
+        values["micro/{}/{:d}".format(result["name"], result["levels"])] = result["median_us"]
+    for stage, times in results.get("end_to_end", {}).get("stages", {}).items():
+        values["end_to_end/{}".format(stage)] = times["mean_ms"]
+    return values
+
+
+def compare_results(results, baseline, max_regression=0.25):
+    # Benchmarks that got slower than the baseline by more than max_regression (relative)
+    values = get_benchmark_values(results)
+    baseline_values = get_benchmark_values(baseline)
+    regressions = []
+    for key, value in sorted(values.items()):
+        baseline_value = baseline_values.get(key)
+        if baseline_value is None or baseline_value <= 0:
+            continue
+        change = value / baseline_value - 1
+        if change > max_regression:
+            regressions.append({"benchmark": key, "baseline": baseline_value, "value": value, "change": change})
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Micro and end-to-end latency benchmarks of the trading loop")
+    parser.add_argument("--levels", default=",".join(str(levels) for levels in DEFAULT_LEVELS),
+                        help="Book levels of the micro benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum time of one sample in seconds")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    parser.add_argument("--iterations", type=int, default=10, help="Iterations of the end-to-end benchmark")
+    parser.add_argument("--e2e-levels", type=int, default=50, help="Levels per side of the mock market makers")
+    parser.add_argument("--latency", type=float, default=0.05, help="Injected latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Mean of the exponential extra latency")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="JSON results to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="Fail if a benchmark is slower than the baseline by more than this ratio")
+    args = parser.parse_args(argv)
+
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+    if not args.skip_micro:
+        results["micro"] = run_micro_benchmarks([int(levels) for levels in args.levels.split(",")],
+                                                args.repeat, args.min_time)
+    if not args.skip_end_to_end:
+        results["end_to_end"] = run_end_to_end_benchmark(args.iterations, args.e2e_levels, args.latency,
+                                                         args.jitter)
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fin:
+            baseline = json.load(fin)
+        results["regressions"] = compare_results(results, baseline, args.max_regression)
+    if args.output is not None:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=2)
+    print(json.dumps(results, indent=2))
+    if results.get("regressions"):
+        for regression in results["regressions"]:
+            sys.stderr.write("Regression: {} {:.3f} -> {:.3f} ({:+.1f} %)\n".format(
+                regression["benchmark"], regression["baseline"], regression["value"], 100 * regression["change"]))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
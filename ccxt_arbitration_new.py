@@ -1,35 +1,73 @@
 import sys
 import os
+import atexit
 import time
 import datetime
 import math
 import random
 import uuid
 import logging
+import threading
+import collections
 import numpy as np
 
 import ccxt
 import ccxt_utils
+import arbitrage_engine
+import currency_graph
+import order_book_stream
+import order_book_recorder
+import gains_log
+import trading_log
+import fill_watcher
+import order_registry
+import balance_ledger
+import rate_limiter
+import http_transport
+import market_cache
+import leg_execution
+import metrics
 
 import gdax_wrapper
 import kraken_wrapper
 
 home_folder = os.environ["HOME"]
-logging.basicConfig(filename=os.path.join(home_folder, 'ccxt_arbitration_new.log'), level=logging.DEBUG)
-logging.getLogger().addHandler(logging.StreamHandler())
-
-BUY_KRAKEN_SELL_GDAX = 0
-BUY_GDAX_SELL_KRAKEN = 1
-ARBITRATION_MODES = [BUY_KRAKEN_SELL_GDAX, BUY_GDAX_SELL_KRAKEN]
-ARBITRATION_MODES_STR = {
-    BUY_KRAKEN_SELL_GDAX: "BUY_KRAKEN_SELL_GDAX",
-    BUY_GDAX_SELL_KRAKEN: "BUY_GDAX_SELL_KRAKEN",
+# Logging: handlers run on a listener thread (use_queue_logging) and messages are only formatted
+# if their level is enabled. Levels can be set per subsystem of the trading loop:
+# None (main loop), "orders" (order lookup and status) and "gains" (expected gains of each pair).
+use_queue_logging = True
+structured_logging = False
+log_levels = {
+    None: logging.INFO,
+    "orders": logging.INFO,
+    "gains": logging.INFO,
 }
-
-random.seed()
-
+log_filename = os.path.join(home_folder, 'ccxt_arbitration_new.log')
+# Also log to the console (besides log_filename)?
+log_to_console = True
+log_listener = None
+log = trading_log.get_logger()
+order_log = trading_log.get_logger("orders")
+gain_log = trading_log.get_logger("gains")
+
+# Calls to an exchange are limited by a rate limiter shared by all callers that models the limits of
+# the exchange (see rate_limiter.py), failed calls are retried with exponential backoff.
+# Without these limiters every request waits api_rate_limit seconds between its trials and the loop
+# sleeps trial_sleep_time seconds between iterations.
+use_rate_limiters = True
 api_rate_limit = 1.0
+# Kraken private API call counter of the account tier (starter: max 15, decays by 0.33 per second)
+kraken_max_api_counter = 15
+kraken_api_counter_decay = 0.33
+# Iterations between refreshes of the Kraken server time and the stats logging
 balance_update_interval = 10
+# Balances are kept in a local ledger that is updated from fills. The ledger is reconciled with the
+# exchanges in the background every balance_reconcile_interval seconds (and after every arbitrage).
+balance_reconcile_interval = 60.0
+# Maximum difference between ledger and exchange balance per currency before the deviation alarm
+max_ledger_deviation_fiat = 1.0
+max_ledger_deviation_crypto = 1e-3
+stop_on_balance_deviation = True
 
 crypto = "ETH"
 fiat = "EUR"
@@ -38,6 +76,30 @@ num_iterations = sys.maxsize
 max_num_arbitrations = sys.maxsize
 # max_num_arbitrations = 1
 
+# Exchanges to trade on (ccxt exchange ids)
+exchange_names = ["kraken", "gdax"]
+exchange_key_files = {
+    "kraken": "kraken_private.key",
+    "gdax": "gdax_private.key",
+}
+exchange_key_readers = {
+    "kraken": kraken_wrapper.read_keys_from_file,
+    "gdax": gdax_wrapper.read_keys_from_file,
+}
+# Order parameter that holds our own reference to an order
+client_order_id_params = {
+    "kraken": "userref",
+    "gdax": "client_oid",
+}
+# Order legs are submitted in this order of exchanges (exchanges that are not listed go last)
+order_submission_priority = ["kraken", "gdax"]
+# Submit all legs at the same time instead of one after the other in order_submission_priority?
+concurrent_leg_submission = True
+# How to resolve an arbitrage where only some legs went through (see leg_execution.py). The actions are
+# tried in this order. Retries end max_time_from_order_book_to_order seconds after the order book request.
+leg_failure_actions = ["retry", "cancel", "hedge"]
+leg_retry_interval = 0.5
+
 # Volume and performance bounds
 min_volume_crypto = 0.0
 max_volume_crypto = 0.5
@@ -46,28 +108,53 @@ max_volume_crypto = 0.5
 # high_gain_reserve = 0.25
 # min_relative_gain = min_gain_percentage / 100.0
 # high_relative_gain = high_gain_percentage / 100.0
+# Threshold ladders keyed by (buy exchange, sell exchange)
 min_gains_percentage = {
-    BUY_KRAKEN_SELL_GDAX: [2.0, 1.5, 1.0, 0.75],
-    # BUY_GDAX_SELL_KRAKEN: [0.0, -0.5, -1.0],
-    # BUY_GDAX_SELL_KRAKEN: [0.4, 0.2, 0.0, -0.2],
-    BUY_GDAX_SELL_KRAKEN: [0.2, -0.2, -0.2, -0.2],
+    ("kraken", "gdax"): [2.0, 1.5, 1.0, 0.75],
+    # ("gdax", "kraken"): [0.0, -0.5, -1.0],
+    # ("gdax", "kraken"): [0.4, 0.2, 0.0, -0.2],
+    ("gdax", "kraken"): [0.2, -0.2, -0.2, -0.2],
 }
 min_fiat_reserves = {
-    BUY_KRAKEN_SELL_GDAX: [0.0, 0.4, 0.6, 0.75],
-    BUY_GDAX_SELL_KRAKEN: [0.0, 0.25, 0.4, 0.6],
+    ("kraken", "gdax"): [0.0, 0.4, 0.6, 0.75],
+    ("gdax", "kraken"): [0.0, 0.25, 0.4, 0.6],
 }
 # min_fiat_reserves = {
-#     BUY_KRAKEN_SELL_GDAX: [0.0, 2500, 5000, 7500],
-#     BUY_GDAX_SELL_KRAKEN: [0.0, 2500, 5000, 7500],
+#     ("kraken", "gdax"): [0.0, 2500, 5000, 7500],
+#     ("gdax", "kraken"): [0.0, 2500, 5000, 7500],
 # }
+# Threshold ladder for exchange pairs that are not listed above
+default_min_gains_percentage = [2.0, 1.5, 1.0, 0.75]
+default_min_fiat_reserves = [0.0, 0.4, 0.6, 0.75]
 min_relative_gains = {}
 for key, gains in min_gains_percentage.items():
     min_relative_gains[key] = [gain / 100.0 for gain in gains]
-
+default_min_relative_gains = [gain / 100.0 for gain in default_min_gains_percentage]
+
+# HTTP settings: all clients of a venue (ccxt, krakenex, gdax) share one keep-alive connection pool.
+# Timeouts (connect, read) in seconds are chosen by the first matching URL path substring of the venue.
+http_pool_size = 8
+http_default_timeout = (3.05, 10.0)
+http_endpoint_timeouts = {
+    "kraken": [("/AddOrder", (1.5, 5.0)), ("/CancelOrder", (1.5, 5.0)), ("/Depth", (1.5, 3.0)),
+               ("/Time", (1.5, 3.0)), ("/QueryOrders", (1.5, 5.0)), ("/OpenOrders", (1.5, 5.0)),
+               ("/ClosedOrders", (3.05, 10.0))],
+    "gdax": [("/book", (1.5, 3.0)), ("/orders", (1.5, 5.0))],
+}
+# Markets (precision, limits and fees) are cached on disk for market_cache_ttl seconds (None to always
+# load them from the exchange), so a restart does not have to wait for the exchanges
+market_cache_folder = os.path.join(home_folder, ".ccxt_arbitration_cache")
+market_cache_ttl = 24 * 3600
+# Latency histograms and counters of the trading loop in the Prometheus text format: served on
+# http://metrics_host:metrics_port/metrics (metrics_port None to disable) and/or written to metrics_textfile
+# with the periodic stats (e.g. for the textfile collector of the node exporter)
+metrics_host = "127.0.0.1"
+metrics_port = 9108
+metrics_textfile = None
+# Base URLs of local mock exchange servers (mock_exchange.py) per exchange name to run the loop against a
+# matching engine instead of the venue, e.g. {"kraken": "http://127.0.0.1:9200"}
+mock_exchange_urls = {}
 # Kraken request settings
-kraken_timeout = 10.0
-kraken_order_book_timeout = 15.0
-kraken_add_order_timeout = 10.0
 kraken_ohlc_interval = 5  # Interval in minutes
 kraken_order_book_count = 100  # Maximum number of active orders to return
 # Price rounding (also used for Gdax)
@@ -78,12 +165,73 @@ crypto_ndigits = 4
 simulate = False
 # simulate = True
 prompt_user = False
+# Paper trading (simulate): orders are filled against the live (or replayed) order books after a latency of
+# paper_latency seconds plus an exponential jitter with mean paper_latency_jitter, and booked in a ledger that
+# starts from paper_balances ({exchange name: {currency: amount}}, None for the current exchange balances).
+# While orders are open the books are fetched every paper_book_interval seconds (cheap with order book streams).
+paper_balances = None
+paper_latency = 0.1
+paper_latency_jitter = 0.05
+paper_book_interval = 1.0
 # prompt_user = True
 
 # Sleep times
 trial_sleep_time = 1
+# Orders are polled every order_check_min_interval seconds right after submission and then less often
+# (order_check_age_factor times the age of the order) up to every order_check_interval seconds
 order_check_interval = 2
+order_check_min_interval = 0.2
+order_check_age_factor = 0.25
+# After a failed submission the order is looked up for up to check_order_time seconds, but not past the
+# deadline of the order (so the leg can still be retried), and for at least min_check_order_time seconds
 check_order_time = 15
+min_check_order_time = 1.0
+
+# Fetch the order books of all exchanges in parallel?
+concurrent_order_book_fetch = True
+# Maximum time skew (in seconds) between the order book snapshots that are compared
+max_order_book_skew = 2.0
+
+# Read order books from websocket streams instead of fetching them over REST?
+use_order_book_streams = False
+order_book_stream_depth = 100
+# Replay server (host, port) per exchange to stream from instead of the exchange (see order_book_replay.py)
+order_book_replay_servers = {}
+# order_book_replay_servers = {"kraken": ("127.0.0.1", 9100), "gdax": ("127.0.0.1", 9101)}
+
+# Multi-process mode (see multi_process.py, which sets these in each worker process): order books are read from
+# shared memory blocks ({exchange name: block name}) and ignored when older than shared_order_book_max_age seconds,
+# arbitrages need the approval of the risk coordinator (risk_client) and the rate limits of the exchanges are
+# shared with the other processes ({limit name: share of this process}, e.g. {"private": 0.25})
+shared_order_book_names = None
+shared_order_book_depth = 100
+shared_order_book_max_age = 5.0
+risk_client = None
+rate_limit_shares = None
+
+# Record all order books (top levels) to disk for research and backtests?
+record_order_books = False
+order_book_record_folder = os.path.join(home_folder, "order_book_records")
+order_book_record_levels = 20
+
+# Scan for multi-hop arbitrage cycles over the markets of all exchanges?
+scan_currency_graph = False
+# Only use markets between these currencies for the scan (None for all markets)
+currency_graph_currencies = ["ETH", "BTC", "EUR"]
+currency_graph_max_cycle_length = 4
+currency_graph_transfer_fee = 0.0
+# Refresh the prices of all markets in the graph every this many iterations
+currency_graph_ticker_interval = 10
+
+# Gains log (one record per iteration, written on a background thread)
+gains_log_filename = os.path.join(home_folder, "ccxt_arbitration_gains.log")
+# Write binary records (see gains_log.read_binary_records) instead of text lines?
+gains_log_binary = False
+gains_log_queue_size = 10000
+gains_log_flush_interval = 1.0
+# Rotate the gains log when it gets larger than this many bytes (None for never) and/or every day
+gains_log_max_bytes = 100 * 1024 * 1024
+gains_log_rotate_daily = False
 
 # Use USD on Kraken?
 use_kraken_usd = False
@@ -102,6 +250,15 @@ min_volume_factor = 10.0
 max_time_from_order_book_to_order = 15  # Maximum time allowed between order book results and ordering
 max_balance_deviation_crypto = 1e-2
 safety_lower_gain_tolerance = 0.8
+# Compute expected gains with the average fill price of the order volume instead of
+# the conservative price of the level that reaches min_volume_factor * order volume?
+use_vwap_prices = False
+# Choose the order volume (up to max_volume_crypto) that maximizes the expected gain given both order books?
+optimize_order_volume = True
+# Decide with one vectorized pass over all modes, threshold tiers and decision_volume_grid_size volumes
+# up to max_volume_crypto (see arbitrage_engine.DecisionKernel) instead of solving the volume of each mode?
+use_decision_kernel = False
+decision_volume_grid_size = 20
 max_overall_fiat_loss = 25.0
 
 
@@ -111,11 +268,44 @@ max_overall_fiat_loss = 25.0
 # min_gain_percentage = 2.0
 # min_relative_gain = min_gain_percentage / 100.0
 
+# Orders are looked up by client order id: Kraken filters by userref, for other exchanges the
+# ccxt method of a native lookup by client id is used if listed here (else open and closed orders are scanned)
+native_order_lookup_methods = {
+    "gdax": "privateGetOrdersClientClientOid",
+}
+
 # TODO
-kraken_client = kraken_wrapper.create_client_from_file("kraken_private.key")
 kraken_pair = "XETHZEUR"
 kraken_fiat_currency = "EUR"
 
+# Set up by init() (and get_exchanges()) so that the module can be imported without side effects
+http_sessions = None
+kraken_client = None
+exchanges = None
+exchange_titles = None
+fees = None
+num_exchanges = None
+arbitration_pairs = None
+arbitrage_parameters = None
+tier_min_relative_gains = None
+tier_min_fiat_reserves = None
+order_book_streams = None
+order_book_update_event = None
+shared_order_books = None
+client_order_registry = None
+balance_deviation_alarm = False
+ledger = None
+order_fill_watcher = None
+leg_executor = None
+paper_engine = None
+paper_exchanges = None
+metrics_server = None
+gains_log_writer = None
+recorder = None
+graph = None
+graph_symbols = None
+_initialized = False
+
 
 def ccxt_retry(*args, **kwargs):
     if "_rate_limit" not in kwargs:
@@ -123,21 +313,221 @@ def ccxt_retry(*args, **kwargs):
     return ccxt_utils.retry(*args, **kwargs)
 
 
-gdax_api_key, gdax_api_secret, gdax_password = gdax_wrapper.read_keys_from_file("gdax_private.key")
-gdax = ccxt.gdax()
-gdax.apiKey = gdax_api_key
-gdax.secret = gdax_api_secret
-gdax.password = gdax_password
-ccxt_retry(gdax.loadMarkets, reload=True)
-gdax_fee = max(gdax.market(symbol)["maker"], gdax.market(symbol)["taker"])
+def setup_rate_limiters():
+    if use_rate_limiters:
+        if rate_limiter.get_rate_limiter("kraken", create=False) is None:
+            rate_limiter.set_rate_limiter(
+                "kraken", rate_limiter.create_kraken_rate_limiter(kraken_max_api_counter, kraken_api_counter_decay))
+    else:
+        for name in exchange_names:
+            rate_limiter.set_rate_limiter(name, None)
+    if use_rate_limiters and rate_limit_shares is not None:
+        for name in exchange_names:
+            limiter = rate_limiter.get_rate_limiter(name)
+            if limiter is not None:
+                limiter.scale(rate_limit_shares)
+
+
+def get_http_sessions():
+    global http_sessions
+    if http_sessions is None:
+        http_sessions = collections.OrderedDict()
+        for name in exchange_names:
+            http_sessions[name] = http_transport.get_session(
+                name, http_endpoint_timeouts.get(name), http_default_timeout, http_pool_size)
+    return http_sessions
+
+
+def create_exchange(name):
+    api_key, api_secret, password = exchange_key_readers[name](exchange_key_files[name])
+    exchange = getattr(ccxt, name)({"session": get_http_sessions()[name]})
+    exchange.apiKey = api_key
+    exchange.secret = api_secret
+    exchange.password = password
+    if name in mock_exchange_urls:
+        # Only needed to run against mock exchange servers
+        import mock_exchange
+        mock_exchange.use_mock_url(exchange, mock_exchange_urls[name])
+    if market_cache_ttl is not None:
+        from_cache = market_cache.load_markets(exchange, market_cache_folder, market_cache_ttl, ccxt_retry)
+        log.info("Loaded {} markets from {}", name, "cache" if from_cache else "exchange")
+    else:
+        ccxt_retry(exchange.loadMarkets, reload=True)
+    return exchange
+
+
+def get_exchanges():
+    # ccxt exchanges of exchange_names with their markets (created on first use)
+    global exchanges, exchange_titles, fees, num_exchanges
+    if exchanges is None:
+        setup_rate_limiters()
+        # Markets are loaded concurrently (a cache miss costs one request per exchange)
+        executor = ccxt_utils.get_order_book_executor()
+        futures = [(name, executor.submit(create_exchange, name)) for name in exchange_names]
+        created_exchanges = collections.OrderedDict((name, future.result()) for name, future in futures)
+        exchange_titles = [name.capitalize() for name in exchange_names]
+        fees = np.array([max(exchange.market(symbol)["maker"], exchange.market(symbol)["taker"])
+                         for exchange in created_exchanges.values()])
+        num_exchanges = len(exchange_names)
+        exchanges = created_exchanges
+    return exchanges
+
+
+def create_balance_ledger(currencies, tolerances=None, on_deviation=None):
+    # Balance ledger of exchange_names (only simulated fills change it when paper trading, so it isn't
+    # reconciled then)
+    if simulate and paper_balances is not None:
+        import paper_trading
+        return paper_trading.create_paper_ledger(paper_balances, currencies)
+    get_exchanges()
+    ledger = balance_ledger.BalanceLedger(
+        {name: (lambda name=name: fetch_balance(name)) for name in exchange_names}, currencies, tolerances,
+        reconcile_interval=balance_reconcile_interval, on_deviation=on_deviation)
+    ledger.reconcile(executor=ccxt_utils.get_order_book_executor())
+    if not simulate:
+        ledger.start()
+    return ledger
+
+
+def init():
+    # Set up logging, clients, order book streams, the order registry and the balance ledger.
+    # Only the first call does anything.
+    global _initialized, log_listener, kraken_client, arbitration_pairs, arbitrage_parameters
+    global tier_min_relative_gains, tier_min_fiat_reserves, order_book_streams, order_book_update_event
+    global client_order_registry, ledger, order_fill_watcher, leg_executor, gains_log_writer, recorder, graph
+    global graph_symbols, metrics_server, paper_engine, paper_exchanges, shared_order_books
+    if _initialized:
+        return
+    _initialized = True
+    log_listener = trading_log.setup_logging(
+        log_filename, level=logging.DEBUG, console=log_to_console,
+        use_queue=use_queue_logging, structured=structured_logging, subsystem_levels=log_levels)
+    random.seed()
+
+    kraken_client = kraken_wrapper.create_client_from_file(
+        exchange_key_files["kraken"], session=get_http_sessions()["kraken"])
+    if "kraken" in mock_exchange_urls:
+        import mock_exchange
+        mock_exchange.use_mock_url(kraken_client, mock_exchange_urls["kraken"])
+    get_exchanges()
+    arbitration_pairs = arbitrage_engine.get_arbitration_pairs(num_exchanges)
+    arbitrage_parameters = arbitrage_engine.ArbitrageParameters(
+        min_relative_gains, min_fiat_reserves, default_min_relative_gains, default_min_fiat_reserves,
+        min_volume_crypto=min_volume_crypto, max_volume_crypto=max_volume_crypto, min_volume_factor=min_volume_factor,
+        buy_safety_factor_fiat=buy_safety_factor_fiat, limit_price_safety_factor=limit_price_safety_factor,
+        use_vwap_prices=use_vwap_prices, optimize_order_volume=optimize_order_volume,
+        use_decision_kernel=use_decision_kernel, volume_grid_size=decision_volume_grid_size,
+        fiat_ndigits=fiat_ndigits, crypto_ndigits=crypto_ndigits)
+    tier_min_relative_gains, tier_min_fiat_reserves = arbitrage_parameters.get_tiers(exchange_names)
+
+    if use_order_book_streams:
+        order_book_streams = collections.OrderedDict()
+        order_book_update_event = threading.Event()
+        for name, exchange in exchanges.items():
+            def fetch_order_book(exchange=exchange):
+                return ccxt_retry(exchange.fetchL2OrderBook, symbol)
+            # Local books store prices and volumes as integers in units of the market precision
+            precision = exchange.market(symbol)["precision"]
+            tick_size = 10.0 ** -precision["price"]
+            lot_size = 10.0 ** -precision["amount"]
+            if name in order_book_replay_servers:
+                host, port = order_book_replay_servers[name]
+                order_book_streams[name] = order_book_stream.create_replay_stream(
+                    name, host, port, snapshot_fn=fetch_order_book, depth=order_book_stream_depth,
+                    update_event=order_book_update_event, tick_size=tick_size, lot_size=lot_size)
+            else:
+                order_book_streams[name] = order_book_stream.create_exchange_stream(
+                    name, symbol, snapshot_fn=fetch_order_book, depth=order_book_stream_depth,
+                    update_event=order_book_update_event, tick_size=tick_size, lot_size=lot_size)
+            order_book_streams[name].start()
+
+    if shared_order_book_names is not None:
+        # Only needed when the books are read from the shared memory of a multi process run
+        import shared_order_book
+        shared_order_books = collections.OrderedDict(
+            (name, shared_order_book.SharedOrderBook(shared_order_book_names[name], shared_order_book_depth))
+            for name in exchange_names)
+
+    client_order_registry = order_registry.OrderRegistry()
+    for name, exchange in exchanges.items():
+        if name == "kraken":
+            order_source = order_registry.KrakenOrderSource(kraken_client)
+        else:
+            order_source = order_registry.CcxtOrderSource(
+                exchange, symbol, client_order_id_params[name], native_order_lookup_methods.get(name), ccxt_retry)
+        client_order_registry.add_venue(name, order_source)
+
+    # In multi-process mode the risk coordinator keeps the ledger of all workers
+    if risk_client is None:
+        ledger = create_balance_ledger(
+            [fiat, crypto], {fiat: max_ledger_deviation_fiat, crypto: max_ledger_deviation_crypto},
+            on_balance_deviation)
+
+    # Private order streams can push order updates with order_fill_watcher.push((exchange name, order id), order_info)
+    order_fill_watcher = fill_watcher.FillWatcher(
+        min_interval=order_check_min_interval, max_interval=order_check_interval, age_factor=order_check_age_factor)
+    leg_executor = leg_execution.LegExecution(
+        submit_leg, cancel_leg, hedge_leg, query_fn=query_leg, failure_actions=leg_failure_actions,
+        retry_interval=leg_retry_interval)
 
-kraken_api_key, kraken_api_secret, kraken_password = kraken_wrapper.read_keys_from_file("kraken_private.key")
-kraken = ccxt.kraken()
-kraken.apiKey = kraken_api_key
-kraken.secret = kraken_api_secret
-kraken.password = kraken_password
-ccxt_retry(kraken.loadMarkets, reload=True)
-kraken_fee = max(kraken.market(symbol)["maker"], kraken.market(symbol)["taker"])
+    if simulate:
+        # Only needed for paper trading
+        import paper_trading
+        book_fns = {}
+        for name, exchange in exchanges.items():
+            if use_order_book_streams:
+                def get_order_book(stream=order_book_streams[name]):
+                    snapshot = stream.get_snapshot(symbol)
+                    return snapshot["order_book"] if snapshot is not None else None
+            else:
+                def get_order_book(exchange=exchange):
+                    return ccxt_retry(exchange.fetchL2OrderBook, symbol, _max_trials=1)
+            book_fns[name] = get_order_book
+        fee_rates = {name: (exchange.market(symbol)["maker"], exchange.market(symbol)["taker"])
+                     for name, exchange in exchanges.items()}
+        # Simulated order updates are pushed to the fill watcher right away
+        paper_engine = paper_trading.PaperTradingEngine(
+            crypto, fiat, fee_rates, paper_trading.LatencyModel(paper_latency, paper_latency_jitter),
+            book_fns=book_fns, book_interval=paper_book_interval,
+            on_order_update=lambda name, order_info: order_fill_watcher.push((name, order_info["id"]), order_info))
+        paper_engine.start()
+        paper_exchanges = {name: paper_trading.PaperExchange(paper_engine, name) for name in exchange_names}
+
+    gains_log_writer = gains_log.GainsLogWriter(
+        gains_log_filename, binary=gains_log_binary, max_queue_size=gains_log_queue_size,
+        flush_interval=gains_log_flush_interval, max_bytes=gains_log_max_bytes, rotate_daily=gains_log_rotate_daily)
+    # The writer thread is a daemon: write the queued records on every exit (also sys.exit after a loss)
+    atexit.register(gains_log_writer.close)
+
+    if record_order_books:
+        recorder = order_book_recorder.OrderBookRecorder(order_book_record_folder, order_book_record_levels)
+
+    if scan_currency_graph:
+        graph = currency_graph.CurrencyGraph(max_cycle_length=currency_graph_max_cycle_length)
+        for name, exchange in exchanges.items():
+            graph.add_exchange_markets(name, exchange.markets, currency_graph_currencies)
+        graph.add_all_transfers(currency_graph_transfer_fee)
+        graph_symbols = {}
+        for name, graph_symbol in graph.market_edges.keys():
+            graph_symbols.setdefault(name, []).append(graph_symbol)
+        log.info("Currency graph: {:d} nodes, {:d} edges", graph.num_nodes, graph.num_edges)
+
+    metrics.REGISTRY.add_collector(collect_metrics)
+    if metrics_port is not None:
+        metrics_server = metrics.MetricsServer(metrics.REGISTRY, metrics_host, metrics_port).start()
+        log.info("Serving metrics on http://{}:{:d}/metrics", metrics_host, metrics_server.port)
+
+def wait_for_next_iteration():
+    # With order book streams we can start the next iteration as soon as any book changed
+    if use_order_book_streams:
+        order_book_update_event.wait(trial_sleep_time)
+        order_book_update_event.clear()
+    elif shared_order_books is not None:
+        # The same for the books that other processes publish into shared memory
+        import shared_order_book
+        shared_order_book.wait_for_publish(shared_order_books.values(), trial_sleep_time)
+    elif not use_rate_limiters:
+        time.sleep(trial_sleep_time)
 
 
 def prompt_yes_no(message):
@@ -146,592 +536,747 @@ def prompt_yes_no(message):
         return True
     return False
 
-if len(sys.argv) > 1:
-    input_order_volume_crypto = float(sys.argv[1])
-else:
-    input_order_volume_crypto = None
-
 
-total_balance_fiat_begin = None
+def create_client_order_id(name):
+    if client_order_id_params[name] == "userref":
+        return int(random.randint(0, 2**31 - 1))
+    return str(uuid.uuid4())
 
-num_arbitrations = 0
-balances_update_countdown = 0
-for iteration in range(num_iterations):
 
+def get_trading_exchange(name):
+    # Exchange to send orders to (the paper trading engine when simulating)
     if simulate:
-        logging.info("---------- SIMULATION ----------")
-    else:
-        logging.info("---------- ARBITRATION ----------")
-    logging.info("Time: {}".format(datetime.datetime.now()))
-
-    if balances_update_countdown <= 0:
-        logging.info("Retrieving account balances")
-        balances_update_countdown = balance_update_interval
-
-        # Get Kraken account balance
-        kraken_balance = ccxt_retry(kraken.fetchBalance)
-        kraken_balance_fiat = kraken_balance[fiat]["free"]
-        kraken_balance_crypto = kraken_balance[crypto]["free"]
-        gdax_balance = ccxt_retry(gdax.fetchBalance)
-        gdax_balance_fiat = gdax_balance[fiat]["free"]
-        gdax_balance_crypto = gdax_balance[crypto]["free"]
-
-        # Get server time to check for recent orders later on
-        kraken_server_time = None
-        try:
-            kraken_server_time = kraken_client.query_public("Time")
-            if len(kraken_server_time["error"]) > 0:
-                raise Exception("{}".format(kraken_server_time["error"]))
-        except Exception as e:
-            logging.info("Unable to get server time ({}).".format(e))
-            logging.info("Waiting ...")
-            logging.info("")
-            time.sleep(trial_sleep_time)
-            continue
-        kraken_server_time = kraken_server_time["result"]["unixtime"]
-        logging.info("Kraken server time: {:d}".format(kraken_server_time))
-    else:
-        balances_update_countdown -= 1
-
-    logging.info("Kraken account balance:")
-    logging.info("  {:.2f} {}".format(kraken_balance_fiat, fiat))
-    logging.info("  {:.4f} {}".format(kraken_balance_crypto, crypto))
-    logging.info("Current Kraken fee: {:.2f} %".format(100 * kraken_fee))
-    logging.info("Gdax account balance")
-    logging.info("  {:.2f} {}".format(gdax_balance_fiat, fiat))
-    logging.info("  {:.4f} {}".format(gdax_balance_crypto, crypto))
-
-    total_balance_fiat = kraken_balance_fiat + gdax_balance_fiat
-    total_balance_crypto = kraken_balance_crypto + gdax_balance_crypto
-    logging.info("Total balance fiat: {:.2f} {}".format(total_balance_fiat, fiat))
-    logging.info("Total balance crypto: {:.4f} {}".format(total_balance_crypto, crypto))
-
-    if total_balance_fiat_begin is None:
-        total_balance_fiat_begin = total_balance_fiat
-
-    # Compute sell and buy volumes of crypto currency
-    order_volume_crypto = input_order_volume_crypto
-    if order_volume_crypto is None:
-        order_volume_crypto = max_volume_crypto
-    order_volume_crypto = round(order_volume_crypto, crypto_ndigits)
-
-    # Get "safe" price on Kraken for buying and selling ETH
-    min_volume = min_volume_factor * order_volume_crypto
-    kraken_ob = ccxt_retry(kraken.fetchL2OrderBook, symbol)
-    gdax_ob = ccxt_retry(gdax.fetchL2OrderBook, symbol)
-    kraken_ask_price, kraken_ask_volume, kraken_bid_price, kraken_bid_volume \
-        = ccxt_utils.get_conservative_ask_bid_price(kraken_ob, min_volume)
-    gdax_ask_price, gdax_ask_volume, gdax_bid_price, gdax_bid_volume \
-        = ccxt_utils.get_conservative_ask_bid_price(gdax_ob, min_volume)
-
-    if kraken_ask_volume < min_volume or kraken_bid_volume < min_volume:
-        logging.info("Not enough trading volume on Kraken.")
-        logging.info("Kraken ask volume: {}, Kraken bid volume: {}".format(kraken_ask_volume, kraken_bid_volume))
-        logging.info("Waiting ...")
-        logging.info("")
-        time.sleep(trial_sleep_time)
-        continue
-    if gdax_ask_volume < min_volume or gdax_bid_volume < min_volume:
-        logging.info("Not enough trading volume on Gdax.")
-        logging.info("Gdax ask volume: {}, Gdax bid volume: {}".format(gdax_ask_volume, gdax_bid_volume))
-        logging.info("Waiting ...")
-        logging.info("")
-        time.sleep(trial_sleep_time)
-        continue
-
-    kraken_ask_price = round(kraken_ask_price, fiat_ndigits)
-    kraken_bid_price = round(kraken_bid_price, fiat_ndigits)
-    assert kraken_ask_price >= kraken_bid_price
-    gdax_ask_price = round(gdax_ask_price, fiat_ndigits)
-    gdax_bid_price = round(gdax_bid_price, fiat_ndigits)
-    assert gdax_ask_price >= gdax_bid_price
-
-    # Remember time so we can cancel if adding Kraken order takes too long.
-    order_book_request_time = time.time()
-
-    def compute_arbitrage_gain(ask_price, ask_volume, buy_fee,
-            bid_price, bid_volume, sell_fee, order_volume_crypto):
-        assert ask_volume >= order_volume_crypto
-        assert bid_volume >= order_volume_crypto
-        logging.info("Expected buy price: {:.2f} {}".format(ask_price, fiat))
-        ask_price_with_fee = ask_price * (1 + buy_fee)
-        logging.info("Expected buy price (plus fees): {:.2f} {}".format(ask_price_with_fee, fiat))
-        logging.info("Volume for buy price {:.2f} {}: {:.2f}".format(ask_price, fiat, ask_volume))
-        buy_volume_fiat = ask_price_with_fee * order_volume_crypto
-
-        logging.info("Expected sell price: {:.2f} {}".format(bid_price, fiat))
-        bid_price_with_fee = bid_price * (1 - sell_fee)
-        logging.info("Expected sell price (minus fees): {:.2f} {}".format(bid_price_with_fee, fiat))
-        logging.info("Volume for sell price {:.2f} {}: {:.2f}".format(bid_price, fiat, bid_volume))
-        sell_volume_fiat = bid_price_with_fee * order_volume_crypto
-
-        logging.info("Buy crypto volume (limit price {:.2f} {}: {:.4f} {}".format(
-            ask_price, fiat,
-            order_volume_crypto, crypto))
-        logging.info("Sell crypto volume (limit price {:.2f} {}: {:.4f} {}".format(
-            bid_price, fiat,
-            order_volume_crypto, crypto))
-        logging.info("Expected buy fiat volume (plus fees): {:.2f} {}".format(buy_volume_fiat, fiat))
-        logging.info("Expected sell fiat volume (minus fees): {:.2f} {}".format(sell_volume_fiat, fiat))
-
-        gain_fiat = sell_volume_fiat - buy_volume_fiat
-        relative_gain = gain_fiat / buy_volume_fiat
-        logging.info("Expected gain: {:.2f} {} ({:.4f} %)".format(
-            gain_fiat, fiat, 100 * relative_gain))
-
-        return gain_fiat, relative_gain, buy_volume_fiat
-
-    exp_gains_fiat = {}
-    exp_relative_gains = {}
-    buy_volumes_fiat = {}
-    logging.info("----- Buy on Kraken, sell on Gdax -----")
-    exp_gains_fiat[BUY_KRAKEN_SELL_GDAX], exp_relative_gains[BUY_KRAKEN_SELL_GDAX], buy_volumes_fiat[BUY_KRAKEN_SELL_GDAX] \
-        = compute_arbitrage_gain(
-            kraken_ask_price, kraken_ask_volume, kraken_fee,
-            gdax_bid_price, gdax_bid_volume, gdax_fee,
-            order_volume_crypto)
-    logging.info("----- Buy on Gdax, sell on Kraken -----")
-    exp_gains_fiat[BUY_GDAX_SELL_KRAKEN], exp_relative_gains[BUY_GDAX_SELL_KRAKEN], buy_volumes_fiat[BUY_GDAX_SELL_KRAKEN] \
-        = compute_arbitrage_gain(
-            gdax_ask_price, gdax_ask_volume, gdax_fee,
-            kraken_bid_price, kraken_bid_volume, kraken_fee,
-            order_volume_crypto)
-
-    try:
-        with open(os.path.join(home_folder, 'ccxt_arbitration_gains.log'), 'a') as fout:
-            iso_time = datetime.datetime.now().isoformat()
-            fout.write("{:s} {:f} {:f} {:f} {:f} {:f} {:f} {:f} {:f} {:f} {:f} {:f} {:f}\n".format(
-                iso_time, exp_gains_fiat[BUY_KRAKEN_SELL_GDAX], exp_gains_fiat[BUY_GDAX_SELL_KRAKEN],
-                exp_relative_gains[BUY_KRAKEN_SELL_GDAX], exp_relative_gains[BUY_GDAX_SELL_KRAKEN],
-                kraken_ask_price, kraken_ask_volume, kraken_bid_price, kraken_bid_volume,
-                gdax_ask_price, gdax_ask_volume, gdax_bid_price, gdax_bid_volume))
-    except:
-        pass
-
-    valid = {}
-    valid[BUY_GDAX_SELL_KRAKEN] = False
-    valid[BUY_KRAKEN_SELL_GDAX] = False
-    chosen_min_relative_gains = {}
-
-    for min_relative_gain, min_fiat_reserve in zip(min_relative_gains[BUY_GDAX_SELL_KRAKEN], min_fiat_reserves[BUY_GDAX_SELL_KRAKEN]):
-        if exp_relative_gains[BUY_GDAX_SELL_KRAKEN] >= min_relative_gain \
-        and gdax_balance_fiat / total_balance_fiat >= min_fiat_reserve \
-        and gdax_balance_fiat >= buy_safety_factor_fiat * order_volume_crypto * buy_volumes_fiat[BUY_GDAX_SELL_KRAKEN] \
-        and kraken_balance_crypto >= order_volume_crypto:
-            logging.info("{} is possible with min_relative_gain={} %, min_fiat_reserve={}".
-                format(ARBITRATION_MODES_STR[BUY_GDAX_SELL_KRAKEN], 100 * min_relative_gain, min_fiat_reserve))
-            valid[BUY_GDAX_SELL_KRAKEN] = True
-            chosen_min_relative_gains[BUY_GDAX_SELL_KRAKEN] = min_relative_gain
-            break
+        return paper_exchanges[name]
+    return exchanges[name]
 
-    for min_relative_gain, min_fiat_reserve in zip(min_relative_gains[BUY_KRAKEN_SELL_GDAX], min_fiat_reserves[BUY_KRAKEN_SELL_GDAX]):
-        if exp_relative_gains[BUY_KRAKEN_SELL_GDAX] >= min_relative_gain \
-        and kraken_balance_fiat / total_balance_fiat >= min_fiat_reserve \
-        and kraken_balance_fiat >= buy_safety_factor_fiat * order_volume_crypto * buy_volumes_fiat[BUY_KRAKEN_SELL_GDAX] \
-        and gdax_balance_crypto >= order_volume_crypto:
-            logging.info("{} is possible with min_relative_gain={} %, min_fiat_reserve={}".
-                format(ARBITRATION_MODES_STR[BUY_KRAKEN_SELL_GDAX], 100 * min_relative_gain, min_fiat_reserve))
-            valid[BUY_KRAKEN_SELL_GDAX] = True
-            chosen_min_relative_gains[BUY_KRAKEN_SELL_GDAX] = min_relative_gain
-            break
 
-    valid_values = [value for key, value in valid.items()]
-    if not np.any(valid_values):
-        logging.info("No arbitration opportunity. Cancelling.")
-        logging.info("Waiting ...")
-        logging.info("")
-        time.sleep(trial_sleep_time)
-        continue
+def check_order_info(name, check_order_time, client_order_id):
+    return client_order_registry.find_order_id(name, client_order_id, check_order_time, order_check_interval)
 
-    for arbitration_mode in ARBITRATION_MODES:
-        if not valid[arbitration_mode]:
-            exp_relative_gains[arbitration_mode] = -float("inf")
 
-    if exp_relative_gains[BUY_GDAX_SELL_KRAKEN] > exp_relative_gains[BUY_KRAKEN_SELL_GDAX]:
-        arbitration_mode = BUY_GDAX_SELL_KRAKEN
+def get_order_fee(order_info):
+    if order_info["fee"] is not None:
+        return order_info["fee"]["cost"], order_info["fee"]["currency"]
+    if "fill_fees" in order_info["info"]:
+        return float(order_info["info"]["fill_fees"]), fiat
+    return None, None
+
+
+def is_order_done(order_info):
+    # logging.info("Order status: {}".format(order_info["status"]))
+    if order_info["status"] == "closed":
+        return True
+    elif order_info["status"] == "canceled":
+        order_log.error("Order was cancelled.")
+        order_log.error("Exiting")
+        sys.exit(1)
+    elif order_info["status"] == "expired":
+        order_log.error("Order expired.")
+        order_log.error("Exiting")
+        sys.exit(1)
+    return False
+
+
+def get_balances():
+    # Available balances from the ledger (totals minus amounts reserved for open orders), in multi-process mode
+    # from the ledger of the risk coordinator (None if it didn't answer in time)
+    if risk_client is not None:
+        return risk_client.get_balances(exchange_names, (fiat, crypto))
+    return ledger.get_available_arrays(exchange_names, (fiat, crypto))
+
+
+def on_balance_deviation(name, currency, ledger_total, exchange_total):
+    global balance_deviation_alarm
+    balance_deviation_alarm = True
+
+
+def fetch_balance(name):
+    with metrics.REGISTRY.timer("stage_latency_seconds", stage="balance_fetch", venue=name):
+        return ccxt_retry(exchanges[name].fetchBalance)
+
+
+def fetch_exchange_balances(indices):
+    # Balances of some exchanges straight from the exchanges (not the ledger), fetched concurrently
+    executor = ccxt_utils.get_order_book_executor()
+    futures = [(index, executor.submit(fetch_balance, exchange_names[index])) for index in indices]
+    return [(index, future.result()) for index, future in futures]
+
+
+def collect_metrics():
+    # Values that are counted by the components themselves
+    samples = []
+    for name in exchange_names:
+        limiter = rate_limiter.get_rate_limiter(name, create=False)
+        if limiter is not None:
+            samples += [
+                ("rate_limiter_waits_total", "counter", "Calls that waited for the rate limiter", {"venue": name},
+                 limiter.num_waits),
+                ("rate_limiter_wait_seconds_total", "counter", "Time spent waiting for the rate limiter",
+                 {"venue": name}, limiter.wait_time),
+                ("rate_limiter_penalties_total", "counter", "Rate limit violations reported by the exchange",
+                 {"venue": name}, limiter.num_penalties),
+            ]
+    for name, session in (http_sessions or {}).items():
+        stats = session.get_stats()
+        samples += [
+            ("http_requests_total", "counter", "HTTP requests", {"venue": name}, stats["num_requests"]),
+            ("http_connections_total", "counter", "New HTTP connections (TCP and TLS handshakes)", {"venue": name},
+             stats["num_connections"]),
+        ]
+    if ledger is not None:
+        samples.append(("balance_deviations_total", "counter", "Deviations between ledger and exchange balances",
+                        {}, ledger.num_deviations))
+    if order_fill_watcher is not None:
+        samples.append(("order_polls_total", "counter", "Order status polls", {}, order_fill_watcher.num_polls))
+    if leg_executor is not None:
+        samples.append(("leg_failures_total", "counter", "Arbitrages where only some legs went through", {},
+                        leg_executor.num_leg_failures))
+    if paper_engine is not None:
+        num_arbitrages, expected_gain, realized_gain = paper_engine.get_gain_stats()
+        samples += [
+            ("paper_expected_gain_fiat", "gauge", "Sum of the expected gains of the simulated arbitrages", {},
+             expected_gain),
+            ("paper_realized_gain_fiat", "gauge", "Sum of the realized gains of the simulated arbitrages", {},
+             realized_gain),
+        ]
+    return samples
+
+
+def get_leg_reservation(leg):
+    # Currency and amount that the order of a leg can use at most
+    if leg["side"] == "buy":
+        return fiat, leg["volume"] * leg["limit_price"] * (1 + fees[leg["index"]])
+    return crypto, leg["volume"]
+
+
+def submit_leg(leg, max_order_time):
+    # Create the limit order of a leg with a new client order id and reserve its balance in the ledger.
+    # Returns the order id or None if the order did not go through.
+    name = exchange_names[leg["index"]]
+    title = exchange_titles[leg["index"]]
+    exchange = get_trading_exchange(name)
+    client_order_id = create_client_order_id(name)
+    client_order_registry.register(name, client_order_id)
+    if ledger is not None:
+        reserve_currency, reserve_amount = get_leg_reservation(leg)
+        ledger.reserve(name, client_order_id, reserve_currency, reserve_amount)
+    leg["client_order_id"] = client_order_id
+    log.info("Creating {} {} order for {:.4f} {} (limit price {:f}) (userref={})",
+        title, leg["side"], leg["volume"], crypto, leg["limit_price"], client_order_id)
+    if leg["side"] == "buy":
+        create_order_fn = exchange.createLimitBuyOrder
+    else:
+        create_order_fn = exchange.createLimitSellOrder
+    start_time = time.time()
+    order_result = ccxt_retry(create_order_fn,
+        symbol, leg["volume"], leg["limit_price"], {client_order_id_params[name]: client_order_id},
+        _max_time=max_order_time, _max_trials=1)
+    leg["submit_time"] = time.time()
+    metrics.REGISTRY.observe("stage_latency_seconds", leg["submit_time"] - start_time,
+                             stage="order_submit", venue=name)
+    if order_result is not None:
+        order_id = order_result["id"]
+        client_order_registry.register(name, client_order_id, order_id)
+    else:
+        log.warning("Order submission failed.")
+        lookup_time = min(check_order_time, max(max_order_time - time.time(), min_check_order_time))
+        order_id = check_order_info(name, lookup_time, client_order_id)
+        if order_id is None:
+            if ledger is not None:
+                ledger.release(name, client_order_id)
+            return None
+    # TODO: Check for errors message {'message': 'size too precise (7.020050523748998)'}
+    log.info("{} order id: {}", title, order_id)
+    order_log.event("order_submitted", exchange=name, side=leg["side"], volume=leg["volume"],
+                    limit_price=leg["limit_price"], order_id=order_id, client_order_id=client_order_id)
+    return order_id
+
+
+def cancel_leg(leg):
+    # Cancel the order of a leg. Returns its order info afterwards (None if unknown).
+    name = exchange_names[leg["index"]]
+    exchange = get_trading_exchange(name)
+    log.warning("Cancelling {} {} order {}", exchange_titles[leg["index"]], leg["side"], leg["order_id"])
+    if ccxt_retry(exchange.cancelOrder, leg["order_id"], symbol, _max_trials=3) is None:
+        log.warning("Cancelling order {} failed.", leg["order_id"])
+    # The order might have been filled before the cancellation
+    return ccxt_retry(exchange.fetchOrder, leg["order_id"], _max_trials=3)
+
+
+def query_leg(leg):
+    # Look up the order of a leg again (e.g. when its cancellation failed): the order id is found through the
+    # client order registry by the client order id of the leg and the order info is fetched from the exchange.
+    # Returns None if the state of the order is still unknown.
+    name = exchange_names[leg["index"]]
+    order_id = check_order_info(name, min_check_order_time, leg["client_order_id"])
+    if order_id is None:
+        return None
+    return ccxt_retry(get_trading_exchange(name).fetchOrder, order_id, _max_trials=3)
+
+
+def hedge_leg(leg, volume):
+    # Offset volume of a leg with an opposite order on the same exchange that should fill right away.
+    # Returns the hedge leg or None.
+    name = exchange_names[leg["index"]]
+    side = "sell" if leg["side"] == "buy" else "buy"
+    order_book = ccxt_retry(exchanges[name].fetchL2OrderBook, symbol, _max_trials=3)
+    if order_book is None:
+        return None
+    ask_price, _, bid_price, _ = ccxt_utils.get_conservative_ask_bid_price(order_book, volume * min_volume_factor)
+    if side == "buy":
+        limit_price = round(ask_price * limit_price_safety_factor, fiat_ndigits)
     else:
-        arbitration_mode = BUY_KRAKEN_SELL_GDAX
-
-    # if exp_relative_gains[arbitration_mode] < chosen_min_relative_gains[arbitration_mode]:
-    #     logging.info("Gain is too low. Cancelling.")
-    #     logging.info("Waiting ...")
-    #     logging.info("")
-    #     time.sleep(trial_sleep_time)
-    #     continue
-
-    if arbitration_mode == BUY_KRAKEN_SELL_GDAX:
-        if order_volume_crypto > gdax_balance_crypto:
-            logging.info("Not enough crypto balance in Gdax account. Reducing order amount.")
-            order_volume_crypto = gdax_balance_crypto
-        if buy_volumes_fiat[arbitration_mode] * buy_safety_factor_fiat > kraken_balance_fiat:
-            logging.info("Not enough fiat balance in Kraken account. Reducing order amount.")
-            reduce_factor = kraken_balance_fiat / (buy_volumes_fiat[arbitration_mode] * buy_safety_factor_fiat)
-            order_volume_crypto = round(reduce_factor * order_volume_crypto, crypto_ndigits)
-            logging.info("Reduced order amount to {:.4f} {}".format(order_volume_crypto, crypto))
-    elif arbitration_mode == BUY_GDAX_SELL_KRAKEN:
-        if order_volume_crypto > kraken_balance_crypto:
-            logging.info("Not enough crypto balance in Kraken account. Reducing order amount.")
-            order_volume_crypto = kraken_balance_crypto
-        if buy_volumes_fiat[arbitration_mode] * buy_safety_factor_fiat > gdax_balance_fiat:
-            logging.info("Not enough fiat balance in Gdax account. Reducing order amount.")
-            reduce_factor = gdax_balance_fiat / (buy_volumes_fiat[arbitration_mode] * buy_safety_factor_fiat)
-            order_volume_crypto = round(reduce_factor * order_volume_crypto, crypto_ndigits)
-            logging.info("Reduced order amount to {:.4f} {}".format(order_volume_crypto, crypto))
-
-    logging.info("Gain is high enough. Continuing.")
-    if arbitration_mode == BUY_KRAKEN_SELL_GDAX:
-        logging.info("Arbitration mode: BUY_KRAKEN_SELL_GDAX")
+        limit_price = round(bid_price / limit_price_safety_factor, fiat_ndigits)
+    if not math.isfinite(limit_price) or limit_price <= 0:
+        log.error("Not enough volume in the {} order book to hedge.", exchange_titles[leg["index"]])
+        return None
+    hedge = {"index": leg["index"], "side": side, "limit_price": limit_price, "volume": round(volume, crypto_ndigits)}
+    log.warning("Hedging {} {} order with a {} order", exchange_titles[leg["index"]], leg["side"], side)
+    hedge["order_id"] = submit_leg(hedge, time.time() + max_time_from_order_book_to_order)
+    if hedge["order_id"] is None:
+        return None
+    return hedge
+
+
+def apply_leg_fill(leg, order_info):
+    name = exchange_names[leg["index"]]
+    if order_info["filled"] > 0:
+        log.info("Final {} price: {} {}", leg["side"], order_info["cost"] / order_info["filled"], fiat)
+    fee_cost, fee_currency = get_order_fee(order_info)
+    if fee_cost is not None:
+        log.info("Final {} fee: {} {}", leg["side"], fee_cost, fee_currency)
     else:
-        logging.info("Arbitration mode: BUY_GDAX_SELL_KRAKEN")
+        log.info("No fee information")
+    leg["fill"] = (order_info["filled"], order_info["cost"], fee_cost, fee_currency)
+    if risk_client is not None:
+        risk_client.apply_fill(name, leg["side"], crypto, fiat, order_info["filled"], order_info["cost"],
+                               fee_cost, fee_currency)
+    else:
+        ledger.apply_fill(name, leg["side"], crypto, fiat, order_info["filled"], order_info["cost"],
+                          fee_cost, fee_currency, leg["client_order_id"])
+
 
-    if prompt_user and not prompt_yes_no("Continue?"):
-        logging.info("Cancelling")
+def get_leg_balance_changes(legs):
+    # Changes of the fiat and crypto balances per exchange by the fills of the legs (booked like the ledger does)
+    changes_fiat = np.zeros(num_exchanges)
+    changes_crypto = np.zeros(num_exchanges)
+    for leg in legs:
+        if leg.get("fill") is None:
+            continue
+        filled, cost, fee_cost, fee_currency = leg["fill"]
+        sign = 1 if leg["side"] == "buy" else -1
+        changes_crypto[leg["index"]] += sign * filled
+        changes_fiat[leg["index"]] -= sign * cost
+        if fee_cost is not None and fee_currency == fiat:
+            changes_fiat[leg["index"]] -= fee_cost
+        elif fee_cost is not None and fee_currency == crypto:
+            changes_crypto[leg["index"]] -= fee_cost
+    return changes_fiat, changes_crypto
+
+
+def wait_for_legs(legs, check_done=True):
+    # Wait until the orders of all legs are final and apply their fills to the ledger.
+    # With check_done an order that was cancelled or expired stops the engine.
+    order_fill_watcher.clear()
+    legs_by_key = {}
+    for leg in legs:
+        name = exchange_names[leg["index"]]
+        def fetch_order(exchange=get_trading_exchange(name), order_id=leg["order_id"]):
+            return ccxt_retry(exchange.fetchOrder, order_id, _max_trials=1)
+        legs_by_key[(name, leg["order_id"])] = leg
+        order_fill_watcher.add((name, leg["order_id"]), fetch_order, leg["submit_time"])
+
+    def on_order_done(key, order_info):
+        if not check_done or is_order_done(order_info):
+            apply_leg_fill(legs_by_key[key], order_info)
+
+    order_fill_watcher.wait(on_done=on_order_done)
+    for key, fill_time in order_fill_watcher.get_fill_times().items():
+        log.info("{} order filled after {:.2f} s", exchange_titles[exchange_names.index(key[0])], fill_time)
+        metrics.REGISTRY.observe("stage_latency_seconds", fill_time, stage="order_fill", venue=key[0])
+
+
+def finish_failed_legs(legs, leg_status):
+    # Book the live legs (and their hedges) of an arbitrage where a leg did not go through
+    if leg_status == "unresolved":
+        log.error("ERROR: Only some orders went through and the other ones could not be cancelled or hedged.")
+        log.error("Stopping.")
         sys.exit(1)
+    log.warning("Only some orders went through. Resolved by: {}", leg_status)
+    watched_legs = []
+    for leg in legs:
+        if leg["order_id"] is None:
+            continue
+        name = exchange_names[leg["index"]]
+        if leg.get("cancelled"):
+            if ledger is not None:
+                ledger.release(name, leg["client_order_id"])
+            continue
+        if fill_watcher.is_order_final(leg.get("order_info")):
+            apply_leg_fill(leg, leg["order_info"])
+        else:
+            watched_legs.append(leg)
+        if leg.get("hedge_leg") is not None:
+            watched_legs.append(leg["hedge_leg"])
+    wait_for_legs(watched_legs, check_done=False)
+    if ledger is not None:
+        ledger.request_reconcile()
+    log.info("")
+
+
+def release_approval(approval_id):
+    # Give the reservations of an approved arbitrage back to the risk coordinator (after its fills were sent)
+    if approval_id is not None:
+        risk_client.release(approval_id)
+
+
+def log_arbitrage_gain(ask_price, ask_volume, bid_price, bid_volume, buy_fee, sell_fee, order_volume_crypto,
+                       buy_volume_fiat, gain_fiat, relative_gain):
+    gain_log.info("Expected buy price: {:.2f} {}", ask_price, fiat)
+    gain_log.info("Expected buy price (plus fees): {:.2f} {}", ask_price * (1 + buy_fee), fiat)
+    gain_log.info("Volume for buy price {:.2f} {}: {:.2f}", ask_price, fiat, ask_volume)
+    gain_log.info("Expected sell price: {:.2f} {}", bid_price, fiat)
+    gain_log.info("Expected sell price (minus fees): {:.2f} {}", bid_price * (1 - sell_fee), fiat)
+    gain_log.info("Volume for sell price {:.2f} {}: {:.2f}", bid_price, fiat, bid_volume)
+    gain_log.info("Buy crypto volume (limit price {:.2f} {}: {:.4f} {}",
+        ask_price, fiat,
+        order_volume_crypto, crypto)
+    gain_log.info("Sell crypto volume (limit price {:.2f} {}: {:.4f} {}",
+        bid_price, fiat,
+        order_volume_crypto, crypto)
+    gain_log.info("Expected buy fiat volume (plus fees): {:.2f} {}", buy_volume_fiat, fiat)
+    gain_log.info("Expected sell fiat volume (minus fees): {:.2f} {}", buy_volume_fiat + gain_fiat, fiat)
+    gain_log.info("Expected gain: {:.2f} {} ({:.4f} %)",
+        gain_fiat, fiat, 100 * relative_gain)
+
+
+def run(input_order_volume_crypto=None):
+    # The trading loop. input_order_volume_crypto fixes the order volume instead of choosing it.
+    init()
+    total_balance_fiat_begin = None
+    # Sum of the gains of this worker's own fills (multi-process mode)
+    total_gain_fiat = 0.0
+
+    num_arbitrations = 0
+    balances_update_countdown = 0
+    for iteration in range(num_iterations):
 
-    if simulate:
-        logging.info("Simulated arbitration done.")
-        logging.info("")
-        time.sleep(10)
-        continue
+        if simulate:
+            log.info("---------- SIMULATION ----------")
+        else:
+            log.info("---------- ARBITRATION ----------")
+        log.info("Time: {}", datetime.datetime.now())
 
-    # Make sure we check balances on next iteration in case something goes wrong.
-    balances_update_countdown = 0
+        if risk_client is not None and risk_client.halted:
+            log.error("ERROR: The risk coordinator stopped trading.")
+            log.error("Exiting")
+            sys.exit(1)
 
-    #
-    # Kraken Add buy order
-    #
-
-    def find_matching_orders(orders, match_lambda):
-        matching_order_ids = []
-        for order in orders.items():
-            if match_lamdba(order):
-                matching_order_ids.append(order["id"])
-        return matching_order_ids
-
-    kraken_userref = int(random.randint(0, 2**31 - 1))
-    gdax_userref = str(uuid.uuid4())
-    max_order_time = order_book_request_time + max_time_from_order_book_to_order
-
-    def kraken_find_matching_orders(order_dict, userref):
-        matching_order_ids = []
-        for order_id, order in order_dict.items():
-            if order["userref"] == userref:
-                matching_order_ids.append(order_id)
-        return matching_order_ids
-
-    # TODO
-    def kraken_get_open_orders():
-        data = {}
-        response = kraken_client.query_private('OpenOrders', data=data, timeout=kraken_timeout)
-        if "result" in response:
-            response["result"] = response["result"]["open"]
-        return response
-
-    # TODO
-    def kraken_get_closed_orders():
-        data = {
-            "start": kraken_server_time,
-        }
-        response = kraken_client.query_private('ClosedOrders', data=data, timeout=kraken_timeout)
-        if "result" in response:
-            response["result"] = response["result"]["closed"]
-        return response
-
-    def check_order_info(check_order_time, match_lamdba):
-        # logging.info("kraken_open_orders:", open_orders)
-        matching_order_ids = []
-        check_order_start_time = time.time()
-        while len(matching_order_ids) == 0:
-            logging.info("Trying to find order (time={}, kraken_time={}) ...".format(
-                datetime.datetime.now(), kraken_server_time))
-            check_order_time_limit_reached = time.time() - check_order_start_time > check_order_time
-            open_orders = kraken_wrapper.retry_on_error(
-                kraken_get_open_orders)
-            logging.info("Open orders: {}".format(open_orders))
-            matching_order_ids = kraken_find_matching_orders(open_orders, kraken_userref)
-            if len(matching_order_ids) == 0:
-                closed_orders = kraken_wrapper.retry_on_error(
-                    kraken_get_closed_orders)
-                logging.info("Closed orders: {}".format(closed_orders))
-                # logging.info("kraken_closed_orders:", closed_orders)
-                matching_order_ids = kraken_find_matching_orders(closed_orders, kraken_userref)
-            if len(matching_order_ids) == 0 and check_order_time_limit_reached:
-                return None
-            if len(matching_order_ids) > 1:
-                logging.warning("WARNING: Multiple matching orders found.")
-                logging.warning("Matching orders: {}".format(matching_order_ids))
-        order_id = matching_order_ids[0]
-        return order_id
-
-    def kraken_check_order_info(check_order_time, userref):
-        return check_order_info(check_order_time, lambda order: order["info"]["userref"] == userref)
-
-    def gdax_check_order_info(check_order_time, userref):
-        return check_order_info(check_order_time, lambda order: order["info"]["client_oid"] == userref)
-
-    if arbitration_mode == BUY_KRAKEN_SELL_GDAX:
-        # buy_volume_fiat = kraken_buy_price_fiat * order_volume_crypto * (1 + kraken_fee_ratio)
-        # if buy_volume_fiat * buy_safety_factor_fiat > kraken_balance_fiat:
-        #     logging.info("Not enough fiat balance in Kraken account for transfer.")
-        #     logging.info("Cancelling.")
-        #     logging.info(trial_sleep_time)
-        #     continue
+        if balance_deviation_alarm and stop_on_balance_deviation:
+            log.error("ERROR: Ledger balances deviated from the exchange balances.")
+            log.error("Exiting")
+            sys.exit(1)
 
-        # Limit total losses if market moves extremely fast (if the market recovers again)
-        buy_limit_price_fiat = limit_price_safety_factor * kraken_ask_price
-        # if kraken_ask_price >= gdax_bid_price:
-        #     buy_limit_price_fiat = kraken_ask_price + kraken_ask_price - gdax_bid_price
-        # else:
-        #     buy_limit_price_fiat = (kraken_ask_price + gdax_bid_price) / 2.0
-        buy_limit_price_fiat = round(buy_limit_price_fiat, fiat_ndigits)
-        logging.info("Creating Kraken buy order for {:.4f} {} (limit price {:f}) (userref={:d})".format(
-            order_volume_crypto, crypto, buy_limit_price_fiat, kraken_userref))
-        kraken_order_result = ccxt_retry(kraken.createLimitBuyOrder,
-            symbol, order_volume_crypto, buy_limit_price_fiat, {"userref": kraken_userref},
-            _max_time=max_order_time, _max_trials=1)
-        if kraken_order_result is not None:
-            kraken_order_id = kraken_order_result["id"]
+        balances = get_balances()
+        if balances is None:
+            log.info("No balances from the risk coordinator.")
+            log.info("Waiting ...")
+            log.info("")
+            wait_for_next_iteration()
+            continue
+        balances_fiat, balances_crypto = balances
+
+        if balances_update_countdown <= 0:
+            balances_update_countdown = balance_update_interval
+
+            # Get server time to check for recent orders later on
+            kraken_server_time = None
+            try:
+                kraken_limiter = rate_limiter.get_rate_limiter("kraken")
+                if kraken_limiter is not None:
+                    kraken_limiter.acquire("Time")
+                kraken_server_time = kraken_client.query_public("Time")
+                if len(kraken_server_time["error"]) > 0:
+                    raise Exception("{}".format(kraken_server_time["error"]))
+            except Exception as e:
+                log.info("Unable to get server time ({}).", e)
+                log.info("Waiting ...")
+                log.info("")
+                wait_for_next_iteration()
+                continue
+            kraken_server_time = kraken_server_time["result"]["unixtime"]
+            log.info("Kraken server time: {:d}", kraken_server_time)
+            if "kraken" in client_order_registry.sources:
+                client_order_registry.advance_cursor("kraken", kraken_server_time)
+            log.info("Gains log: {}", gains_log_writer.format_stats())
+            if ledger is not None:
+                log.info("Balance ledger: {:d} fills, {:d} reconciles, {:d} fetch errors, {:d} deviations",
+                    ledger.num_fills, ledger.num_reconciles, ledger.num_fetch_errors, ledger.num_deviations)
+            for name, session in http_sessions.items():
+                log.info("{} HTTP: {}", name.capitalize(), session.format_stats())
+            for name in exchange_names:
+                limiter = rate_limiter.get_rate_limiter(name)
+                if limiter is not None:
+                    log.info("{} rate limiter: {:d} calls, {:d} waits ({:.1f} s), {:d} penalties", name.capitalize(),
+                        limiter.num_acquires, limiter.num_waits, limiter.wait_time, limiter.num_penalties)
+            log.info("Leg execution: {:d} arbitrages, {:d} leg failures, resolved {}, {:d} unresolved",
+                leg_executor.num_executions, leg_executor.num_leg_failures, leg_executor.num_resolved,
+                leg_executor.num_unresolved)
+            if paper_engine is not None:
+                log.info("Paper trading: {}", paper_engine.format_stats())
+            if metrics_textfile is not None:
+                try:
+                    metrics.REGISTRY.write_textfile(metrics_textfile)
+                except OSError as e:
+                    log.warning("Unable to write metrics to {} ({}).", metrics_textfile, e)
+            if gains_log_writer.last_error is not None:
+                log.warning("Last gains log error: {}", gains_log_writer.last_error)
         else:
-            logging.warning("Order submission failed.")
-            kraken_order_id = kraken_check_order_info(check_order_time, kraken_userref)
-            if kraken_order_id is None:
-                logging.info("Kraken order did not go through.")
-                logging.info("Trying another iteration.")
-                logging.info("")
+            balances_update_countdown -= 1
+
+        for index, title in enumerate(exchange_titles):
+            log.info("{} account balance:", title)
+            log.info("  {:.2f} {}", balances_fiat[index], fiat)
+            log.info("  {:.4f} {}", balances_crypto[index], crypto)
+            log.info("Current {} fee: {:.2f} %", title, 100 * fees[index])
+
+        total_balance_fiat = np.sum(balances_fiat)
+        total_balance_crypto = np.sum(balances_crypto)
+        log.info("Total balance fiat: {:.2f} {}", total_balance_fiat, fiat)
+        log.info("Total balance crypto: {:.4f} {}", total_balance_crypto, crypto)
+
+        if total_balance_fiat_begin is None:
+            total_balance_fiat_begin = total_balance_fiat
+
+        # Get order book snapshots of all exchanges
+        if use_order_book_streams:
+            order_book_snapshots = collections.OrderedDict()
+            for name, stream in order_book_streams.items():
+                order_book_snapshots[name] = stream.get_snapshot(symbol)
+            unsynced_names = [name for name, snapshot in order_book_snapshots.items() if snapshot is None]
+            if len(unsynced_names) > 0:
+                log.info("Order book streams are not synced: {}", ", ".join(unsynced_names))
+                log.info("Waiting ...")
+                log.info("")
+                wait_for_next_iteration()
+                continue
+        elif shared_order_books is not None:
+            order_book_snapshots = collections.OrderedDict()
+            for name, shared_book in shared_order_books.items():
+                order_book_snapshots[name] = shared_book.get_snapshot(symbol, shared_order_book_max_age)
+            missing_names = [name for name, snapshot in order_book_snapshots.items() if snapshot is None]
+            if len(missing_names) > 0:
+                log.info("No current order books in shared memory: {}", ", ".join(missing_names))
+                log.info("Waiting ...")
+                log.info("")
+                wait_for_next_iteration()
                 continue
-        logging.info("Kraken order id: {}".format(kraken_order_id))
+        elif concurrent_order_book_fetch:
+            order_book_snapshots = ccxt_utils.fetch_order_books(exchanges, symbol, _rate_limit=api_rate_limit)
+        else:
+            order_book_snapshots = collections.OrderedDict()
+            for name, exchange in exchanges.items():
+                order_book_snapshots[name] = ccxt_utils.fetch_order_book_snapshot(
+                    exchange, symbol, _rate_limit=api_rate_limit)
+        if not use_order_book_streams and shared_order_books is None:
+            for name, snapshot in order_book_snapshots.items():
+                metrics.REGISTRY.observe("stage_latency_seconds", snapshot["response_time"] - snapshot["request_time"],
+                                         stage="book_fetch", venue=name)
+        if record_order_books:
+            for name, snapshot in order_book_snapshots.items():
+                if snapshot["order_book"] is not None:
+                    recorder.record(name, symbol, snapshot)
+        if paper_engine is not None:
+            for name, snapshot in order_book_snapshots.items():
+                paper_engine.update_order_book(name, snapshot["order_book"])
+
+        order_book_skew = ccxt_utils.get_snapshot_skew(*order_book_snapshots.values())
+        log.info("Order book skew: {:.3f} s", order_book_skew)
+        if order_book_skew > max_order_book_skew:
+            log.info("Order book snapshots are too far apart ({:.3f} s > {:.3f} s).",
+                order_book_skew, max_order_book_skew)
+            log.info("Waiting ...")
+            log.info("")
+            wait_for_next_iteration()
+            continue
+
+        if scan_currency_graph:
+            updated_edges = []
+            if iteration % currency_graph_ticker_interval == 0:
+                tickers = ccxt_utils.fetch_tickers(exchanges, graph_symbols, _rate_limit=api_rate_limit, _max_trials=1)
+                for (name, ticker_symbol), ticker in tickers.items():
+                    if ticker is not None and ticker["ask"] is not None and ticker["bid"] is not None:
+                        updated_edges += graph.update_market(name, ticker_symbol, ticker["ask"], ticker["bid"])
+            for name, snapshot in order_book_snapshots.items():
+                if (name, symbol) in graph.market_edges:
+                    updated_edges += graph.update_market_from_order_book(name, symbol, snapshot["order_book"])
+            for cycle in graph.find_cycles_through_edges(updated_edges):
+                log.info("Arbitrage cycle: {}", currency_graph.format_cycle(cycle))
+
+        depths = [ccxt_utils.get_order_book_depths(order_book_snapshots[name]["order_book"])
+                  for name in exchange_names]
+
+        # Remember time so we can cancel if adding the first order takes too long.
+        order_book_request_time = time.time()
+
+        decision = arbitrage_engine.decide(exchange_names, depths, fees, balances_fiat, balances_crypto,
+                                           arbitrage_parameters, input_order_volume_crypto)
+        metrics.REGISTRY.observe("stage_latency_seconds", time.time() - order_book_request_time, stage="decision")
+        ask_prices, ask_volumes = decision["ask_prices"], decision["ask_volumes"]
+        bid_prices, bid_volumes = decision["bid_prices"], decision["bid_volumes"]
+        if decision["status"] == "no_volume":
+            title = exchange_titles[decision["venue_index"]]
+            index = decision["venue_index"]
+            log.info("Not enough trading volume on {}.", title)
+            log.info("{} ask volume: {}, {} bid volume: {}",
+                title, ask_volumes[index], title, bid_volumes[index])
+            log.info("Waiting ...")
+            log.info("")
+            wait_for_next_iteration()
+            continue
+
+        for buy_index, sell_index, solution in decision["volume_solutions"]:
+            log.info("{}: Optimal order volume {:.4f} {} (limit {:.4f} {}), expected gain {:.2f} {}",
+                arbitrage_engine.get_arbitration_mode_str(exchange_names[buy_index], exchange_names[sell_index]),
+                solution["optimal_volume"], crypto, solution["volume_limit"], crypto, solution["gain_fiat"], fiat)
+
+        order_volumes_crypto = decision["order_volumes_crypto"]
+        vwap_ask_prices, vwap_bid_prices = decision["vwap_ask_prices"], decision["vwap_bid_prices"]
+        gain_ask_prices, gain_bid_prices = decision["gain_ask_prices"], decision["gain_bid_prices"]
+        exp_gains_fiat, exp_relative_gains = decision["exp_gains_fiat"], decision["exp_relative_gains"]
+        buy_volumes_fiat = decision["buy_volumes_fiat"]
+        for buy_index, sell_index in arbitration_pairs:
+            log.info("----- Buy on {}, sell on {} -----", exchange_titles[buy_index], exchange_titles[sell_index])
+            log.info("VWAP buy price: {:.2f} {}, VWAP sell price: {:.2f} {}",
+                vwap_ask_prices[buy_index, sell_index], fiat, vwap_bid_prices[buy_index, sell_index], fiat)
+            log_arbitrage_gain(
+                gain_ask_prices[buy_index, sell_index], ask_volumes[buy_index],
+                gain_bid_prices[buy_index, sell_index], bid_volumes[sell_index],
+                fees[buy_index], fees[sell_index], order_volumes_crypto[buy_index, sell_index],
+                buy_volumes_fiat[buy_index, sell_index], exp_gains_fiat[buy_index, sell_index],
+                exp_relative_gains[buy_index, sell_index])
+
+        values = [exp_gains_fiat[pair] for pair in arbitration_pairs]
+        values += [exp_relative_gains[pair] for pair in arbitration_pairs]
+        for index in range(num_exchanges):
+            values += [ask_prices[index], ask_volumes[index], bid_prices[index], bid_volumes[index]]
+        gains_log_writer.write(time.time(), [float(value) for value in values])
+
+        feasible, tier_indices = decision["feasible"], decision["tier_indices"]
+        for buy_index, sell_index in zip(*np.nonzero(feasible)):
+            tier_index = tier_indices[buy_index, sell_index]
+            log.info("{} is possible with min_relative_gain={} %, min_fiat_reserve={}",
+                arbitrage_engine.get_arbitration_mode_str(exchange_names[buy_index], exchange_names[sell_index]),
+                100 * tier_min_relative_gains[buy_index, sell_index, tier_index],
+                tier_min_fiat_reserves[buy_index, sell_index, tier_index])
+
+        if decision["status"] != "trade":
+            log.info("No arbitration opportunity. Cancelling.")
+            log.info("Waiting ...")
+            log.info("")
+            wait_for_next_iteration()
+            continue
+
+        buy_index, sell_index = decision["buy_index"], decision["sell_index"]
+        buy_title, sell_title = exchange_titles[buy_index], exchange_titles[sell_index]
+        arbitration_mode_str = arbitrage_engine.get_arbitration_mode_str(
+            exchange_names[buy_index], exchange_names[sell_index])
+        exp_relative_gain = decision["exp_relative_gain"]
+        chosen_min_relative_gain = decision["chosen_min_relative_gain"]
+        order_volume_crypto = decision["order_volume_crypto"]
+
+        if decision["crypto_reduced"]:
+            log.info("Not enough crypto balance in {} account. Reducing order amount.", sell_title)
+        if decision["fiat_reduced"]:
+            log.info("Not enough fiat balance in {} account. Reducing order amount.", buy_title)
+            log.info("Reduced order amount to {:.4f} {}", order_volume_crypto, crypto)
+
+        log.info("Gain is high enough. Continuing.")
+        log.info("Arbitration mode: {}", arbitration_mode_str)
+        log.event("arbitrage_decision", mode=arbitration_mode_str, volume=order_volume_crypto,
+                  exp_relative_gain=exp_relative_gain, min_relative_gain=chosen_min_relative_gain)
+
+        if prompt_user and not prompt_yes_no("Continue?"):
+            log.info("Cancelling")
+            sys.exit(1)
 
         #
-        # GDax Sell
+        # Add buy and sell orders
         #
 
         # Limit total losses if market moves extremely fast (if the market recovers again)
-        sell_limit_price_fiat = gdax_bid_price / limit_price_safety_factor
-        # if kraken_ask_price >= gdax_bid_price:
-        #     sell_limit_price_fiat = kraken_ask_price - (kraken_ask_price - gdax_bid_price)
-        # else:
-        #     sell_limit_price_fiat = (kraken_ask_price + gdax_bid_price) / 2.0
-        sell_limit_price_fiat = round(sell_limit_price_fiat, fiat_ndigits)
-        logging.info("Creating Gdax sell order for {:.4f} {} (limit price {:f}) (userref={})".format(
-            order_volume_crypto, crypto, sell_limit_price_fiat, gdax_userref))
-        max_order_time = time.time() + max_time_from_order_book_to_order
-        gdax_order_result = ccxt_retry(gdax.createLimitSellOrder,
-            symbol, order_volume_crypto, sell_limit_price_fiat, {"client_oid": gdax_userref},
-            _max_time=max_order_time, _max_trials=1)
-        if gdax_order_result is not None:
-            gdax_order_id = gdax_order_result["id"]
-        else:
-            logging.warning("Exceeded time limit between order book request and order.")
-            gdax_order_id = gdax_check_order_info(check_order_time, gdax_userref)
-            if gdax_order_id is None:
-                logging.error("ERROR: Gdax order did not go through. Stopping.")
-                sys.exit(1)
-        # TODO: Check for errors message {'message': 'size too precise (7.020050523748998)'}
-        logging.info("Gdax order id: {}".format(gdax_order_id))
-
-    elif arbitration_mode == BUY_GDAX_SELL_KRAKEN:
-        # buy_volume_fiat = gdax_buy_price_fiat * order_volume_crypto * (1 + gdax_fee_ratio)
-        # if buy_volume_fiat * buy_safety_factor_fiat > gdax_balance_fiat:
-        #     logging.info("Not enough fiat balance in Gdax account.")
-        #     logging.info("Cancelling.")
-        #     logging.info(trial_sleep_time)
-        #     continue
+        buy_limit_price_fiat = decision["buy_limit_price_fiat"]
+        sell_limit_price_fiat = decision["sell_limit_price_fiat"]
+        legs = [
+            {"index": buy_index, "side": "buy", "limit_price": buy_limit_price_fiat, "volume": order_volume_crypto},
+            {"index": sell_index, "side": "sell", "limit_price": sell_limit_price_fiat, "volume": order_volume_crypto},
+        ]
+
+        def get_submission_priority(leg):
+            name = exchange_names[leg["index"]]
+            if name in order_submission_priority:
+                return order_submission_priority.index(name)
+            return len(order_submission_priority)
+
+        legs.sort(key=get_submission_priority)
+
+        # In multi-process mode the coordinator reserves the balances of the legs for this worker
+        approval_id = None
+        if risk_client is not None:
+            approval_id = risk_client.request_approval(
+                [(exchange_names[leg["index"]],) + get_leg_reservation(leg) for leg in legs])
+            if approval_id is None:
+                log.info("Arbitrage was not approved by the risk coordinator.")
+                log.info("Waiting ...")
+                log.info("")
+                wait_for_next_iteration()
+                continue
 
-        # Limit total losses if market moves extremely fast (if the market recovers again)
-        sell_limit_price_fiat = kraken_bid_price / limit_price_safety_factor
-        # if gdax_ask_price >= kraken_bid_price:
-        #     sell_limit_price_fiat = gdax_ask_price - (gdax_ask_price - kraken_bid_price)
-        # else:
-        #     sell_limit_price_fiat = (gdax_ask_price + kraken_bid_price) / 2.0
-        sell_limit_price_fiat = round(sell_limit_price_fiat, fiat_ndigits)
-        logging.info("Creating Kraken sell order for {:.4f} {} (limit price {:f}) (userref={:d})".format(
-            order_volume_crypto, crypto, sell_limit_price_fiat, kraken_userref))
-        kraken_order_result = ccxt_retry(kraken.createLimitSellOrder,
-            symbol, order_volume_crypto, sell_limit_price_fiat, {"userref": kraken_userref},
-            _max_time=max_order_time, _max_trials=1)
-        if kraken_order_result is not None:
-            kraken_order_id = kraken_order_result["id"]
+        if concurrent_leg_submission:
+            leg_status = leg_executor.execute(legs, order_book_request_time + max_time_from_order_book_to_order)
+            if leg_status == "failed":
+                log.info("No order went through.")
+                log.info("Trying another iteration.")
+                log.info("")
+                release_approval(approval_id)
+                continue
+            if leg_status != "live":
+                finish_failed_legs(legs, leg_status)
+                release_approval(approval_id)
+                continue
         else:
-            logging.warning("Exceeded time limit between order book request and order.")
-            kraken_order_id = kraken_check_order_info(check_order_time, kraken_userref)
-            if kraken_order_id is None:
-                logging.info("Kraken order did not go through.")
-                logging.info("Trying another iteration.")
-                logging.info("")
+            max_order_time = order_book_request_time + max_time_from_order_book_to_order
+            first_leg_failed = False
+            for leg_index, leg in enumerate(legs):
+                title = exchange_titles[leg["index"]]
+                if leg_index > 0:
+                    max_order_time = time.time() + max_time_from_order_book_to_order
+                leg["order_id"] = submit_leg(leg, max_order_time)
+                if leg["order_id"] is None:
+                    if leg_index == 0:
+                        log.info("{} order did not go through.", title)
+                        log.info("Trying another iteration.")
+                        log.info("")
+                        first_leg_failed = True
+                        break
+                    log.error("ERROR: {} order did not go through. Stopping.", title)
+                    sys.exit(1)
+                leg["live_time"] = time.time()
+            if first_leg_failed:
+                release_approval(approval_id)
                 continue
-        logging.info("Kraken order id: {}".format(kraken_order_id))
+        log.info("All orders live {:.3f} s after the order book request",
+            leg_executor.get_live_time(legs, order_book_request_time))
 
         #
-        # GDax Sell
+        # Wait for orders to finish
         #
 
-        # Limit total losses if market moves extremely fast (if the market recovers again)
-        buy_limit_price_fiat = gdax_ask_price * limit_price_safety_factor
-        # if gdax_ask_price >= kraken_bid_price:
-        #     buy_limit_price_fiat = gdax_ask_price + gdax_ask_price - kraken_bid_price
-        # else:
-        #     buy_limit_price_fiat = (gdax_ask_price + kraken_bid_price) / 2.0
-        buy_limit_price_fiat = round(buy_limit_price_fiat, fiat_ndigits)
-        logging.info("Creating Gdax buy order for {:.4f} {} (limit price {:f}) (userref={})".format(
-            order_volume_crypto, crypto, buy_limit_price_fiat, gdax_userref))
-        max_order_time = time.time() + max_time_from_order_book_to_order
-        gdax_order_result = ccxt_retry(gdax.createLimitBuyOrder,
-            symbol, order_volume_crypto, buy_limit_price_fiat, {"client_oid": gdax_userref},
-            _max_time=max_order_time, _max_trials=1)
-        if gdax_order_result is not None:
-            gdax_order_id = gdax_order_result["id"]
+        log.info("Waiting for orders to finish...")
+        wait_for_legs(legs)
+        log.info("Orders finished.")
+        release_approval(approval_id)
+
+        num_arbitrations += 1
+
+        # Balances after the fills. The ledger was just updated by the same fills, so the buy and sell exchanges
+        # are asked directly: a fill that was booked wrong then shows up in the gain and crypto checks below.
+        # In multi-process mode the exchange (and coordinator) balances also change with the reservations and
+        # fills of the other workers, so the balances after are the balances before plus this worker's own fills.
+        if risk_client is not None:
+            changes_fiat, changes_crypto = get_leg_balance_changes(legs)
+            balances_fiat_after = balances_fiat + changes_fiat
+            balances_crypto_after = balances_crypto + changes_crypto
         else:
-            logging.warning("Exceeded time limit between order book request and order.")
-            gdax_order_id = gdax_check_order_info(check_order_time, gdax_userref)
-            if gdax_order_id is None:
-                logging.error("ERROR: Gdax order did not go through. Stopping.")
-                sys.exit(1)
-        # TODO: Check for errors message {'message': 'size too precise (7.020050523748998)'}
-        logging.info("Gdax order id: {}".format(gdax_order_id))
-
-    else:
-        raise RuntimeError("Unknown arbitration mode: {}".format(arbitration_mode))
-
-    #
-    # Wait for orders to finish
-    #
-
-    def is_order_done(order_info):
-        # logging.info("Order status: {}".format(order_info["status"]))
-        if order_info["status"] == "closed":
-            return True
-        elif order_info["status"] == "canceled":
-            logging.error("Order was cancelled.")
-            logging.error("Exiting")
+            balances_fiat_after, balances_crypto_after = get_balances()
+            if not simulate:
+                for index, balance in fetch_exchange_balances((buy_index, sell_index)):
+                    balances_fiat_after[index] = balance[fiat]["free"]
+                    balances_crypto_after[index] = balance[crypto]["free"]
+            ledger.request_reconcile()
+
+        for index, title in enumerate(exchange_titles):
+            if index not in (buy_index, sell_index):
+                continue
+            log.info("{} account balance before arbitration:", title)
+            log.info("  {:.2f} {}", balances_fiat[index], fiat)
+            log.info("  {:.4f} {}", balances_crypto[index], crypto)
+            log.info("{} account balance after arbitration:", title)
+            log.info("  {:.2f} {}", balances_fiat_after[index], fiat)
+            log.info("  {:.4f} {}", balances_crypto_after[index], crypto)
+
+        total_balance_fiat_before = np.sum(balances_fiat)
+        total_balance_fiat_after = np.sum(balances_fiat_after)
+        total_balance_crypto_before = np.sum(balances_crypto)
+        total_balance_crypto_after = np.sum(balances_crypto_after)
+        gain_fiat = total_balance_fiat_after - total_balance_fiat_before
+        gain_crypto = total_balance_crypto_after - total_balance_crypto_before
+        invested_fiat = balances_fiat[buy_index] - balances_fiat_after[buy_index]
+        relative_gain = gain_fiat / invested_fiat
+        total_gain_fiat += gain_fiat
+
+        log.info("Total balance fiat: {:.2f} {}", total_balance_fiat_after, fiat)
+        log.info("Total balance crypto: {:.4f} {}", total_balance_crypto_after, crypto)
+        log.info("Gain in fiat: {:.2f} {} ({:.4f} %)",
+            gain_fiat, fiat, 100 * relative_gain)
+        log.info("Gain in crypto: {:.4f} {}", gain_crypto, crypto)
+
+        if relative_gain < exp_relative_gain:
+            log.warning("WARNING: Actual gain was less than expected gain.")
+        if risk_client is not None:
+            risk_client.report_gain(gain_fiat)
+        if paper_engine is not None:
+            paper_engine.record_arbitrage(arbitration_mode_str, decision["exp_gain_fiat"], gain_fiat)
+            log.info("Simulated gain: {:.2f} {} (expected {:.2f} {})", gain_fiat, fiat, decision["exp_gain_fiat"], fiat)
+
+        # if ( relative_gain < 0 and exp_relative_gain > 0 ) \
+        # or ( relative_gain < exp_relative_gain ):
+        #     logging.error("ERROR: Lost {:.2f} {}.".format(-gain_fiat, fiat))
+        #     logging.error("Exiting")
+        #     sys.exit(1)
+        if ( relative_gain < 0 and relative_gain < (chosen_min_relative_gain / safety_lower_gain_tolerance) ) \
+        or ( relative_gain >= 0 and relative_gain < (chosen_min_relative_gain * safety_lower_gain_tolerance) ):
+            log.warning("ERROR: Actual gain was far less than desired minimum gain.")
+            # logging.warning("Exiting")
+            # sys.exit(1)
+        elif relative_gain < chosen_min_relative_gain:
+            log.warning("WARNING: Actual gain was less than desired minimum gain.")
+
+        if abs(gain_crypto) > max_balance_deviation_crypto:
+            log.error("ERROR: Difference in total crypto balance is too high.")
+            log.error("Exiting")
             sys.exit(1)
-        elif order_info["status"] == "expired":
-            logging.error("Order expired.")
-            logging.error("Exiting")
+
+        log.info("Arbitration done.")
+        log.info("Number of arbitrations done: {:d}", num_arbitrations)
+
+        if risk_client is not None:
+            gain_fiat_since_begin = total_gain_fiat
+        else:
+            gain_fiat_since_begin = total_balance_fiat_after - total_balance_fiat_begin
+        log.info("Total gain since start: {:.2f} {}", gain_fiat_since_begin, fiat)
+        log.info("")
+
+        if gain_fiat_since_begin < - max_overall_fiat_loss:
+            log.error("ERROR: Overall fiat loss is too high.")
+            log.error("Exiting")
             sys.exit(1)
-        return False
-
-    gdax_order_done = False
-    kraken_order_done = False
-    logging.info("Waiting for orders to finish...")
-    while (not gdax_order_done) or (not kraken_order_done):
-        if not kraken_order_done:
-            logging.info("Checking Kraken order...")
-            kraken_order_info = ccxt_retry(kraken.fetchOrder, kraken_order_id)
-            assert kraken_order_info is not None
-            if is_order_done(kraken_order_info):
-                kraken_order_done = True
-                # logging.info("Kraken order info:", kraken_order_info)
-                if arbitration_mode == BUY_KRAKEN_SELL_GDAX:
-                    logging.info("Final buy price: {} {}".format(kraken_order_info["cost"] / kraken_order_info["filled"], fiat))
-                    if kraken_order_info["fee"] is not None:
-                        logging.info("Final buy fee: {} {}".format(kraken_order_info["fee"]["cost"], kraken_order_info["fee"]["currency"]))
-                    else:
-                        logging.info("No fee information")
-                else:
-                    logging.info("Final sell price: {} {}".format(kraken_order_info["cost"] / kraken_order_info["filled"], fiat))
-                    if kraken_order_info["fee"] is not None:
-                        logging.info("Final sell fee: {} {}".format(kraken_order_info["fee"]["cost"], kraken_order_info["fee"]["currency"]))
-                    else:
-                        logging.info("No fee information")
-        if not gdax_order_done:
-            logging.info("Checking Gdax order...")
-            gdax_order_info = ccxt_retry(gdax.fetchOrder, gdax_order_id)
-            assert gdax_order_info is not None
-            if is_order_done(gdax_order_info):
-                gdax_order_done = True
-                # logging.info("Gdax order info:", gdax_order_info)
-                if arbitration_mode == BUY_KRAKEN_SELL_GDAX:
-                    logging.info("Final sell price: {} {}".format(gdax_order_info["cost"] / gdax_order_info["filled"], fiat))
-                    if "fill_fees" in gdax_order_info["info"]:
-                        logging.info("Final sell fee: {} {}".format(float(gdax_order_info["info"]["fill_fees"]), fiat))
-                    else:
-                        logging.info("No fee information")
-                else:
-                    logging.info("Final buy price: {} {}".format(gdax_order_info["cost"] / gdax_order_info["filled"], fiat))
-                    if "fill_fees" in gdax_order_info["info"]:
-                        logging.info("Final buy fee: {} {}".format(float(gdax_order_info["info"]["fill_fees"]), fiat))
-                    else:
-                        logging.info("No fee information")
-        if (not gdax_order_done) or (not kraken_order_done):
-            # Wait a bit before doing another check.
-            time.sleep(order_check_interval)
-    logging.info("Orders finished.")
-
-    num_arbitrations += 1
-
-    kraken_balance_after = ccxt_retry(kraken.fetchBalance)
-    kraken_balance_fiat_after = kraken_balance_after[fiat]["free"]
-    kraken_balance_crypto_after = kraken_balance_after[crypto]["free"]
-    gdax_balance_after = ccxt_retry(gdax.fetchBalance)
-    gdax_balance_fiat_after = gdax_balance_after[fiat]["free"]
-    gdax_balance_crypto_after = gdax_balance_after[crypto]["free"]
-
-    logging.info("Gdax account balance before arbitration")
-    logging.info("  {:.2f} {}".format(gdax_balance_fiat, fiat))
-    logging.info("  {:.4f} {}".format(gdax_balance_crypto, crypto))
-    logging.info("Gdax account balance after arbitration")
-    logging.info("  {:.2f} {}".format(gdax_balance_fiat_after, fiat))
-    logging.info("  {:.4f} {}".format(gdax_balance_crypto_after, crypto))
-
-    logging.info("Kraken account balance before arbitration:")
-    logging.info("  {:.2f} {}".format(kraken_balance_fiat, fiat))
-    logging.info("  {:.4f} {}".format(kraken_balance_crypto, crypto))
-    logging.info("Kraken account balance after arbitration:")
-    logging.info("  {:.2f} {}".format(kraken_balance_fiat_after, fiat))
-    logging.info("  {:.4f} {}".format(kraken_balance_crypto_after, crypto))
-
-    total_balance_fiat_before = gdax_balance_fiat + kraken_balance_fiat
-    total_balance_fiat_after = gdax_balance_fiat_after + kraken_balance_fiat_after
-    total_balance_crypto_before = gdax_balance_crypto + kraken_balance_crypto
-    total_balance_crypto_after = gdax_balance_crypto_after + kraken_balance_crypto_after
-    gain_fiat = total_balance_fiat_after - total_balance_fiat_before
-    gain_crypto = total_balance_crypto_after - total_balance_crypto_before
-    if arbitration_mode == BUY_KRAKEN_SELL_GDAX:
-        invested_fiat = kraken_balance_fiat - kraken_balance_fiat_after
-    else:
-        invested_fiat = gdax_balance_fiat - gdax_balance_fiat_after
-    relative_gain = gain_fiat / invested_fiat
-
-    logging.info("Total balance fiat: {:.2f} {}".format(total_balance_fiat_after, fiat))
-    logging.info("Total balance crypto: {:.4f} {}".format(total_balance_crypto_after, crypto))
-    logging.info("Gain in fiat: {:.2f} {} ({:.4f} %)".format(
-        gain_fiat, fiat, 100 * relative_gain))
-    logging.info("Gain in crypto: {:.4f} {}".format(gain_crypto, crypto))
-
-    if relative_gain < exp_relative_gains[arbitration_mode]:
-        logging.warning("WARNING: Actual gain was less than expected gain.")
-
-    # if ( relative_gain < 0 and exp_relative_gains[arbitration_mode] > 0 ) \
-    # or ( relative_gain < exp_relative_gains[arbitration_mode] ):
-    #     logging.error("ERROR: Lost {:.2f} {}.".format(-gain_fiat, fiat))
-    #     logging.error("Exiting")
-    #     sys.exit(1)
-    if ( relative_gain < 0 and relative_gain < (chosen_min_relative_gains[arbitration_mode] / safety_lower_gain_tolerance) ) \
-    or ( relative_gain >= 0 and relative_gain < (chosen_min_relative_gains[arbitration_mode] * safety_lower_gain_tolerance) ):
-        logging.warning("ERROR: Actual gain was far less than desired minimum gain.")
-        # logging.warning("Exiting")
-        # sys.exit(1)
-    elif relative_gain < chosen_min_relative_gains[arbitration_mode]:
-        logging.warning("WARNING: Actual gain was less than desired minimum gain.")
-
-    if abs(gain_crypto) > max_balance_deviation_crypto:
-        logging.error("ERROR: Difference in total crypto balance is too high.")
-        logging.error("Exiting")
-        sys.exit(1)
 
-    logging.info("Arbitration done.")
-    logging.info("Number of arbitrations done: {:d}".format(num_arbitrations))
+        if num_arbitrations >= max_num_arbitrations:
+            log.info("Stopping")
+            log.info("")
+            break
 
-    gain_fiat_since_begin = total_balance_fiat_after - total_balance_fiat_begin
-    logging.info("Total gain since start: {:.2f} {}".format(gain_fiat_since_begin, fiat))
-    logging.info("")
 
-    if gain_fiat_since_begin < - max_overall_fiat_loss:
-        logging.error("ERROR: Overall fiat loss is too high.")
-        logging.error("Exiting")
-        sys.exit(1)
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) > 0:
+        input_order_volume_crypto = float(argv[0])
+    else:
+        input_order_volume_crypto = None
+    run(input_order_volume_crypto)
+
 
-    if num_arbitrations >= max_num_arbitrations:
-        logging.info("Stopping")
-        logging.info("")
-        break
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,170 @@
 import time
+import concurrent.futures
+import numpy as np
 import ccxt
 
+import rate_limiter
+import metrics
+
+
+class OrderBookDepth(object):
+    # One side of an order book held as price and volume arrays (best price first).
+    # Level lookups for a target volume are done with a binary search on the cumulative volume.
+
+    def __init__(self, prices, volumes, missing_price):
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.volumes = np.asarray(volumes, dtype=np.float64)
+        # Price to report if the book does not have enough volume
+        self.missing_price = missing_price
+        self.acc_volumes = np.cumsum(self.volumes)
+        self.acc_costs = np.cumsum(self.prices * self.volumes)
+        # Cumulative volume and cost before each level
+        self.prev_acc_volumes = np.concatenate(([0.0], self.acc_volumes[:-1]))
+        self.prev_acc_costs = np.concatenate(([0.0], self.acc_costs[:-1]))
+
+    @classmethod
+    def from_levels(cls, levels, missing_price):
+        if len(levels) == 0:
+            return cls([], [], missing_price)
+        levels = np.asarray([level[:2] for level in levels], dtype=np.float64)
+        return cls(levels[:, 0], levels[:, 1], missing_price)
+
+    @property
+    def num_levels(self):
+        return len(self.prices)
+
+    @property
+    def total_volume(self):
+        if self.num_levels == 0:
+            return 0.0
+        return self.acc_volumes[-1]
+
+    def get_level_index(self, volume):
+        # Index of the first level where the cumulative volume reaches volume (num_levels if never)
+        return np.searchsorted(self.acc_volumes, volume, side="left")
+
+    def _take(self, values, index, default):
+        if self.num_levels == 0:
+            result = np.full(np.shape(index), default, dtype=np.float64)
+        else:
+            result = np.where(index < self.num_levels, values[np.minimum(index, self.num_levels - 1)], default)
+        if np.ndim(result) == 0:
+            return float(result)
+        return result
+
+    def get_worst_price(self, volume):
+        # Price of the last level that is needed to fill volume
+        return self._take(self.prices, self.get_level_index(volume), self.missing_price)
+
+    def get_acc_volume(self, volume):
+        # Cumulative volume up to and including the last level that is needed to fill volume
+        return self._take(self.acc_volumes, self.get_level_index(volume), 0.0)
+
+    def get_cost(self, volume):
+        # Fiat cost (excluding fees) of filling volume by walking the book. NaN if there is not enough volume.
+        volume = np.asarray(volume, dtype=np.float64)
+        index = self.get_level_index(volume)
+        prev_acc_costs = self._take(self.prev_acc_costs, index, np.nan)
+        prev_acc_volumes = self._take(self.prev_acc_volumes, index, np.nan)
+        prices = self._take(self.prices, index, np.nan)
+        return prev_acc_costs + (volume - prev_acc_volumes) * prices
+
+    def get_vwap(self, volume):
+        # Volume weighted average fill price of volume
+        volume = np.asarray(volume, dtype=np.float64)
+        index = self.get_level_index(volume)
+        costs = self.get_cost(volume)
+        worst_prices = self.get_worst_price(volume)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            vwaps = np.where(volume > 0, costs / volume, worst_prices)
+        vwaps = np.where(index < self.num_levels, vwaps, self.missing_price)
+        if np.ndim(vwaps) == 0:
+            return float(vwaps)
+        return vwaps
+
+
+def get_order_book_depths(ob):
+    ask_depth = OrderBookDepth.from_levels(ob['asks'], float("inf"))
+    bid_depth = OrderBookDepth.from_levels(ob['bids'], 0.0)
+    return ask_depth, bid_depth
+
+
+def get_max_buy_volume(ask_depth, buy_fee, max_fiat):
+    # Largest volume whose buy cost (including fees) stays within max_fiat
+    if ask_depth.num_levels == 0:
+        return 0.0
+    fee_factor = 1 + buy_fee
+    index = np.searchsorted(ask_depth.acc_costs * fee_factor, max_fiat, side="left")
+    if index >= ask_depth.num_levels:
+        return float(ask_depth.total_volume)
+    remaining_fiat = max_fiat - ask_depth.prev_acc_costs[index] * fee_factor
+    return float(ask_depth.prev_acc_volumes[index] + remaining_fiat / (ask_depth.prices[index] * fee_factor))
+
+
+def solve_order_volume(ask_depth, buy_fee, bid_depth, sell_fee,
+                       max_volume=float("inf"), max_balance_fiat=float("inf"), max_balance_crypto=float("inf"),
+                       buy_safety_factor_fiat=1.0):
+    # Find the volume that maximizes the expected fiat gain of buying on the ask side of one exchange
+    # and selling on the bid side of another exchange.
+    # The gain is piecewise linear in the volume and concave (the marginal gain can only decrease while
+    # walking both books) so the optimum is at one of the level boundaries of either book or at the
+    # volume limit.
+    volume_limit = min(max_volume, max_balance_crypto, ask_depth.total_volume, bid_depth.total_volume,
+                       get_max_buy_volume(ask_depth, buy_fee, max_balance_fiat / buy_safety_factor_fiat))
+    volume_limit = max(volume_limit, 0.0)
+    volumes = np.union1d(ask_depth.acc_volumes, bid_depth.acc_volumes)
+    volumes = volumes[volumes < volume_limit]
+    volumes = np.concatenate(([0.0], volumes, [volume_limit]))
+    buy_volumes_fiat = ask_depth.get_cost(volumes) * (1 + buy_fee)
+    sell_volumes_fiat = bid_depth.get_cost(volumes) * (1 - sell_fee)
+    gains_fiat = sell_volumes_fiat - buy_volumes_fiat
+    gains_fiat[0] = 0.0
+    # Marginal gain per unit of crypto on each segment between two consecutive volumes
+    volume_steps = np.diff(volumes)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        marginal_gains = np.where(volume_steps > 0, np.diff(gains_fiat) / volume_steps, 0.0)
+    best_index = int(np.argmax(gains_fiat))
+    volume = float(volumes[best_index])
+    gain_fiat = float(gains_fiat[best_index])
+    buy_volume_fiat = float(buy_volumes_fiat[best_index]) if best_index > 0 else 0.0
+    relative_gain = gain_fiat / buy_volume_fiat if buy_volume_fiat > 0 else 0.0
+    return {
+        "volume": volume,
+        "gain_fiat": gain_fiat,
+        "relative_gain": relative_gain,
+        "buy_volume_fiat": buy_volume_fiat,
+        "volume_limit": volume_limit,
+        "volumes": volumes,
+        "gains_fiat": gains_fiat,
+        "marginal_gains": marginal_gains,
+    }
+
+
 def get_acc_asks_bids(ob):
-    acc_asks = []
-    acc_volume = 0
-    for price, volume in ob['asks']:
-        acc_volume += volume
-        acc_asks.append((price, acc_volume))
-    acc_bids = []
-    acc_volume = 0
-    for price, volume in ob['bids']:
-        acc_volume += volume
-        acc_bids.append((price, acc_volume))
+    ask_depth, bid_depth = get_order_book_depths(ob)
+    acc_asks = list(zip(ask_depth.prices.tolist(), ask_depth.acc_volumes.tolist()))
+    acc_bids = list(zip(bid_depth.prices.tolist(), bid_depth.acc_volumes.tolist()))
     return acc_asks, acc_bids
 
 
-def get_conservative_ask_bid_price(ob, min_volume):
-    acc_asks, acc_bids = get_acc_asks_bids(ob)
-    ask_price = float("inf")
-    ask_volume = 0.0
-    for price, acc_volume in acc_asks:
-        if acc_volume >= min_volume:
-            ask_price = price
-            ask_volume = acc_volume
-            break
-    bid_price = 0
-    bid_volume = 0.0
-    for price, acc_volume in acc_bids:
-        if acc_volume >= min_volume:
-            bid_price = price
-            bid_volume = acc_volume
-            break
+def get_conservative_ask_bid_price(ob, min_volume, depths=None):
+    if depths is None:
+        depths = get_order_book_depths(ob)
+    ask_depth, bid_depth = depths
+    ask_price = ask_depth.get_worst_price(min_volume)
+    ask_volume = ask_depth.get_acc_volume(min_volume)
+    bid_price = bid_depth.get_worst_price(min_volume)
+    bid_volume = bid_depth.get_acc_volume(min_volume)
     return ask_price, ask_volume, bid_price, bid_volume
 
 
+def get_vwap_ask_bid_price(ob, volume, depths=None):
+    if depths is None:
+        depths = get_order_book_depths(ob)
+    ask_depth, bid_depth = depths
+    return ask_depth.get_vwap(volume), bid_depth.get_vwap(volume)
+
+
 def retry(request_fn, *args, **kwargs):
     if "_max_trials" in kwargs:
         max_trials = kwargs["_max_trials"]
@@ -55,7 +186,23 @@ def retry(request_fn, *args, **kwargs):
         del kwargs["_retry_exception_types"]
     else:
         retry_exception_types = ccxt.BaseError
+    if "_endpoint" in kwargs:
+        endpoint = kwargs["_endpoint"]
+        del kwargs["_endpoint"]
+    else:
+        endpoint = getattr(request_fn, "__name__", None)
+    venue = getattr(getattr(request_fn, "__self__", None), "id", None)
+    if "_rate_limiter" in kwargs:
+        limiter = kwargs["_rate_limiter"]
+        del kwargs["_rate_limiter"]
+    else:
+        # The shared limiter of the exchange the method belongs to (if its limits are known)
+        limiter = rate_limiter.get_rate_limiter(venue)
+    if limiter is not None:
+        # The limiter spaces the calls of all callers, so no extra spacing between trials of this call
+        rate_limit = 0
     num_trials = 0
+    num_failures = 0
     last_trial_time = -float("inf")
     while True:
         now = time.time()
@@ -67,9 +214,90 @@ def retry(request_fn, *args, **kwargs):
                 return None
             if max_trials is not None and num_trials > max_trials:
                 return None
+            if limiter is not None and not limiter.acquire(endpoint, deadline=max_time):
+                return None
             last_trial_time = time.time()
             result = request_fn(*args, **kwargs)
         except retry_exception_types as err:
-            print("Error on ccxt request: {}. Trying again.".format(err))
+            num_failures += 1
+            metrics.REGISTRY.inc("api_request_failures_total", venue=venue or "unknown")
+            if limiter is not None:
+                if isinstance(err, ccxt.DDoSProtection):
+                    limiter.penalize(endpoint)
+                backoff_time = limiter.get_backoff_time(num_failures)
+            else:
+                backoff_time = rate_limiter.get_backoff_time(num_failures)
+            if max_trials is not None and num_trials >= max_trials:
+                backoff_time = 0.0
+            elif max_time is not None:
+                backoff_time = min(backoff_time, max(max_time - time.time(), 0.0))
+            print("Error on ccxt request: {}. Trying again in {:.2f} s.".format(err, backoff_time))
+            time.sleep(backoff_time)
             continue
         return result
+
+
+_order_book_executor = None
+
+
+def get_order_book_executor(max_workers=8):
+    # Shared thread pool so that we don't pay for thread creation on every iteration
+    global _order_book_executor
+    if _order_book_executor is None:
+        _order_book_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="order_book_fetch")
+    return _order_book_executor
+
+
+def fetch_order_book_snapshot(exchange, symbol, *args, **kwargs):
+    request_time = time.time()
+    order_book = retry(exchange.fetchL2OrderBook, symbol, *args, **kwargs)
+    response_time = time.time()
+    return {
+        "symbol": symbol,
+        "order_book": order_book,
+        "request_time": request_time,
+        "response_time": response_time,
+    }
+
+
+def fetch_order_books(exchanges, symbol, *args, **kwargs):
+    # Fetch the order books of all exchanges (a dict of name -> ccxt exchange) in parallel.
+    # Every snapshot is tagged with its request and response time.
+    if "_executor" in kwargs:
+        executor = kwargs["_executor"]
+        del kwargs["_executor"]
+    else:
+        executor = get_order_book_executor()
+    futures = {}
+    for name, exchange in exchanges.items():
+        futures[name] = executor.submit(fetch_order_book_snapshot, exchange, symbol, *args, **kwargs)
+    snapshots = {}
+    for name, future in futures.items():
+        snapshots[name] = future.result()
+    return snapshots
+
+
+def fetch_tickers(exchanges, symbols, *args, **kwargs):
+    # Fetch the tickers of the given symbols (a dict of exchange name -> list of symbols) in parallel
+    if "_executor" in kwargs:
+        executor = kwargs["_executor"]
+        del kwargs["_executor"]
+    else:
+        executor = get_order_book_executor()
+    futures = {}
+    for name, exchange in exchanges.items():
+        for symbol in symbols.get(name, []):
+            futures[(name, symbol)] = executor.submit(retry, exchange.fetchTicker, symbol, *args, **kwargs)
+    tickers = {}
+    for key, future in futures.items():
+        tickers[key] = future.result()
+    return tickers
+
+
+def get_snapshot_skew(*snapshots):
+    # Upper bound on the time between the order books of the given snapshots.
+    # The exchange can have taken each snapshot anywhere between request and response.
+    request_time = min(snapshot["request_time"] for snapshot in snapshots)
+    response_time = max(snapshot["response_time"] for snapshot in snapshots)
+    return response_time - request_time
@@ -0,0 +1,186 @@
+import math
+import numpy as np
+
+
+class CurrencyGraph(object):
+    # Directed graph over (exchange, currency) nodes.
+    # Every market on an exchange gives two edges (buy and sell) and every currency that is held on
+    # more than one exchange gives transfer edges between the exchanges.
+    # Edge weights are -log(rate) so that a profitable cycle is a negative cycle.
+    # When a book changes only the edges of its market are updated and only cycles through
+    # these edges are searched.
+
+    def __init__(self, max_cycle_length=4, min_profit=0.0):
+        self.max_cycle_length = max_cycle_length
+        self.min_profit = min_profit
+        self.nodes = []
+        self.node_indices = {}
+        self.edge_src = np.zeros(0, dtype=np.int64)
+        self.edge_dst = np.zeros(0, dtype=np.int64)
+        self.edge_weights = np.zeros(0, dtype=np.float64)
+        self.edge_infos = []
+        self.market_edges = {}
+        self.fees = {}
+
+    @property
+    def num_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_infos)
+
+    def get_node_index(self, exchange_name, currency):
+        key = (exchange_name, currency)
+        if key not in self.node_indices:
+            self.node_indices[key] = len(self.nodes)
+            self.nodes.append(key)
+        return self.node_indices[key]
+
+    def _add_edge(self, src, dst, info):
+        self.edge_src = np.append(self.edge_src, src)
+        self.edge_dst = np.append(self.edge_dst, dst)
+        # Edges without a price yet can never be part of a cycle
+        self.edge_weights = np.append(self.edge_weights, np.inf)
+        self.edge_infos.append(info)
+        return self.num_edges - 1
+
+    def add_market(self, exchange_name, symbol, fee):
+        base, quote = symbol.split("/")
+        base_index = self.get_node_index(exchange_name, base)
+        quote_index = self.get_node_index(exchange_name, quote)
+        buy_edge = self._add_edge(quote_index, base_index, {"type": "buy", "exchange": exchange_name, "symbol": symbol})
+        sell_edge = self._add_edge(base_index, quote_index, {"type": "sell", "exchange": exchange_name, "symbol": symbol})
+        self.market_edges[(exchange_name, symbol)] = (buy_edge, sell_edge)
+        self.fees[(exchange_name, symbol)] = fee
+
+    def add_transfer(self, src_exchange_name, dst_exchange_name, currency, fee=0.0):
+        src = self.get_node_index(src_exchange_name, currency)
+        dst = self.get_node_index(dst_exchange_name, currency)
+        edge = self._add_edge(src, dst, {"type": "transfer", "exchange": src_exchange_name,
+                                         "dst_exchange": dst_exchange_name, "currency": currency})
+        self.edge_weights[edge] = -math.log(1 - fee)
+        return edge
+
+    def add_exchange_markets(self, exchange_name, markets, currencies=None):
+        # Add all markets of a ccxt exchange (as returned by loadMarkets) whose currencies are in currencies
+        for symbol, market in markets.items():
+            if "/" not in symbol:
+                continue
+            base, quote = symbol.split("/")
+            if currencies is not None and (base not in currencies or quote not in currencies):
+                continue
+            fee = max(market.get("maker") or 0.0, market.get("taker") or 0.0)
+            self.add_market(exchange_name, symbol, fee)
+
+    def add_all_transfers(self, fee=0.0):
+        currency_exchanges = {}
+        for exchange_name, currency in self.nodes:
+            currency_exchanges.setdefault(currency, []).append(exchange_name)
+        for currency, exchange_names in currency_exchanges.items():
+            for src_exchange_name in exchange_names:
+                for dst_exchange_name in exchange_names:
+                    if src_exchange_name != dst_exchange_name:
+                        self.add_transfer(src_exchange_name, dst_exchange_name, currency, fee)
+
+    def update_market(self, exchange_name, symbol, ask_price, bid_price):
+        # Update the edges of a market and return the indices of edges whose weight decreased.
+        # Only these edges can have created a new negative cycle.
+        buy_edge, sell_edge = self.market_edges[(exchange_name, symbol)]
+        fee_factor = 1 - self.fees[(exchange_name, symbol)]
+        new_weights = {
+            buy_edge: -math.log(fee_factor / ask_price) if ask_price > 0 and math.isfinite(ask_price) else np.inf,
+            sell_edge: -math.log(fee_factor * bid_price) if bid_price > 0 and math.isfinite(bid_price) else np.inf,
+        }
+        decreased_edges = []
+        for edge, weight in new_weights.items():
+            if weight < self.edge_weights[edge]:
+                decreased_edges.append(edge)
+            self.edge_weights[edge] = weight
+        return decreased_edges
+
+    def update_market_from_order_book(self, exchange_name, symbol, ob):
+        ask_price = ob["asks"][0][0] if len(ob["asks"]) > 0 else np.inf
+        bid_price = ob["bids"][0][0] if len(ob["bids"]) > 0 else 0.0
+        return self.update_market(exchange_name, symbol, ask_price, bid_price)
+
+    def _shortest_paths(self, src, num_rounds):
+        # Layered Bellman-Ford from src: distances[k][node] is the shortest distance using exactly k + 1 edges
+        distances = []
+        predecessors = []
+        dist = np.full(self.num_nodes, np.inf)
+        dist[src] = 0.0
+        for _ in range(num_rounds):
+            candidates = dist[self.edge_src] + self.edge_weights
+            new_dist = np.full(self.num_nodes, np.inf)
+            np.minimum.at(new_dist, self.edge_dst, candidates)
+            pred = np.full(self.num_nodes, -1, dtype=np.int64)
+            best = np.isfinite(candidates) & (candidates == new_dist[self.edge_dst])
+            pred[self.edge_dst[best]] = np.nonzero(best)[0]
+            distances.append(new_dist)
+            predecessors.append(pred)
+            dist = new_dist
+        return distances, predecessors
+
+    def _get_cycle(self, edge, path_length, predecessors):
+        # Walk back from the source node of edge to the destination node of edge
+        edges = [edge]
+        node = self.edge_src[edge]
+        for k in range(path_length - 1, -1, -1):
+            path_edge = predecessors[k][node]
+            if path_edge < 0:
+                return None
+            edges.append(path_edge)
+            node = self.edge_src[path_edge]
+        if node != self.edge_dst[edge]:
+            return None
+        edges.reverse()
+        nodes = [self.edge_src[e] for e in edges]
+        if len(set(nodes)) != len(nodes):
+            return None
+        return edges
+
+    def _make_cycle(self, edges):
+        weight = float(np.sum(self.edge_weights[edges]))
+        return {
+            "edges": [self.edge_infos[e] for e in edges],
+            "nodes": [self.nodes[self.edge_src[e]] for e in edges],
+            "profit": math.exp(-weight) - 1,
+        }
+
+    def find_cycles_through_edges(self, edges):
+        # Profitable cycles that contain at least one of the given edges
+        cycles = []
+        seen = set()
+        for edge in edges:
+            if not np.isfinite(self.edge_weights[edge]):
+                continue
+            distances, predecessors = self._shortest_paths(self.edge_dst[edge], self.max_cycle_length - 1)
+            for path_length in range(1, self.max_cycle_length):
+                total_weight = distances[path_length - 1][self.edge_src[edge]] + self.edge_weights[edge]
+                if total_weight >= -math.log1p(self.min_profit) or not np.isfinite(total_weight):
+                    continue
+                cycle_edges = self._get_cycle(edge, path_length, predecessors)
+                if cycle_edges is None:
+                    continue
+                key = frozenset(cycle_edges)
+                if key in seen:
+                    continue
+                seen.add(key)
+                cycles.append(self._make_cycle(cycle_edges))
+        cycles.sort(key=lambda cycle: -cycle["profit"])
+        return cycles
+
+    def find_all_cycles(self):
+        # Full scan over all edges (e.g. after the graph was built)
+        return self.find_cycles_through_edges(range(self.num_edges))
+
+
+def format_cycle(cycle):
+    steps = []
+    for info in cycle["edges"]:
+        if info["type"] == "transfer":
+            steps.append("transfer {} {}->{}".format(info["currency"], info["exchange"], info["dst_exchange"]))
+        else:
+            steps.append("{} {} on {}".format(info["type"], info["symbol"], info["exchange"]))
+    return "{:.4f} %: {}".format(100 * cycle["profit"], " -> ".join(steps))
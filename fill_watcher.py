@@ -0,0 +1,149 @@
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+
+
+# Order states after which an order won't change anymore (ccxt unified status)
+FINAL_ORDER_STATES = ("closed", "canceled", "expired")
+
+
+def is_order_final(order_info):
+    return order_info is not None and order_info.get("status") in FINAL_ORDER_STATES
+
+
+class WatchedOrder(object):
+
+    def __init__(self, key, fetch_fn, submit_time):
+        self.key = key
+        self.fetch_fn = fetch_fn
+        self.submit_time = submit_time
+        self.next_poll_time = submit_time
+        self.future = None
+        self.order_info = None
+        self.done = False
+        self.done_time = None
+        self.num_polls = 0
+
+
+class FillWatcher(object):
+    # Tracks orders until they are final.
+    # All orders are polled concurrently on a thread pool. An order is polled quickly right after
+    # submission and less often as it gets older: the interval is age_factor * age, bounded by
+    # min_interval and max_interval. Updates from a private order stream can be pushed with push() and
+    # wake up wait() immediately, so a pushed final state doesn't wait for the next poll.
+
+    def __init__(self, min_interval=0.2, max_interval=2.0, age_factor=0.25, max_workers=4):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.age_factor = age_factor
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.orders = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.update_event = threading.Event()
+        self._pushed = {}
+        self.num_polls = 0
+        self.num_poll_errors = 0
+        self.num_pushes = 0
+
+    def add(self, key, fetch_fn, submit_time=None):
+        # fetch_fn returns the ccxt order info (or None if the request failed)
+        if submit_time is None:
+            submit_time = time.time()
+        with self.lock:
+            self.orders[key] = WatchedOrder(key, fetch_fn, submit_time)
+            pushed_info = self._pushed.pop(key, None)
+        if pushed_info is not None:
+            self.push(key, pushed_info)
+
+    def push(self, key, order_info):
+        # Can be called from any thread. Updates for orders that are not added yet are kept until add().
+        with self.lock:
+            self.num_pushes += 1
+            order = self.orders.get(key)
+            if order is None:
+                self._pushed[key] = order_info
+                return
+            self._update(order, order_info)
+        self.update_event.set()
+
+    def clear(self):
+        with self.lock:
+            self.orders.clear()
+            self._pushed.clear()
+
+    def get_poll_interval(self, age):
+        return min(self.max_interval, max(self.min_interval, self.age_factor * age))
+
+    def _update(self, order, order_info):
+        if order.done or order_info is None:
+            return
+        order.order_info = order_info
+        if is_order_final(order_info):
+            order.done = True
+            order.done_time = time.time()
+
+    def _poll(self, order):
+        order_info = order.fetch_fn()
+        with self.lock:
+            self.num_polls += 1
+            order.num_polls += 1
+            if order_info is None:
+                self.num_poll_errors += 1
+            self._update(order, order_info)
+        return order_info
+
+    def _start_polls(self, now):
+        for order in self.orders.values():
+            if order.done or order.future is not None or order.next_poll_time > now:
+                continue
+            order.future = self.executor.submit(self._poll, order)
+            order.future.add_done_callback(lambda future: self.update_event.set())
+
+    def _finish_polls(self, now):
+        for order in self.orders.values():
+            if order.future is None or not order.future.done():
+                continue
+            err = order.future.exception()
+            if err is not None:
+                with self.lock:
+                    self.num_poll_errors += 1
+                logging.warning("Polling order {} failed: {}".format(order.key, err))
+            order.future = None
+            order.next_poll_time = now + self.get_poll_interval(now - order.submit_time)
+
+    def wait(self, timeout=None, on_done=None):
+        # Wait until all orders are final (or the timeout passed).
+        # on_done(key, order_info) is called on the calling thread once for each order that became final.
+        # Returns the latest order info of all orders by key.
+        start_time = time.time()
+        reported = set()
+        while True:
+            now = time.time()
+            self._finish_polls(now)
+            with self.lock:
+                done_orders = [order for order in self.orders.values() if order.done and order.key not in reported]
+                all_done = all(order.done for order in self.orders.values())
+            for order in done_orders:
+                reported.add(order.key)
+                if on_done is not None:
+                    on_done(order.key, order.order_info)
+            if all_done:
+                break
+            if timeout is not None and now - start_time >= timeout:
+                break
+            self._start_polls(now)
+            next_times = [order.next_poll_time for order in self.orders.values()
+                          if not order.done and order.future is None]
+            wait_time = max(min(next_times) - now, 0.0) if next_times else self.max_interval
+            if timeout is not None:
+                wait_time = min(wait_time, max(start_time + timeout - now, 0.0))
+            self.update_event.wait(wait_time)
+            self.update_event.clear()
+        return collections.OrderedDict((key, order.order_info) for key, order in self.orders.items())
+
+    def get_fill_times(self):
+        # Time from submission until the order was seen final (None while it is open)
+        return {key: order.done_time - order.submit_time if order.done else None
+                for key, order in self.orders.items()}
@@ -0,0 +1,188 @@
+import os
+import time
+import queue
+import struct
+import logging
+import datetime
+import threading
+
+
+# Binary records: timestamp and number of values followed by the values (all little-endian)
+BINARY_HEADER = struct.Struct("<dI")
+
+
+def format_text_record(timestamp, values):
+    iso_time = datetime.datetime.fromtimestamp(timestamp).isoformat()
+    return "{:s} {}\n".format(iso_time, " ".join("{:f}".format(value) for value in values)).encode("utf-8")
+
+
+def format_binary_record(timestamp, values):
+    return BINARY_HEADER.pack(timestamp, len(values)) + struct.pack("<{:d}d".format(len(values)), *values)
+
+
+def read_binary_records(filename):
+    # List of (timestamp, values) of a binary gains log (an incomplete last record is ignored)
+    records = []
+    with open(filename, "rb") as fin:
+        data = fin.read()
+    offset = 0
+    while offset + BINARY_HEADER.size <= len(data):
+        timestamp, num_values = BINARY_HEADER.unpack_from(data, offset)
+        end = offset + BINARY_HEADER.size + 8 * num_values
+        if end > len(data):
+            break
+        values = struct.unpack_from("<{:d}d".format(num_values), data, offset + BINARY_HEADER.size)
+        records.append((timestamp, list(values)))
+        offset = end
+    return records
+
+
+class GainsLogWriter(object):
+    # Appends one record per loop iteration to the gains log on a background thread.
+    # write() only puts the record on a bounded queue and never blocks. If the queue is full the record
+    # is dropped and counted. The writer thread collects records for flush_interval and writes them with a
+    # single flush, so a slow disk costs one write per batch instead of one open/write/close per record.
+    # The file is rotated when it exceeds max_bytes (keeping backup_count old files as .1, .2, ...)
+    # and/or on each new (local) day when rotate_daily is set.
+
+    def __init__(self, filename, binary=False, max_queue_size=10000, flush_interval=1.0,
+                 max_bytes=None, backup_count=5, rotate_daily=False, backpressure_ratio=0.75):
+        self.filename = filename
+        self.binary = binary
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_daily = rotate_daily
+        self.backpressure_size = int(backpressure_ratio * max_queue_size)
+        self.queue = queue.Queue(max_queue_size)
+        self.num_written = 0
+        self.num_dropped = 0
+        self.num_backpressure = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.num_rotations = 0
+        self.last_error = None
+        self._file = None
+        self._file_day = None
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="gains_log_writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, timestamp, values):
+        # Called from the loop thread
+        if self.queue.qsize() >= self.backpressure_size:
+            self.num_backpressure += 1
+        try:
+            self.queue.put_nowait((timestamp, values))
+            return True
+        except queue.Full:
+            self.num_dropped += 1
+            return False
+
+    def get_stats(self):
+        return {
+            "written": self.num_written,
+            "dropped": self.num_dropped,
+            "backpressure": self.num_backpressure,
+            "queued": self.queue.qsize(),
+            "batches": self.num_batches,
+            "errors": self.num_errors,
+            "rotations": self.num_rotations,
+            "last_error": self.last_error,
+        }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return "written {:d}, dropped {:d}, backpressure {:d}, queued {:d}, errors {:d}".format(
+            stats["written"], stats["dropped"], stats["backpressure"], stats["queued"], stats["errors"])
+
+    def close(self, timeout=5.0):
+        # Write all queued records and stop the writer thread
+        self._stop = True
+        self._thread.join(timeout)
+
+    def _format(self, timestamp, values):
+        if self.binary:
+            return format_binary_record(timestamp, values)
+        return format_text_record(timestamp, values)
+
+    def _get_day_filename(self, day):
+        return "{}.{}".format(self.filename, day)
+
+    def _rotate_by_size(self):
+        for index in range(self.backup_count - 1, 0, -1):
+            source = "{}.{:d}".format(self.filename, index)
+            if os.path.exists(source):
+                os.replace(source, "{}.{:d}".format(self.filename, index + 1))
+        if self.backup_count > 0:
+            os.replace(self.filename, "{}.1".format(self.filename))
+        else:
+            os.remove(self.filename)
+
+    def _open(self, timestamp):
+        # Open the log file for a record and rotate it first if needed
+        day = datetime.date.fromtimestamp(timestamp).isoformat()
+        if self._file is None:
+            self._file = open(self.filename, "ab")
+            # A file from an earlier run belongs to the day it was last written
+            if self._file.tell() > 0:
+                self._file_day = datetime.date.fromtimestamp(os.path.getmtime(self.filename)).isoformat()
+            else:
+                self._file_day = day
+        new_day = self.rotate_daily and day != self._file_day
+        too_large = self.max_bytes is not None and self._file.tell() >= self.max_bytes
+        if not new_day and not too_large:
+            return
+        self._file.close()
+        self._file = None
+        if new_day:
+            os.replace(self.filename, self._get_day_filename(self._file_day))
+        else:
+            self._rotate_by_size()
+        self.num_rotations += 1
+        self._file = open(self.filename, "ab")
+        self._file_day = day
+
+    def _write_batch(self, records):
+        # Records go to the buffered file object and hit the disk with the flush at the end
+        for timestamp, values in records:
+            self._open(timestamp)
+            self._file.write(self._format(timestamp, values))
+        self._file.flush()
+
+    def _run(self):
+        while True:
+            records = []
+            try:
+                records.append(self.queue.get(timeout=self.flush_interval))
+                # Collect records for up to flush_interval and write them in one go
+                deadline = time.time() + self.flush_interval
+                while not self._stop and time.time() < deadline:
+                    records.append(self.queue.get(timeout=max(deadline - time.time(), 0.0)))
+            except queue.Empty:
+                pass
+            try:
+                while True:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if records:
+                try:
+                    self._write_batch(records)
+                    self.num_written += len(records)
+                    self.num_batches += 1
+                except Exception as err:
+                    self.num_errors += 1
+                    self.last_error = "{}".format(err)
+                    logging.warning("Unable to write gains log ({}).".format(err))
+                    if self._file is not None:
+                        try:
+                            self._file.close()
+                        except Exception:
+                            pass
+                        self._file = None
+            elif self._stop:
+                break
+        if self._file is not None:
+            self._file.close()
@@ -10,17 +10,20 @@ def read_keys_from_file(filename):
     return api_key, api_secret, passphrase
 
 
-def create_client_from_file(filename):
+def create_client_from_file(filename, session=None):
 	with open(filename, "r") as fin:
 		passphrase = fin.readline().strip()
 		api_key = fin.readline().strip()
 		api_secret = fin.readline().strip()
-	return create_client(api_key, api_secret, passphrase)
+	return create_client(api_key, api_secret, passphrase, session)
 
 
-def create_client(api_key, api_secret, passphrase):
+def create_client(api_key, api_secret, passphrase, session=None):
 	import gdax
 	client = gdax.AuthenticatedClient(api_key, api_secret, passphrase)
+	# Clients of gdax versions with a requests session can share the session of the venue
+	if session is not None and hasattr(client, "session"):
+		client.session = session
 	return client
 
 
@@ -0,0 +1,142 @@
+import time
+import socket
+import threading
+import requests
+import requests.adapters
+import urllib3.util
+
+
+# Default (connect timeout, read timeout) in seconds
+DEFAULT_TIMEOUT = (3.05, 10.0)
+
+# Socket options of pooled connections: no Nagle delay for small requests and TCP keep-alive probes,
+# so idle connections are not silently dropped by NAT and load balancers between two arbitrages
+SOCKET_OPTIONS = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for _option_name, _value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+    if hasattr(socket, _option_name):
+        SOCKET_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, _option_name), _value))
+
+
+class VenueHTTPAdapter(requests.adapters.HTTPAdapter):
+    # Keep-alive connection pool of one venue.
+    # The timeout of a request is chosen by its URL path: endpoint_timeouts is a list of
+    # (path substring, timeout) and the first match wins. Requests without a match use the timeout of
+    # the caller or default_timeout. A timeout is a number or a (connect, read) tuple.
+
+    def __init__(self, endpoint_timeouts=None, default_timeout=DEFAULT_TIMEOUT, pool_maxsize=8, **kwargs):
+        self.endpoint_timeouts = list(endpoint_timeouts or [])
+        self.default_timeout = default_timeout
+        self.stats_lock = threading.Lock()
+        self.num_sends = 0
+        self.num_errors = 0
+        self.send_time = 0.0
+        self.endpoint_send_times = {}
+        requests.adapters.HTTPAdapter.__init__(self, pool_connections=1, pool_maxsize=pool_maxsize, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = SOCKET_OPTIONS
+        requests.adapters.HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+
+    def get_endpoint(self, url):
+        path = urllib3.util.parse_url(url).path or "/"
+        for pattern, _ in self.endpoint_timeouts:
+            if pattern in path:
+                return pattern
+        return None
+
+    def get_timeout(self, url, timeout=None):
+        endpoint = self.get_endpoint(url)
+        if endpoint is not None:
+            return dict(self.endpoint_timeouts)[endpoint]
+        if timeout is None:
+            return self.default_timeout
+        return timeout
+
+    def send(self, request, timeout=None, **kwargs):
+        endpoint = self.get_endpoint(request.url)
+        start_time = time.time()
+        try:
+            return requests.adapters.HTTPAdapter.send(
+                self, request, timeout=self.get_timeout(request.url, timeout), **kwargs)
+        except Exception:
+            with self.stats_lock:
+                self.num_errors += 1
+            raise
+        finally:
+            send_time = time.time() - start_time
+            with self.stats_lock:
+                self.num_sends += 1
+                self.send_time += send_time
+                num_endpoint_sends, endpoint_send_time = self.endpoint_send_times.get(endpoint, (0, 0.0))
+                self.endpoint_send_times[endpoint] = (num_endpoint_sends + 1, endpoint_send_time + send_time)
+
+    def get_pool_stats(self):
+        # Requests and new connections (each one a TCP and TLS handshake) of all connection pools
+        num_requests = 0
+        num_connections = 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        return num_requests, num_connections
+
+
+class VenueSession(requests.Session):
+    # requests session of one venue with a VenueHTTPAdapter for http and https
+
+    def __init__(self, name, endpoint_timeouts=None, default_timeout=DEFAULT_TIMEOUT, pool_maxsize=8):
+        requests.Session.__init__(self)
+        self.name = name
+        self.adapter = VenueHTTPAdapter(endpoint_timeouts, default_timeout, pool_maxsize)
+        self.mount("https://", self.adapter)
+        self.mount("http://", self.adapter)
+
+    def get_stats(self):
+        num_requests, num_connections = self.adapter.get_pool_stats()
+        with self.adapter.stats_lock:
+            num_sends = self.adapter.num_sends
+            num_errors = self.adapter.num_errors
+            send_time = self.adapter.send_time
+        return {
+            "num_requests": num_requests,
+            "num_connections": num_connections,
+            "num_reused": max(num_requests - num_connections, 0),
+            "reuse_ratio": 1.0 - float(num_connections) / num_requests if num_requests > 0 else 0.0,
+            "num_errors": num_errors,
+            "mean_send_time": send_time / num_sends if num_sends > 0 else 0.0,
+        }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return "{:d} requests, {:d} connections ({:.1f} % reused), {:d} errors, {:.1f} ms per request".format(
+            stats["num_requests"], stats["num_connections"], 100 * stats["reuse_ratio"], stats["num_errors"],
+            1000 * stats["mean_send_time"])
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(name, endpoint_timeouts=None, default_timeout=DEFAULT_TIMEOUT, pool_maxsize=8):
+    # The shared session of a venue. The settings are only used when the session is created.
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = VenueSession(name, endpoint_timeouts, default_timeout, pool_maxsize)
+        return _sessions[name]
+
+
+def get_sessions():
+    with _sessions_lock:
+        return dict(_sessions)
+
+
+def use_session(client, session):
+    # Let a ccxt exchange, krakenex.API or gdax client send its requests through session.
+    # Returns False for clients without a requests session (e.g. old gdax clients call requests.get directly).
+    if not hasattr(client, "session"):
+        return False
+    client.session = session
+    return True
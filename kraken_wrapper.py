@@ -3,6 +3,9 @@ import requests.exceptions
 import urllib3.exceptions
 import krakenex
 
+import rate_limiter
+import metrics
+
 
 CURRENCY_ASSET_DICT = {
     "EUR": "ZEUR",
@@ -19,9 +22,12 @@ def read_keys_from_file(filename):
     return api_key, api_secret, passphrase
 
 
-def create_client_from_file(filename):
+def create_client_from_file(filename, session=None):
+    # session: requests session to send through (e.g. the one shared with ccxt, see http_transport.py)
     kraken_client = krakenex.API()
     kraken_client.load_key(filename)
+    if session is not None:
+        kraken_client.session = session
     return kraken_client
 
 
@@ -55,8 +61,15 @@ def retry_on_error(request_fn, *args, **kwargs):
         del kwargs["_max_time"]
     else:
         max_time = None
-    success = False
+    if "_rate_limiter" in kwargs:
+        limiter = kwargs["_rate_limiter"]
+        del kwargs["_rate_limiter"]
+    else:
+        limiter = rate_limiter.get_rate_limiter("kraken")
+    # request_fn is query_public or query_private with the API method as first argument
+    endpoint = args[0] if len(args) > 0 else kwargs.get("method")
     num_trials = 0
+    num_failures = 0
     while True:
         try:
             num_trials += 1
@@ -64,6 +77,8 @@ def retry_on_error(request_fn, *args, **kwargs):
                 return None
             if max_trials is not None and num_trials > max_trials:
                 return None
+            if limiter is not None and not limiter.acquire(endpoint, deadline=max_time):
+                return None
             result = None
             response = request_fn(*args, **kwargs)
             if "error" in response:
@@ -82,8 +97,21 @@ def retry_on_error(request_fn, *args, **kwargs):
         except ConnectionResetError as exc:
             error = [exc]
         if len(error) > 0:
+            num_failures += 1
+            metrics.REGISTRY.inc("api_request_failures_total", venue="kraken")
+            if limiter is not None:
+                if any("Rate limit exceeded" in str(err) for err in error):
+                    limiter.penalize(endpoint)
+                backoff_time = limiter.get_backoff_time(num_failures)
+            else:
+                backoff_time = rate_limiter.get_backoff_time(num_failures)
+            if max_trials is not None and num_trials >= max_trials:
+                backoff_time = 0.0
+            elif max_time is not None:
+                backoff_time = min(backoff_time, max(max_time - time.time(), 0.0))
             print("Error on Kraken request: {}".format(error))
-            print("Trying again")
+            print("Trying again in {:.2f} s".format(backoff_time))
+            time.sleep(backoff_time)
             continue
         assert len(error) == 0, "Errors during query: {}".format(error)
         return result
@@ -0,0 +1,135 @@
+import time
+import logging
+import concurrent.futures
+
+
+# Ways to resolve an arbitrage where only some legs went through, applied in the configured order until
+# one of them resolves it:
+#   "retry": submit the failed legs again until the deadline
+#   "cancel": cancel the live legs (legs that were partially filled still need a hedge)
+#   "hedge": offset the filled volume of the live legs with an opposite order on the same exchange. Only a
+#            known filled volume is hedged and an order that may still fill stays unresolved.
+LEG_FAILURE_ACTIONS = ("retry", "cancel", "hedge")
+
+
+class LegExecution(object):
+    # Submits all legs of an arbitrage at the same time, so the second leg doesn't wait for the first
+    # one to be confirmed (and trade against an older book).
+    # submit_fn(leg, deadline) returns the order id or None, cancel_fn(leg) returns the order info after the
+    # cancellation or None if it failed, and hedge_fn(leg, volume) returns the hedge leg or None.
+    # query_fn(leg) returns the current order info of a live leg or None if its state is unknown.
+    # Legs are dicts; the results are stored in them ("order_id", "live_time", "order_info", "hedge_leg").
+
+    def __init__(self, submit_fn, cancel_fn, hedge_fn, failure_actions=LEG_FAILURE_ACTIONS, retry_interval=0.5,
+                 max_workers=4, query_fn=None):
+        for action in failure_actions:
+            assert action in LEG_FAILURE_ACTIONS, "Unknown leg failure action: {}".format(action)
+        self.submit_fn = submit_fn
+        self.cancel_fn = cancel_fn
+        self.hedge_fn = hedge_fn
+        self.query_fn = query_fn
+        self.failure_actions = list(failure_actions)
+        self.retry_interval = retry_interval
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.num_executions = 0
+        self.num_leg_failures = 0
+        self.num_resolved = {action: 0 for action in LEG_FAILURE_ACTIONS}
+        self.num_unresolved = 0
+
+    def _submit(self, legs, deadline):
+        futures = [(leg, self.executor.submit(self.submit_fn, leg, deadline)) for leg in legs]
+        for leg, future in futures:
+            try:
+                leg["order_id"] = future.result()
+            except Exception as err:
+                logging.warning("Submitting {} leg failed: {}".format(leg["side"], err))
+                leg["order_id"] = None
+            if leg["order_id"] is not None:
+                leg["live_time"] = time.time()
+
+    def _retry(self, legs, failed_legs, deadline):
+        while len(failed_legs) > 0:
+            remaining_time = deadline - time.time()
+            if remaining_time <= 0:
+                break
+            time.sleep(min(self.retry_interval, remaining_time))
+            self._submit(failed_legs, deadline)
+            failed_legs = [leg for leg in failed_legs if leg["order_id"] is None]
+        return failed_legs
+
+    def _cancel(self, live_legs):
+        # Returns the legs that still have a filled volume (or an unknown state) after the cancellation
+        exposed_legs = []
+        for leg in live_legs:
+            order_info = self.cancel_fn(leg)
+            leg["order_info"] = order_info
+            if order_info is None or (order_info.get("filled") or 0.0) > 0:
+                exposed_legs.append(leg)
+            else:
+                leg["cancelled"] = True
+        return exposed_legs
+
+    def _hedge(self, exposed_legs):
+        unhedged_legs = []
+        for leg in exposed_legs:
+            order_info = leg.get("order_info")
+            if (order_info is None or order_info.get("status") == "open") and self.query_fn is not None:
+                # The order was not cancelled (or the cancellation failed): get its current state
+                order_info = self.query_fn(leg)
+                leg["order_info"] = order_info
+            if order_info is None or order_info.get("filled") is None:
+                # Hedging a volume that may not have been filled would open a position of its own
+                unhedged_legs.append(leg)
+                continue
+            if order_info["filled"] <= 0 and order_info.get("status") != "open":
+                # Cancelled after all, without a fill
+                leg["cancelled"] = True
+                continue
+            if order_info["filled"] > 0 and leg.get("hedge_leg") is None:
+                leg["hedge_leg"] = self.hedge_fn(leg, order_info["filled"])
+                if leg["hedge_leg"] is None:
+                    unhedged_legs.append(leg)
+                    continue
+            if order_info.get("status") == "open":
+                # The rest of the order can still fill
+                unhedged_legs.append(leg)
+        return unhedged_legs
+
+    def execute(self, legs, deadline):
+        # Submit all legs and resolve a partial failure before the deadline (for retries).
+        # Returns the status: "live" (all legs live), "failed" (no leg live), "cancelled", "hedged"
+        # or "unresolved" (some legs are live without their counterpart).
+        self.num_executions += 1
+        self._submit(legs, deadline)
+        failed_legs = [leg for leg in legs if leg["order_id"] is None]
+        if len(failed_legs) == 0:
+            return "live"
+        if len(failed_legs) == len(legs):
+            return "failed"
+        self.num_leg_failures += 1
+        exposed_legs = [leg for leg in legs if leg["order_id"] is not None]
+        for action in self.failure_actions:
+            if action == "retry":
+                failed_legs = self._retry(legs, failed_legs, deadline)
+                if len(failed_legs) == 0:
+                    self.num_resolved[action] += 1
+                    return "live"
+            elif action == "cancel":
+                exposed_legs = self._cancel(exposed_legs)
+                if len(exposed_legs) == 0:
+                    self.num_resolved[action] += 1
+                    return "cancelled"
+            elif action == "hedge":
+                exposed_legs = self._hedge(exposed_legs)
+                if len(exposed_legs) == 0:
+                    self.num_resolved[action] += 1
+                    return "hedged"
+        self.num_unresolved += 1
+        return "unresolved"
+
+    def get_live_time(self, legs, start_time):
+        # Time from start_time until all legs were live (None if some leg never was)
+        live_times = [leg.get("live_time") for leg in legs]
+        if any(live_time is None for live_time in live_times):
+            return None
+        return max(live_times) - start_time
@@ -0,0 +1,320 @@
+import sys
+import zlib
+import numpy as np
+
+
+class LadderSide(object):
+    # One side of an order book with prices as integer ticks and volumes as integer lots.
+    # Only the levels of the book are stored: their keys and lots in sorted blocks of at most block_size
+    # levels, with the first key of every block in a sorted index and the lots and fiat cost of every block
+    # in a Fenwick tree. Changing a level is a binary search over the blocks and within its block plus a
+    # tree update, O(log n). Inserting or removing a level also copies its block (at most block_size levels),
+    # and a block that overflows is split in halves (one that falls below a quarter full is merged with a
+    # neighbor), which rebuilds the index of the blocks in O(n / block_size).
+    # Memory is 16 bytes per level plus about 270 bytes per block, and blocks are kept at least a quarter
+    # full, so 20 to 35 bytes per level with the default block size (see nbytes).
+    # Internally prices are keys (tick for asks, -tick for bids) so better prices always have smaller keys.
+
+    def __init__(self, is_bid, block_size=64):
+        self.is_bid = is_bid
+        self.block_size = block_size
+        self.clear()
+
+    def _to_key(self, tick):
+        # Also converts a key back to its tick
+        if self.is_bid:
+            return -tick
+        return tick
+
+    def _get_block_cost(self, block):
+        return float(np.dot(self.block_lots[block].astype(np.float64),
+                            self._to_key(self.block_keys[block]).astype(np.float64)))
+
+    def _build_index(self):
+        # First keys and Fenwick tree of the blocks in O(number of blocks): every node is added to its parent,
+        # one power of two (node size) at a time, so all children of a node are complete before the node is added
+        num_blocks = len(self.block_keys)
+        self.first_keys = np.array([keys[0] for keys in self.block_keys], dtype=np.int64)
+        self.tree_lots = np.zeros(num_blocks + 1, dtype=np.int64)
+        self.tree_costs = np.zeros(num_blocks + 1, dtype=np.float64)
+        self.tree_lots[1:] = [np.sum(lots) for lots in self.block_lots]
+        self.tree_costs[1:] = [self._get_block_cost(block) for block in range(num_blocks)]
+        step = 1
+        while step < num_blocks:
+            children = np.arange(step, num_blocks + 1, 2 * step)
+            parents = children + step
+            valid = parents <= num_blocks
+            self.tree_lots[parents[valid]] += self.tree_lots[children[valid]]
+            self.tree_costs[parents[valid]] += self.tree_costs[children[valid]]
+            step *= 2
+        # Highest power of two up to the number of blocks for the Fenwick tree descent
+        self.tree_step = 1 << (num_blocks.bit_length() - 1) if num_blocks > 0 else 0
+
+    def _tree_add(self, block, lots, cost):
+        index = block + 1
+        while index < len(self.tree_lots):
+            self.tree_lots[index] += lots
+            self.tree_costs[index] += cost
+            index += index & -index
+
+    def _tree_prefix(self, block):
+        # Sum of lots and cost over blocks [0, block]
+        lots = 0
+        cost = 0.0
+        index = block + 1
+        while index > 0:
+            lots += self.tree_lots[index]
+            cost += self.tree_costs[index]
+            index -= index & -index
+        return int(lots), float(cost)
+
+    def _tree_search(self, lots):
+        # Smallest block whose cumulative lots reach lots (number of blocks if never).
+        # Also returns the lots and cost of all blocks before it.
+        index = 0
+        acc_lots = 0
+        acc_cost = 0.0
+        step = self.tree_step
+        while step > 0:
+            next_index = index + step
+            if next_index < len(self.tree_lots) and acc_lots + self.tree_lots[next_index] < lots:
+                index = next_index
+                acc_lots += self.tree_lots[index]
+                acc_cost += self.tree_costs[index]
+            step >>= 1
+        return index, int(acc_lots), float(acc_cost)
+
+    def _find_block(self, key):
+        # Block that holds key or where it belongs (the first block for keys before all levels)
+        return max(int(self.first_keys.searchsorted(key, side="right")) - 1, 0)
+
+    def clear(self):
+        self.set_levels([], [])
+
+    def set_levels(self, ticks, lots):
+        # Replace all levels. Blocks start three quarters full, so inserts rarely split them right away.
+        ticks = np.asarray(ticks, dtype=np.int64)
+        lots = np.asarray(lots, dtype=np.int64)
+        valid = lots > 0
+        keys = self._to_key(ticks[valid])
+        lots = lots[valid]
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        lots = lots[order]
+        fill = max(self.block_size * 3 // 4, 1)
+        self.block_keys = [keys[begin:begin + fill].copy() for begin in range(0, len(keys), fill)]
+        self.block_lots = [lots[begin:begin + fill].copy() for begin in range(0, len(keys), fill)]
+        self.num_levels = len(keys)
+        self._build_index()
+
+    def _split_block(self, block):
+        keys = self.block_keys[block]
+        lots = self.block_lots[block]
+        middle = len(keys) // 2
+        self.block_keys[block:block + 1] = [keys[:middle].copy(), keys[middle:].copy()]
+        self.block_lots[block:block + 1] = [lots[:middle].copy(), lots[middle:].copy()]
+        self._build_index()
+
+    def _merge_block(self, block):
+        # Merge a block that ran low with a neighbor (and split the result again if it is too large)
+        if len(self.block_keys[block]) > 0 and len(self.block_keys) > 1:
+            neighbor = block + 1 if block + 1 < len(self.block_keys) else block - 1
+            first, second = min(block, neighbor), max(block, neighbor)
+            keys = np.concatenate((self.block_keys[first], self.block_keys[second]))
+            lots = np.concatenate((self.block_lots[first], self.block_lots[second]))
+            self.block_keys[first:second + 1] = [keys]
+            self.block_lots[first:second + 1] = [lots]
+            if len(keys) > self.block_size:
+                self._split_block(first)
+                return
+        elif len(self.block_keys[block]) == 0:
+            del self.block_keys[block]
+            del self.block_lots[block]
+        self._build_index()
+
+    def set_level(self, tick, lots):
+        # Set the volume of a price level (0 removes the level)
+        key = self._to_key(tick)
+        if len(self.block_keys) == 0:
+            if lots > 0:
+                self.set_levels([tick], [lots])
+            return
+        block = self._find_block(key)
+        keys = self.block_keys[block]
+        index = int(keys.searchsorted(key))
+        if index < len(keys) and keys[index] == key:
+            delta = lots - int(self.block_lots[block][index])
+            if delta == 0:
+                return
+            if lots > 0:
+                self.block_lots[block][index] = lots
+                self._tree_add(block, delta, float(delta) * tick)
+                return
+            block_lots = self.block_lots[block]
+            self.block_keys[block] = np.concatenate((keys[:index], keys[index + 1:]))
+            self.block_lots[block] = np.concatenate((block_lots[:index], block_lots[index + 1:]))
+            self.num_levels -= 1
+            if len(self.block_keys[block]) == 0 or \
+                    (len(self.block_keys) > 1 and len(self.block_keys[block]) < self.block_size // 4):
+                self._merge_block(block)
+                return
+            self.first_keys[block] = self.block_keys[block][0]
+            self._tree_add(block, delta, float(delta) * tick)
+            return
+        if lots <= 0:
+            return
+        block_lots = self.block_lots[block]
+        self.block_keys[block] = np.concatenate((keys[:index], [key], keys[index:]))
+        self.block_lots[block] = np.concatenate((block_lots[:index], [lots], block_lots[index:]))
+        self.num_levels += 1
+        if len(self.block_keys[block]) > self.block_size:
+            self._split_block(block)
+            return
+        self.first_keys[block] = self.block_keys[block][0]
+        self._tree_add(block, lots, float(lots) * tick)
+
+    def get_levels(self, max_levels=None):
+        # Ticks and lots of the levels (best first)
+        if len(self.block_keys) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        num_blocks = len(self.block_keys)
+        if max_levels is not None:
+            num_blocks = 0
+            num_levels = 0
+            while num_blocks < len(self.block_keys) and num_levels < max_levels:
+                num_levels += len(self.block_keys[num_blocks])
+                num_blocks += 1
+        ticks = self._to_key(np.concatenate(self.block_keys[:num_blocks]))
+        lots = np.concatenate(self.block_lots[:num_blocks])
+        if max_levels is not None:
+            ticks = ticks[:max_levels]
+            lots = lots[:max_levels]
+        return ticks, lots
+
+    @property
+    def total_lots(self):
+        return self._tree_prefix(len(self.block_keys) - 1)[0]
+
+    def get_best_tick(self):
+        if self.num_levels == 0:
+            return None
+        return int(self._to_key(self.block_keys[0][0]))
+
+    def get_depth(self, lots):
+        # Worst tick, cumulative lots up to and including that level and the cost (in ticks * lots)
+        # of filling lots by walking the book. None if there is not enough volume.
+        if self.num_levels == 0 or lots > self.total_lots:
+            return None
+        block, acc_lots, acc_cost = self._tree_search(lots)
+        block_lots = self.block_lots[block]
+        block_acc_lots = np.cumsum(block_lots)
+        index = int(block_acc_lots.searchsorted(lots - acc_lots))
+        block_ticks = self._to_key(self.block_keys[block][:index + 1])
+        if index > 0:
+            acc_cost += float(np.dot(block_lots[:index].astype(np.float64), block_ticks[:index].astype(np.float64)))
+            acc_lots += int(block_acc_lots[index - 1])
+        tick = int(block_ticks[index])
+        cost = acc_cost + (lots - acc_lots) * float(tick)
+        return tick, acc_lots + int(block_lots[index]), cost
+
+    def get_cumulative_lots(self, tick):
+        # Cumulative lots of all levels at tick or better
+        if self.num_levels == 0:
+            return 0
+        key = self._to_key(tick)
+        block = self._find_block(key)
+        index = int(self.block_keys[block].searchsorted(key, side="right"))
+        return self._tree_prefix(block - 1)[0] + int(np.sum(self.block_lots[block][:index]))
+
+    @property
+    def nbytes(self):
+        # Memory of the levels, the blocks and the block index (with the array and list headers)
+        arrays = self.block_keys + self.block_lots + [self.first_keys, self.tree_lots, self.tree_costs]
+        return sum(sys.getsizeof(array) for array in arrays) + sys.getsizeof(self.block_keys) + \
+            sys.getsizeof(self.block_lots)
+
+
+class LocalOrderBook(object):
+    # Order book with prices stored as integer ticks and volumes as integer lots.
+    # tick_size and lot_size should be the price and amount precision of the market.
+
+    def __init__(self, tick_size=0.01, lot_size=1e-8, block_size=64):
+        self.tick_size = tick_size
+        self.lot_size = lot_size
+        self.asks = LadderSide(is_bid=False, block_size=block_size)
+        self.bids = LadderSide(is_bid=True, block_size=block_size)
+
+    def to_tick(self, price):
+        return int(round(price / self.tick_size))
+
+    def to_lots(self, volume):
+        return int(round(volume / self.lot_size))
+
+    def apply_snapshot(self, asks, bids):
+        for side, levels in ((self.asks, asks), (self.bids, bids)):
+            if len(levels) == 0:
+                side.clear()
+                continue
+            levels = np.asarray([level[:2] for level in levels], dtype=np.float64)
+            side.set_levels(np.round(levels[:, 0] / self.tick_size).astype(np.int64),
+                            np.round(levels[:, 1] / self.lot_size).astype(np.int64))
+
+    def update(self, is_bid, price, volume):
+        side = self.bids if is_bid else self.asks
+        side.set_level(self.to_tick(price), self.to_lots(volume))
+
+    def apply_update(self, asks, bids):
+        for price, volume in asks:
+            self.asks.set_level(self.to_tick(price), self.to_lots(volume))
+        for price, volume in bids:
+            self.bids.set_level(self.to_tick(price), self.to_lots(volume))
+
+    def get_best_prices(self):
+        ask_tick = self.asks.get_best_tick()
+        bid_tick = self.bids.get_best_tick()
+        ask_price = ask_tick * self.tick_size if ask_tick is not None else float("inf")
+        bid_price = bid_tick * self.tick_size if bid_tick is not None else 0.0
+        return ask_price, bid_price
+
+    def get_depth(self, is_bid, volume):
+        # Worst price, cumulative volume and VWAP for filling volume, or None
+        side = self.bids if is_bid else self.asks
+        lots = max(self.to_lots(volume), 1)
+        depth = side.get_depth(lots)
+        if depth is None:
+            return None
+        tick, acc_lots, cost = depth
+        return tick * self.tick_size, acc_lots * self.lot_size, cost / lots * self.tick_size
+
+    def get_order_book(self, depth=None):
+        # Order book in ccxt format (best levels first)
+        order_book = {}
+        for key, side in (("asks", self.asks), ("bids", self.bids)):
+            ticks, lots = side.get_levels(depth)
+            order_book[key] = np.column_stack((ticks * self.tick_size, lots * self.lot_size)).tolist()
+        return order_book
+
+    def get_depths(self, depth=None):
+        # Both sides as ccxt_utils.OrderBookDepth for the arbitrage engine
+        import ccxt_utils
+        depths = []
+        for side, missing_price in ((self.asks, float("inf")), (self.bids, 0.0)):
+            ticks, lots = side.get_levels(depth)
+            depths.append(ccxt_utils.OrderBookDepth(ticks * self.tick_size, lots * self.lot_size, missing_price))
+        return tuple(depths)
+
+    def checksum(self, num_levels=10):
+        # CRC32 in the style of the Kraken websocket book checksum: for the top asks (ascending) and then
+        # the top bids (descending), price and volume without decimal point and leading zeros.
+        # With tick_size and lot_size equal to the market precision these strings are just the integers.
+        parts = []
+        for side in (self.asks, self.bids):
+            ticks, lots = side.get_levels(num_levels)
+            for tick, level_lots in zip(ticks, lots):
+                parts.append(str(int(tick)))
+                parts.append(str(int(level_lots)))
+        return zlib.crc32("".join(parts).encode("ascii")) & 0xffffffff
+
+    @property
+    def nbytes(self):
+        return self.asks.nbytes + self.bids.nbytes
@@ -0,0 +1,60 @@
+import os
+import json
+import time
+import logging
+
+
+def get_cache_filename(folder, exchange_id):
+    return os.path.join(folder, "{}_markets.json".format(exchange_id))
+
+
+def read_markets(filename, ttl):
+    # Cached markets and currencies or None if there is no cache or it is older than ttl seconds
+    try:
+        if time.time() - os.path.getmtime(filename) > ttl:
+            return None
+        with open(filename, "r") as fin:
+            return json.load(fin)
+    except (OSError, ValueError) as err:
+        if os.path.exists(filename):
+            logging.warning("Unable to read market cache {} ({}).".format(filename, err))
+        return None
+
+
+def write_markets(filename, markets, currencies=None):
+    # Written to a temporary file first so that a crash never leaves a truncated cache behind
+    folder = os.path.dirname(filename)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    tmp_filename = "{}.tmp".format(filename)
+    with open(tmp_filename, "w") as fout:
+        json.dump({"markets": markets, "currencies": currencies}, fout, default=str)
+    os.replace(tmp_filename, filename)
+
+
+def load_markets(exchange, folder, ttl, retry_fn=None):
+    # Load the markets (including precision and fees) of a ccxt exchange from the cache in folder if it is
+    # younger than ttl seconds, otherwise from the exchange (through retry_fn if given) and update the cache.
+    # Returns True if the markets came from the cache.
+    filename = get_cache_filename(folder, exchange.id)
+    cached = read_markets(filename, ttl)
+    if cached is not None:
+        exchange.setMarkets(cached["markets"])
+        if cached.get("currencies"):
+            exchange.currencies = cached["currencies"]
+        return True
+    if retry_fn is None:
+        exchange.loadMarkets(reload=True)
+    else:
+        retry_fn(exchange.loadMarkets, reload=True)
+    try:
+        write_markets(filename, exchange.markets, getattr(exchange, "currencies", None))
+    except (OSError, TypeError, ValueError) as err:
+        logging.warning("Unable to write market cache {} ({}).".format(filename, err))
+    return False
+
+
+def invalidate(folder, exchange_id):
+    filename = get_cache_filename(folder, exchange_id)
+    if os.path.exists(filename):
+        os.remove(filename)
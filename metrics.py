@@ -0,0 +1,200 @@
+import os
+import time
+import bisect
+import threading
+import http.server
+
+
+# Histogram bucket upper bounds in seconds (from 100 us for the decision to 1 min for order fills)
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram(object):
+    # Cumulative histogram with fixed bucket bounds. observe() costs one binary search.
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_quantile(self, quantile):
+        # Upper bound of the bucket that holds the quantile (None without observations)
+        if self.count == 0:
+            return None
+        rank = quantile * self.count
+        acc_count = 0
+        for index, count in enumerate(self.counts):
+            acc_count += count
+            if acc_count >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class MetricsRegistry(object):
+    # Histograms and counters keyed by metric name and labels, e.g.
+    #   registry.observe("stage_latency_seconds", 0.123, stage="book_fetch", venue="kraken")
+    #   registry.inc("api_request_failures_total", venue="kraken")
+    # Collectors are functions that return (name, type, help, labels dict, value) tuples of values that are
+    # kept elsewhere (e.g. rate limiter statistics); they are called when the metrics are formatted.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions = {}
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = []
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        self.descriptions[name] = (metric_type, help_text, buckets)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                buckets = self.descriptions.get(name, (None, None, None))[2] or DEFAULT_LATENCY_BUCKETS
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def timer(self, name, **labels):
+        return StageTimer(self, name, labels)
+
+    def add_collector(self, collector_fn):
+        self.collectors.append(collector_fn)
+
+    def get_histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def format_prometheus(self):
+        # All metrics in the Prometheus text exposition format
+        samples = {}
+        types = {}
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                types[name] = "histogram"
+                lines = samples.setdefault(name, [])
+                acc_count = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    acc_count += count
+                    lines.append("{}_bucket{} {:d}".format(
+                        name, _format_labels(labels + (("le", _format_value(bound)),)), acc_count))
+                lines.append("{}_sum{} {}".format(name, _format_labels(labels), _format_value(histogram.sum)))
+                lines.append("{}_count{} {:d}".format(name, _format_labels(labels), histogram.count))
+            for (name, labels), value in self.counters.items():
+                types[name] = "counter"
+                samples.setdefault(name, []).append(
+                    "{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+        for collector_fn in self.collectors:
+            for name, metric_type, help_text, labels, value in collector_fn():
+                types[name] = metric_type
+                self.descriptions.setdefault(name, (metric_type, help_text, None))
+                samples.setdefault(name, []).append(
+                    "{}{} {}".format(name, _format_labels(tuple(sorted(labels.items()))), _format_value(value)))
+        lines = []
+        for name in sorted(samples.keys()):
+            help_text = self.descriptions.get(name, (None, None, None))[1]
+            if help_text is not None:
+                lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, types[name]))
+            lines += samples[name]
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, filename):
+        # For the textfile collector of the node exporter (written atomically)
+        tmp_filename = "{}.tmp".format(filename)
+        with open(tmp_filename, "w") as fout:
+            fout.write(self.format_prometheus())
+        os.replace(tmp_filename, filename)
+
+
+class StageTimer(object):
+    # Context manager that observes the time spent in its block:
+    #   with registry.timer("stage_latency_seconds", stage="decision"):
+    #       ...
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.time() - self.start_time, **self.labels)
+        return False
+
+
+class MetricsServer(object):
+    # Serves the metrics of a registry over HTTP (GET /metrics) on a background thread
+
+    def __init__(self, registry, host="127.0.0.1", port=9108):
+        self.registry = registry
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(handler):
+                if handler.path.split("?")[0] not in ("/", "/metrics"):
+                    handler.send_error(404)
+                    return
+                body = registry.format_prometheus().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics_server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Registry of the trading loop and the request helpers
+REGISTRY = MetricsRegistry()
+REGISTRY.describe("stage_latency_seconds", "histogram",
+                  "Latency of the stages of the trading loop (book_fetch, decision, order_submit, order_fill, "
+                  "balance_fetch)")
+REGISTRY.describe("api_request_failures_total", "counter", "Failed exchange API requests (each one is retried)")
@@ -0,0 +1,720 @@
+import sys
+import json
+import time
+import bisect
+import random
+import argparse
+import datetime
+import threading
+import collections
+import http.server
+import urllib.parse
+
+import rate_limiter
+import kraken_wrapper
+
+
+class Order(object):
+    __slots__ = ("id", "account", "side", "price", "volume", "filled", "cost", "fee", "status", "client_ref",
+                 "open_time", "close_time")
+
+    def __init__(self, id, account, side, price, volume, client_ref=None):
+        self.id = id
+        self.account = account
+        self.side = side
+        self.price = price
+        self.volume = volume
+        self.filled = 0.0
+        self.cost = 0.0
+        self.fee = 0.0
+        # "open", "closed" (completely filled) or "canceled"
+        self.status = "open"
+        self.client_ref = client_ref
+        self.open_time = time.time()
+        self.close_time = None
+
+    @property
+    def remaining(self):
+        return self.volume - self.filled
+
+
+class BookSide(object):
+    # Resting orders of one side: a sorted list of prices and a FIFO queue of orders per price
+
+    def __init__(self, is_bid):
+        self.is_bid = is_bid
+        self.prices = []
+        self.levels = {}
+
+    def best_price(self):
+        if not self.prices:
+            return None
+        return self.prices[-1] if self.is_bid else self.prices[0]
+
+    def add(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            bisect.insort(self.prices, order.price)
+            level = self.levels[order.price] = collections.deque()
+        level.append(order)
+
+    def remove(self, order):
+        level = self.levels[order.price]
+        level.remove(order)
+        if not level:
+            self._remove_level(order.price)
+
+    def _remove_level(self, price):
+        del self.levels[price]
+        del self.prices[bisect.bisect_left(self.prices, price)]
+
+    def pop_front(self, price):
+        level = self.levels[price]
+        order = level.popleft()
+        if not level:
+            self._remove_level(price)
+        return order
+
+    def get_levels(self, count=None):
+        # Aggregated (price, volume, number of orders), best price first
+        prices = reversed(self.prices) if self.is_bid else iter(self.prices)
+        levels = []
+        for price in prices:
+            if count is not None and len(levels) >= count:
+                break
+            orders = self.levels[price]
+            levels.append((price, sum(order.remaining for order in orders), len(orders)))
+        return levels
+
+
+class Account(object):
+    # Balances of an account. Unlimited accounts (the market maker) are never short of funds.
+
+    def __init__(self, balances=None, unlimited=False):
+        self.balances = collections.defaultdict(float, balances or {})
+        self.holds = collections.defaultdict(float)
+        self.unlimited = unlimited
+
+    def get_available(self, currency):
+        return self.balances[currency] - self.holds[currency]
+
+
+class MatchingEngine(object):
+    # Price-time priority limit order book of one market.
+    # Incoming orders trade against resting orders at the resting price (best price first, oldest order
+    # first), the rest of a limit order rests in the book. The taker pays taker_fee, the maker maker_fee
+    # (in the quote currency). Amounts that open orders may still use are held on the accounts.
+
+    def __init__(self, base, quote, maker_fee=0.0016, taker_fee=0.0026, price_decimals=2, volume_decimals=8):
+        self.base = base
+        self.quote = quote
+        self.maker_fee = maker_fee
+        self.taker_fee = taker_fee
+        self.price_decimals = price_decimals
+        self.volume_decimals = volume_decimals
+        self.bids = BookSide(True)
+        self.asks = BookSide(False)
+        self.orders = {}
+        self.orders_by_client_ref = {}
+        self.accounts = {}
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.num_trades = 0
+        self.traded_volume = 0.0
+
+    def add_account(self, name, balances=None, unlimited=False):
+        self.accounts[name] = Account(balances, unlimited)
+        return self.accounts[name]
+
+    def _next_order_id(self):
+        self.sequence += 1
+        return "O{:08d}".format(self.sequence)
+
+    def _get_hold(self, side, price, volume):
+        if side == "buy":
+            return self.quote, price * volume * (1 + self.taker_fee)
+        return self.base, volume
+
+    def submit(self, account_name, side, price, volume, client_ref=None):
+        # Returns the order or raises ValueError (e.g. insufficient funds)
+        price = round(float(price), self.price_decimals)
+        volume = round(float(volume), self.volume_decimals)
+        if side not in ("buy", "sell") or price <= 0 or volume <= 0:
+            raise ValueError("Invalid order")
+        with self.lock:
+            account = self.accounts[account_name]
+            hold_currency, hold_amount = self._get_hold(side, price, volume)
+            if not account.unlimited and account.get_available(hold_currency) < hold_amount:
+                raise ValueError("Insufficient funds")
+            order = Order(self._next_order_id(), account_name, side, price, volume, client_ref)
+            self.orders[order.id] = order
+            if client_ref is not None:
+                self.orders_by_client_ref[(account_name, client_ref)] = order
+            account.holds[hold_currency] += hold_amount
+            self._match(order)
+            if order.status == "open":
+                (self.bids if side == "buy" else self.asks).add(order)
+            return order
+
+    def _match(self, order):
+        opposite = self.asks if order.side == "buy" else self.bids
+        while order.remaining > 1e-12:
+            best_price = opposite.best_price()
+            if best_price is None:
+                break
+            if order.side == "buy" and best_price > order.price or order.side == "sell" and best_price < order.price:
+                break
+            resting = opposite.levels[best_price][0]
+            volume = min(order.remaining, resting.remaining)
+            self._fill(resting, volume, best_price, self.maker_fee)
+            self._fill(order, volume, best_price, self.taker_fee)
+            if resting.status != "open":
+                opposite.pop_front(best_price)
+            self.num_trades += 1
+            self.traded_volume += volume
+
+    def _fill(self, order, volume, price, fee_rate):
+        account = self.accounts[order.account]
+        cost = volume * price
+        fee = cost * fee_rate
+        # Release the hold of the filled part (at the limit price the hold was computed with)
+        hold_currency, hold_amount = self._get_hold(order.side, order.price, volume)
+        account.holds[hold_currency] -= hold_amount
+        if order.side == "buy":
+            account.balances[self.base] += volume
+            account.balances[self.quote] -= cost + fee
+        else:
+            account.balances[self.base] -= volume
+            account.balances[self.quote] += cost - fee
+        order.filled += volume
+        order.cost += cost
+        order.fee += fee
+        if order.remaining <= 1e-12:
+            order.status = "closed"
+            order.close_time = time.time()
+
+    def cancel(self, order_id):
+        # Returns the order (None if unknown). Orders that are not open stay as they are.
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None or order.status != "open":
+                return order
+            (self.bids if order.side == "buy" else self.asks).remove(order)
+            hold_currency, hold_amount = self._get_hold(order.side, order.price, order.remaining)
+            self.accounts[order.account].holds[hold_currency] -= hold_amount
+            order.status = "canceled"
+            order.close_time = time.time()
+            return order
+
+    def get_order(self, order_id):
+        return self.orders.get(order_id)
+
+    def get_order_by_client_ref(self, account_name, client_ref):
+        return self.orders_by_client_ref.get((account_name, client_ref))
+
+    def get_orders(self, account_name, status=None, client_ref=None, start_time=None):
+        with self.lock:
+            orders = [order for order in self.orders.values() if order.account == account_name]
+        if status == "open":
+            orders = [order for order in orders if order.status == "open"]
+        elif status == "closed":
+            orders = [order for order in orders if order.status != "open"]
+        if client_ref is not None:
+            orders = [order for order in orders if order.client_ref == client_ref]
+        if start_time is not None:
+            orders = [order for order in orders if order.close_time is not None and order.close_time > start_time]
+        return orders
+
+    def get_depth(self, count=None):
+        with self.lock:
+            return self.asks.get_levels(count), self.bids.get_levels(count)
+
+
+class MarketMaker(object):
+    # Background liquidity: quotes num_levels levels on each side around a mid price that follows a random walk
+    # (volatility is the relative standard deviation per refresh). Requoting across resting orders of other
+    # accounts fills them, like a moving market does.
+
+    account_name = "market_maker"
+
+    def __init__(self, engine, mid_price=400.0, spread=0.001, num_levels=50, level_step=0.0005, level_volume=2.0,
+                 volatility=0.0005, refresh_interval=1.0, seed=None):
+        self.engine = engine
+        self.mid_price = mid_price
+        self.spread = spread
+        self.num_levels = num_levels
+        self.level_step = level_step
+        self.level_volume = level_volume
+        self.volatility = volatility
+        self.refresh_interval = refresh_interval
+        self.random = random.Random(seed)
+        self.order_ids = []
+        self._stop = threading.Event()
+        self._thread = None
+        if self.account_name not in engine.accounts:
+            engine.add_account(self.account_name, unlimited=True)
+
+    def quote(self):
+        for order_id in self.order_ids:
+            self.engine.cancel(order_id)
+        self.order_ids = []
+        for level in range(self.num_levels):
+            offset = self.spread / 2 + level * self.level_step
+            volume = self.level_volume * self.random.uniform(0.2, 1.8)
+            for side, price in (("sell", self.mid_price * (1 + offset)), ("buy", self.mid_price * (1 - offset))):
+                order = self.engine.submit(self.account_name, side, price, volume)
+                if order.status == "open":
+                    self.order_ids.append(order.id)
+
+    def step(self):
+        self.mid_price *= 1 + self.random.gauss(0.0, self.volatility)
+        self.quote()
+
+    def start(self):
+        self.quote()
+        self._thread = threading.Thread(target=self._run, name="mock_market_maker")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            self.step()
+
+
+def _format_number(value, decimals=8):
+    return "{:.{}f}".format(value, decimals)
+
+
+def _iso_time(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class KrakenAPI(object):
+    # The part of the Kraken REST API used by ccxt and krakenex here: public Time, Assets, AssetPairs and Depth,
+    # private Balance, AddOrder, CancelOrder, QueryOrders, OpenOrders and ClosedOrders.
+    # Private calls are not authenticated, the API-Key header selects the account (one account by default).
+
+    def __init__(self, engine, account_name="default", rate_limits=True):
+        self.engine = engine
+        self.account_name = account_name
+        self.rate_limits = rate_limits
+        self.rate_limiters = {}
+        self.pair = "X{}Z{}".format(engine.base, engine.quote)
+        self.base_asset = kraken_wrapper.CURRENCY_ASSET_DICT.get(engine.base, "X" + engine.base)
+        self.quote_asset = kraken_wrapper.CURRENCY_ASSET_DICT.get(engine.quote, "Z" + engine.quote)
+
+    def error_response(self, error):
+        return 200, {"error": [error], "result": {}}
+
+    def _result(self, result):
+        return 200, {"error": [], "result": result}
+
+    def check_rate_limit(self, path, params, headers):
+        # Kraken answers calls over the limit with an error (and HTTP 200)
+        if not self.rate_limits:
+            return True
+        key = headers.get("API-Key") or ("public" if "/public/" in path else self.account_name)
+        limiter = self.rate_limiters.get(key)
+        if limiter is None:
+            limiter = self.rate_limiters[key] = rate_limiter.create_kraken_rate_limiter()
+        return limiter.try_acquire(path.rsplit("/", 1)[-1])
+
+    def _format_order(self, order):
+        descr_order = "{} {} {}{} @ limit {}".format(order.side, _format_number(order.volume),
+                                                     self.engine.base, self.engine.quote, order.price)
+        return {
+            "refid": None,
+            "userref": order.client_ref,
+            "status": order.status,
+            "opentm": order.open_time,
+            "closetm": order.close_time,
+            "starttm": 0,
+            "expiretm": 0,
+            "descr": {"pair": "{}{}".format(self.engine.base, self.engine.quote), "type": order.side,
+                      "ordertype": "limit", "price": _format_number(order.price, self.engine.price_decimals),
+                      "price2": "0", "leverage": "none", "order": descr_order},
+            "vol": _format_number(order.volume),
+            "vol_exec": _format_number(order.filled),
+            "cost": _format_number(order.cost, 5),
+            "fee": _format_number(order.fee, 5),
+            "price": _format_number(order.cost / order.filled if order.filled > 0 else 0.0, 5),
+            "misc": "",
+            "oflags": "fciq",
+        }
+
+    def handle(self, method, path, params, headers):
+        name = path.rsplit("/", 1)[-1]
+        account_name = headers.get("API-Key") or self.account_name
+        if account_name not in self.engine.accounts:
+            account_name = self.account_name
+        if path.startswith("/0/public/"):
+            if name == "Time":
+                now = time.time()
+                return self._result({"unixtime": int(now), "rfc1123": time.strftime(
+                    "%a, %d %b %y %H:%M:%S +0000", time.gmtime(now))})
+            if name == "Assets":
+                return self._result({
+                    self.base_asset: {"aclass": "currency", "altname": self.engine.base, "decimals": 10,
+                                      "display_decimals": 5},
+                    self.quote_asset: {"aclass": "currency", "altname": self.engine.quote, "decimals": 4,
+                                       "display_decimals": 2},
+                })
+            if name == "AssetPairs":
+                return self._result({self.pair: {
+                    "altname": "{}{}".format(self.engine.base, self.engine.quote),
+                    "wsname": "{}/{}".format(self.engine.base, self.engine.quote),
+                    "aclass_base": "currency", "base": self.base_asset,
+                    "aclass_quote": "currency", "quote": self.quote_asset,
+                    "lot": "unit", "pair_decimals": self.engine.price_decimals,
+                    "lot_decimals": self.engine.volume_decimals, "lot_multiplier": 1,
+                    "leverage_buy": [], "leverage_sell": [],
+                    "fees": [[0, 100 * self.engine.taker_fee]], "fees_maker": [[0, 100 * self.engine.maker_fee]],
+                    "fee_volume_currency": "ZUSD", "margin_call": 80, "margin_stop": 40, "ordermin": "0.02",
+                }})
+            if name == "Depth":
+                count = int(params.get("count", 100))
+                asks, bids = self.engine.get_depth(count)
+                now = int(time.time())
+                return self._result({self.pair: {
+                    "asks": [[_format_number(price, self.engine.price_decimals), _format_number(volume), now]
+                             for price, volume, _ in asks],
+                    "bids": [[_format_number(price, self.engine.price_decimals), _format_number(volume), now]
+                             for price, volume, _ in bids],
+                }})
+        elif path.startswith("/0/private/"):
+            account = self.engine.accounts[account_name]
+            if name == "Balance":
+                return self._result({self.base_asset: _format_number(account.balances[self.engine.base], 10),
+                                     self.quote_asset: _format_number(account.balances[self.engine.quote], 4)})
+            if name == "AddOrder":
+                if params.get("ordertype", "limit") != "limit":
+                    return self.error_response("EGeneral:Invalid arguments:ordertype")
+                userref = int(params["userref"]) if "userref" in params else None
+                try:
+                    order = self.engine.submit(account_name, params["type"], params["price"], params["volume"],
+                                               userref)
+                except (KeyError, ValueError) as err:
+                    if str(err) == "Insufficient funds":
+                        return self.error_response("EOrder:Insufficient funds")
+                    return self.error_response("EGeneral:Invalid arguments")
+                return self._result({"descr": {"order": self._format_order(order)["descr"]["order"]},
+                                     "txid": [order.id]})
+            if name == "CancelOrder":
+                order = self.engine.cancel(params.get("txid"))
+                if order is None:
+                    return self.error_response("EOrder:Unknown order")
+                return self._result({"count": 1 if order.status == "canceled" else 0})
+            if name == "QueryOrders":
+                orders = [self.engine.get_order(order_id) for order_id in params.get("txid", "").split(",")]
+                return self._result({order.id: self._format_order(order) for order in orders
+                                     if order is not None and order.account == account_name})
+            if name in ("OpenOrders", "ClosedOrders"):
+                userref = int(params["userref"]) if "userref" in params else None
+                start_time = float(params["start"]) if "start" in params else None
+                if name == "OpenOrders":
+                    orders = self.engine.get_orders(account_name, "open", userref)
+                    return self._result({"open": {order.id: self._format_order(order) for order in orders}})
+                orders = self.engine.get_orders(account_name, "closed", userref, start_time)
+                return self._result({"closed": {order.id: self._format_order(order) for order in orders},
+                                     "count": len(orders)})
+        return self.error_response("EGeneral:Unknown method")
+
+
+class GdaxAPI(object):
+    # The part of the Gdax REST API used by ccxt here: time, products, currencies, the level 2 book, accounts and
+    # orders (create, get by id or client_oid, list, cancel). Requests are not authenticated, the CB-ACCESS-KEY
+    # header selects the account (one account by default).
+
+    def __init__(self, engine, account_name="default", rate_limits=True):
+        self.engine = engine
+        self.account_name = account_name
+        self.rate_limits = rate_limits
+        self.rate_limiters = {}
+        self.product_id = "{}-{}".format(engine.base, engine.quote)
+
+    def error_response(self, error):
+        return 503, {"message": error}
+
+    def check_rate_limit(self, path, params, headers):
+        if not self.rate_limits:
+            return True
+        key = headers.get("CB-ACCESS-KEY") or self.account_name
+        limiter = self.rate_limiters.get(key)
+        if limiter is None:
+            limiter = self.rate_limiters[key] = rate_limiter.create_gdax_rate_limiter()
+        endpoint = "fetchOrderBook" if path.startswith("/products") or path in ("/time", "/currencies") else None
+        return limiter.try_acquire(endpoint)
+
+    def _format_order(self, order):
+        if order.status == "open":
+            status, done_reason = "open", None
+        else:
+            status, done_reason = "done", "filled" if order.status == "closed" else "canceled"
+        return {
+            "id": order.id,
+            "client_oid": order.client_ref,
+            "price": _format_number(order.price, self.engine.price_decimals),
+            "size": _format_number(order.volume),
+            "product_id": self.product_id,
+            "side": order.side,
+            "type": "limit",
+            "time_in_force": "GTC",
+            "post_only": False,
+            "created_at": _iso_time(order.open_time),
+            "done_at": _iso_time(order.close_time),
+            "done_reason": done_reason,
+            "fill_fees": _format_number(order.fee, 10),
+            "filled_size": _format_number(order.filled),
+            "executed_value": _format_number(order.cost, 10),
+            "status": status,
+            "settled": status == "done",
+        }
+
+    def handle(self, method, path, params, headers):
+        account_name = headers.get("CB-ACCESS-KEY") or self.account_name
+        if account_name not in self.engine.accounts:
+            account_name = self.account_name
+        parts = [part for part in path.split("/") if part]
+        if method == "GET" and parts == ["time"]:
+            now = time.time()
+            return 200, {"iso": _iso_time(now), "epoch": now}
+        if method == "GET" and parts == ["products"]:
+            return 200, [{
+                "id": self.product_id, "base_currency": self.engine.base, "quote_currency": self.engine.quote,
+                "base_min_size": "0.01", "base_max_size": "1000",
+                "quote_increment": _format_number(10.0 ** -self.engine.price_decimals, self.engine.price_decimals),
+                "base_increment": _format_number(10.0 ** -self.engine.volume_decimals),
+                "display_name": "{}/{}".format(self.engine.base, self.engine.quote),
+                "min_market_funds": "10", "max_market_funds": "1000000", "margin_enabled": False,
+                "post_only": False, "limit_only": False, "cancel_only": False, "status": "online",
+                "status_message": "",
+            }]
+        if method == "GET" and parts == ["currencies"]:
+            return 200, [{"id": currency, "name": currency, "min_size": "0.00000001", "status": "online",
+                          "details": {}} for currency in (self.engine.base, self.engine.quote)]
+        if method == "GET" and len(parts) == 3 and parts[0] == "products" and parts[2] == "book":
+            if parts[1] != self.product_id:
+                return 404, {"message": "NotFound"}
+            asks, bids = self.engine.get_depth(None if params.get("level") == "3" else 50)
+            return 200, {
+                "sequence": self.engine.sequence,
+                "asks": [[_format_number(price, self.engine.price_decimals), _format_number(volume), num_orders]
+                         for price, volume, num_orders in asks],
+                "bids": [[_format_number(price, self.engine.price_decimals), _format_number(volume), num_orders]
+                         for price, volume, num_orders in bids],
+            }
+        account = self.engine.accounts[account_name]
+        if method == "GET" and parts == ["accounts"]:
+            return 200, [{"id": "{}-{}".format(account_name, currency), "currency": currency,
+                          "balance": _format_number(account.balances[currency], 16),
+                          "available": _format_number(account.get_available(currency), 16),
+                          "hold": _format_number(account.holds[currency], 16), "profile_id": account_name}
+                         for currency in (self.engine.base, self.engine.quote)]
+        if parts[:1] == ["orders"]:
+            if method == "POST" and len(parts) == 1:
+                if params.get("type", "limit") != "limit":
+                    return 400, {"message": "Only limit orders are supported"}
+                try:
+                    order = self.engine.submit(account_name, params["side"], params["price"], params["size"],
+                                               params.get("client_oid"))
+                except (KeyError, ValueError) as err:
+                    return 400, {"message": str(err)}
+                return 200, self._format_order(order)
+            if method == "GET" and len(parts) == 1:
+                statuses = params.get("status", ["open", "pending", "active"])
+                if not isinstance(statuses, list):
+                    statuses = [statuses]
+                orders = self.engine.get_orders(account_name)
+                if "all" not in statuses:
+                    orders = [order for order in orders if self._format_order(order)["status"] in statuses]
+                return 200, [self._format_order(order) for order in reversed(orders)]
+            if len(parts) == 2:
+                if parts[1].startswith("client:"):
+                    order = self.engine.get_order_by_client_ref(account_name, parts[1][len("client:"):])
+                else:
+                    order = self.engine.get_order(parts[1])
+                if order is None or order.account != account_name:
+                    return 404, {"message": "NotFound"}
+                if method == "DELETE":
+                    order = self.engine.cancel(order.id)
+                    if order.status != "canceled":
+                        return 400, {"message": "Order already done"}
+                    return 200, [order.id]
+                return 200, self._format_order(order)
+        return 404, {"message": "NotFound"}
+
+
+class MockExchangeHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive connections without Nagle's algorithm (headers and body are written separately)
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _handle(self, method):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        params = {}
+        for key, values in urllib.parse.parse_qs(url.query).items():
+            params[key] = values[0] if len(values) == 1 else values
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > 0:
+            body = self.rfile.read(length).decode("utf-8")
+            if "json" in (self.headers.get("Content-Type") or ""):
+                params.update(json.loads(body))
+            else:
+                for key, values in urllib.parse.parse_qs(body).items():
+                    params[key] = values[0] if len(values) == 1 else values
+        delay = server.get_delay()
+        if delay > 0:
+            time.sleep(delay)
+        if not server.api.check_rate_limit(url.path, params, self.headers):
+            server.count("num_rate_limited")
+            if isinstance(server.api, KrakenAPI):
+                status, result = server.api.error_response("EAPI:Rate limit exceeded")
+            else:
+                status, result = 429, {"message": "Rate limit exceeded"}
+        elif server.error_rate > 0 and server.random.random() < server.error_rate:
+            server.count("num_errors")
+            status, result = server.api.error_response("EService:Unavailable")
+        else:
+            try:
+                status, result = server.api.handle(method, url.path, params, self.headers)
+            except Exception as err:
+                server.count("num_exceptions")
+                status, result = 500, {"message": "Internal error: {}".format(err)}
+        server.count("num_requests")
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def log_message(self, *args):
+        pass
+
+
+class MockExchangeServer(http.server.ThreadingHTTPServer):
+    # Serves a KrakenAPI or GdaxAPI over HTTP with keep-alive.
+    # Every request is delayed by latency seconds plus an exponential jitter with mean jitter seconds
+    # (a long tail like real exchanges), error_rate of the requests fail with a service error and requests over
+    # the rate limit of the venue are rejected (if the API has rate_limits).
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, api, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        http.server.ThreadingHTTPServer.__init__(self, (host, port), MockExchangeHandler)
+        self.api = api
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.stats_lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return "http://{}:{:d}".format(self.server_address[0], self.port)
+
+    def get_delay(self):
+        if self.jitter <= 0:
+            return self.latency
+        with self.stats_lock:
+            return self.latency + self.random.expovariate(1.0 / self.jitter)
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="mock_exchange")
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def create_server(venue, base="ETH", quote="EUR", balances=None, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+                  error_rate=0.0, rate_limits=True, mid_price=400.0, volatility=0.0005, refresh_interval=1.0,
+                  seed=None):
+    # Mock server of venue ("kraken" or "gdax") with a market maker and one funded "default" account.
+    # Returns the (not yet started) server and the market maker.
+    if venue == "kraken":
+        engine = MatchingEngine(base, quote, maker_fee=0.0016, taker_fee=0.0026)
+        api = KrakenAPI(engine, rate_limits=rate_limits)
+    elif venue == "gdax":
+        engine = MatchingEngine(base, quote, maker_fee=0.0, taker_fee=0.003)
+        api = GdaxAPI(engine, rate_limits=rate_limits)
+    else:
+        raise ValueError("Unknown venue: {}".format(venue))
+    engine.add_account("default", balances if balances is not None else {base: 5.0, quote: 5000.0})
+    market_maker = MarketMaker(engine, mid_price, volatility=volatility, refresh_interval=refresh_interval, seed=seed)
+    server = MockExchangeServer(api, host, port, latency, jitter, error_rate, seed)
+    return server, market_maker
+
+
+def use_mock_url(client, url):
+    # Point a ccxt exchange or a krakenex client to a mock server
+    if hasattr(client, "urls"):
+        if isinstance(client.urls["api"], dict):
+            client.urls["api"] = {key: url for key in client.urls["api"]}
+        else:
+            client.urls["api"] = url
+    if hasattr(client, "uri"):
+        client.uri = url
+    return client
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Local mock of the Kraken or Gdax REST API with a matching engine")
+    parser.add_argument("venue", choices=["kraken", "gdax"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--base", default="ETH")
+    parser.add_argument("--quote", default="EUR")
+    parser.add_argument("--balance-base", type=float, default=5.0)
+    parser.add_argument("--balance-quote", type=float, default=5000.0)
+    parser.add_argument("--mid-price", type=float, default=400.0)
+    parser.add_argument("--volatility", type=float, default=0.0005, help="Relative mid price change per refresh")
+    parser.add_argument("--refresh-interval", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.0, help="Fixed latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Mean of the exponential extra latency")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--no-rate-limits", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+    server, market_maker = create_server(
+        args.venue, args.base, args.quote, {args.base: args.balance_base, args.quote: args.balance_quote},
+        args.host, args.port, args.latency, args.jitter, args.error_rate, not args.no_rate_limits,
+        args.mid_price, args.volatility, args.refresh_interval, args.seed)
+    market_maker.start()
+    print("Mock {} exchange on {}".format(args.venue, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        market_maker.stop()
+        server.server_close()
+        print("Requests: {}".format(dict(server.stats)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,339 @@
+import os
+import sys
+import time
+import queue
+import logging
+import argparse
+import multiprocessing
+
+import ccxt
+import ccxt_utils
+import order_book_stream
+import shared_order_book
+import trading_log
+
+import ccxt_arbitration_new as engine
+
+
+class RiskCoordinator(object):
+    # Central risk process of the workers: owns the balance ledger of all venues and currencies, approves
+    # arbitrages (their legs are reserved in the ledger, so workers can't spend the same balance twice) and
+    # stops all workers (halt_event) when the sum of their gains falls below -max_overall_fiat_loss.
+    # The workers don't keep ledgers of their own, they get the available balances from the coordinator.
+    # Messages are (kind, worker index, request id, payload) tuples on one request queue, approvals and balance
+    # requests are answered with (request id, kind, result) on the response queue of the worker.
+
+    def __init__(self, ledger, max_overall_fiat_loss, halt_event, response_queues):
+        self.ledger = ledger
+        self.max_overall_fiat_loss = max_overall_fiat_loss
+        self.halt_event = halt_event
+        self.response_queues = response_queues
+        self.approvals = {}
+        self.sequence = 0
+        self.total_gain_fiat = 0.0
+        self.num_approvals = 0
+        self.num_denials = 0
+        self.num_fills = 0
+
+    def approve(self, legs):
+        # legs: (venue, currency, amount) to reserve. Returns the approval id or None.
+        if self.halt_event.is_set():
+            return None
+        needed = {}
+        for venue, currency, amount in legs:
+            needed[(venue, currency)] = needed.get((venue, currency), 0.0) + amount
+        for (venue, currency), amount in needed.items():
+            if self.ledger.get_available(venue, currency) < amount:
+                logging.warning("Denied arbitrage: {:f} {} needed on {}, {:f} {} available".format(
+                    amount, currency, venue, self.ledger.get_available(venue, currency), currency))
+                return None
+        self.sequence += 1
+        approval_id = self.sequence
+        keys = []
+        for index, (venue, currency, amount) in enumerate(legs):
+            key = (approval_id, index)
+            self.ledger.reserve(venue, key, currency, amount)
+            keys.append((venue, key))
+        self.approvals[approval_id] = keys
+        return approval_id
+
+    def release(self, approval_id):
+        for venue, key in self.approvals.pop(approval_id, []):
+            self.ledger.release(venue, key)
+
+    def add_gain(self, gain_fiat):
+        self.total_gain_fiat += gain_fiat
+        if self.total_gain_fiat < -self.max_overall_fiat_loss and not self.halt_event.is_set():
+            logging.error("Overall fiat loss of all workers is too high ({:.2f}). Stopping all workers.".format(
+                -self.total_gain_fiat))
+            self.halt_event.set()
+
+    def handle(self, message):
+        kind, worker_index, request_id, payload = message
+        if kind == "approve":
+            approval_id = self.approve(payload)
+            if approval_id is None:
+                self.num_denials += 1
+            else:
+                self.num_approvals += 1
+            self.response_queues[worker_index].put((request_id, kind, approval_id))
+        elif kind == "balances":
+            names, currencies = payload
+            self.response_queues[worker_index].put(
+                (request_id, kind, self.ledger.get_available_arrays(names, currencies)))
+        elif kind == "release":
+            self.release(payload)
+        elif kind == "fill":
+            self.ledger.apply_fill(*payload)
+            self.num_fills += 1
+        elif kind == "gain":
+            self.add_gain(payload)
+        else:
+            logging.warning("Unknown risk coordinator message: {}".format(kind))
+
+    def format_stats(self):
+        return "{:d} approvals, {:d} denials, {:d} fills, total gain {:.2f}".format(
+            self.num_approvals, self.num_denials, self.num_fills, self.total_gain_fiat)
+
+    def run(self, request_queue, stats_interval=60.0):
+        # Until a None message
+        next_stats_time = time.time() + stats_interval
+        while True:
+            try:
+                message = request_queue.get(timeout=stats_interval)
+            except queue.Empty:
+                message = ()
+            if message is None:
+                break
+            if message:
+                self.handle(message)
+            if time.time() >= next_stats_time:
+                next_stats_time = time.time() + stats_interval
+                logging.info("Risk coordinator: {}".format(self.format_stats()))
+
+
+class RiskClient(object):
+    # The worker side of the RiskCoordinator (picklable, so it can be passed to a worker process)
+
+    def __init__(self, worker_index, request_queue, response_queue, halt_event, timeout=5.0):
+        self.worker_index = worker_index
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.halt_event = halt_event
+        self.timeout = timeout
+        self.sequence = 0
+
+    @property
+    def halted(self):
+        return self.halt_event.is_set()
+
+    def _request(self, kind, payload):
+        # Result of the coordinator or None if there was no answer in time
+        self.sequence += 1
+        request_id = self.sequence
+        self.request_queue.put((kind, self.worker_index, request_id, payload))
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                response_id, response_kind, result = self.response_queue.get(
+                    timeout=max(deadline - time.time(), 0.0))
+            except queue.Empty:
+                return None
+            if response_id == request_id:
+                return result
+            # Answers of requests that timed out before are late now, their reservations are given back
+            if response_kind == "approve" and result is not None:
+                self.release(result)
+
+    def request_approval(self, legs):
+        # Approval id or None (denied or no answer in time)
+        return self._request("approve", legs)
+
+    def get_balances(self, names, currencies):
+        # Available balances of the coordinator ledger as one array per currency (in the order of names),
+        # or None if there was no answer in time
+        return self._request("balances", (names, currencies))
+
+    def release(self, approval_id):
+        self.request_queue.put(("release", self.worker_index, None, approval_id))
+
+    def apply_fill(self, name, side, base_currency, quote_currency, filled, cost, fee_cost=None, fee_currency=None):
+        self.request_queue.put(("fill", self.worker_index, None,
+                                (name, side, base_currency, quote_currency, filled, cost, fee_cost, fee_currency)))
+
+    def report_gain(self, gain_fiat):
+        self.request_queue.put(("gain", self.worker_index, None, gain_fiat))
+
+
+def get_process_log_filename(suffix):
+    base_filename, extension = os.path.splitext(engine.log_filename)
+    return "{}_{}{}".format(base_filename, suffix, extension)
+
+
+def run_book_publisher(name, symbol, shared_book_name, depth, interval, use_stream, exchange_names,
+                       rate_limit_shares, stop_event):
+    # Process: publish the order book of one market into shared memory, from a websocket stream or by
+    # fetching it every interval seconds
+    trading_log.setup_logging(get_process_log_filename("books_{}_{}".format(name, symbol.replace("/", ""))),
+                              level=logging.INFO, console=False)
+    engine.exchange_names = exchange_names
+    engine.rate_limit_shares = rate_limit_shares
+    engine.setup_rate_limiters()
+    exchange = getattr(ccxt, name)({"session": engine.get_http_sessions()[name]})
+    if name in engine.mock_exchange_urls:
+        import mock_exchange
+        mock_exchange.use_mock_url(exchange, engine.mock_exchange_urls[name])
+    shared_book = shared_order_book.SharedOrderBook(shared_book_name, depth)
+
+    def fetch_order_book():
+        return ccxt_utils.retry(exchange.fetchL2OrderBook, symbol, _max_trials=3)
+
+    if use_stream:
+        stream = order_book_stream.create_exchange_stream(name, symbol, snapshot_fn=fetch_order_book, depth=depth)
+        stream.start()
+        while not stop_event.is_set():
+            # A synced book is published at least every second, so a quiet market doesn't look stale to the
+            # workers (shared_order_book_max_age)
+            stream.wait_for_update(1.0)
+            snapshot = stream.get_snapshot(symbol)
+            if snapshot is not None:
+                shared_book.publish(snapshot["order_book"], snapshot["update_time"])
+        stream.stop()
+    else:
+        while not stop_event.is_set():
+            start_time = time.time()
+            order_book = fetch_order_book()
+            if order_book is not None:
+                shared_book.publish(order_book)
+            stop_event.wait(max(interval - (time.time() - start_time), 0.0))
+    shared_book.close()
+
+
+def run_coordinator(request_queue, response_queues, halt_event, exchange_names, currencies, tolerances,
+                    max_overall_fiat_loss, rate_limit_shares, simulate, paper_balances):
+    # Process: the RiskCoordinator with a ledger that is reconciled with the exchanges and stops all workers when
+    # it deviates (or a paper ledger when simulating, like the ledger of a single process)
+    trading_log.setup_logging(get_process_log_filename("coordinator"), level=logging.INFO)
+    engine.exchange_names = exchange_names
+    engine.rate_limit_shares = rate_limit_shares
+    engine.simulate = simulate
+    engine.paper_balances = paper_balances
+    def on_balance_deviation(name, currency, ledger_total, exchange_total):
+        if engine.stop_on_balance_deviation and not halt_event.is_set():
+            logging.error("Ledger balances deviated from the exchange balances. Stopping all workers.")
+            halt_event.set()
+
+    ledger = engine.create_balance_ledger(currencies, tolerances, on_balance_deviation)
+    coordinator = RiskCoordinator(ledger, max_overall_fiat_loss, halt_event, response_queues)
+    coordinator.run(request_queue)
+    ledger.stop()
+    logging.info("Risk coordinator: {}".format(coordinator.format_stats()))
+
+
+def run_worker(index, symbol, exchange_names, shared_book_names, depth, risk_client, rate_limit_shares, settings):
+    # Process: the trading loop of ccxt_arbitration_new for one market
+    crypto, fiat = symbol.split("/")
+    suffix = "{}{}".format(crypto, fiat)
+    engine.crypto = crypto
+    engine.fiat = fiat
+    engine.symbol = symbol
+    engine.exchange_names = exchange_names
+    engine.log_filename = get_process_log_filename(suffix)
+    base_filename, extension = os.path.splitext(engine.gains_log_filename)
+    engine.gains_log_filename = "{}_{}{}".format(base_filename, suffix, extension)
+    engine.shared_order_book_names = shared_book_names
+    engine.shared_order_book_depth = depth
+    engine.risk_client = risk_client
+    engine.rate_limit_shares = rate_limit_shares
+    if engine.metrics_port is not None:
+        engine.metrics_port += index
+    for key, value in settings.items():
+        setattr(engine, key, value)
+    engine.run()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run one trading process per market with shared memory order books and a risk coordinator")
+    parser.add_argument("symbols", nargs="+", help="Markets, e.g. ETH/EUR BTC/EUR")
+    parser.add_argument("--exchanges", nargs="+", default=engine.exchange_names)
+    parser.add_argument("--depth", type=int, default=engine.order_book_stream_depth)
+    parser.add_argument("--book-interval", type=float, default=engine.trial_sleep_time,
+                        help="Seconds between order book fetches (without --streams)")
+    parser.add_argument("--streams", action="store_true", help="Publish order books from websocket streams")
+    parser.add_argument("--max-overall-fiat-loss", type=float, default=engine.max_overall_fiat_loss,
+                        help="Loss of all workers together that stops them")
+    parser.add_argument("--simulate", action="store_true")
+    args = parser.parse_args(argv)
+
+    # Processes that share the API keys share the rate limits: the book publishers take the public limit
+    # (minus a small share for the workers), the workers and the coordinator take the private limit
+    num_symbols = len(args.symbols)
+    publisher_shares = {"public": 1.0 / (num_symbols + 1)}
+    worker_shares = {"private": 1.0 / (num_symbols + 1), "public": 1.0 / ((num_symbols + 1) * num_symbols)}
+    coordinator_shares = {"private": 1.0 / (num_symbols + 1)}
+    # Tolerances of the coordinator ledger: the crypto tolerance for base and the fiat tolerance for quote currencies
+    # (the smaller one for a currency that is both)
+    tolerances = {}
+    for symbol in args.symbols:
+        base_currency, quote_currency = symbol.split("/")
+        for currency, tolerance in ((base_currency, engine.max_ledger_deviation_crypto),
+                                    (quote_currency, engine.max_ledger_deviation_fiat)):
+            tolerances[currency] = min(tolerances.get(currency, tolerance), tolerance)
+    currencies = sorted(tolerances)
+    settings = {"simulate": args.simulate, "max_overall_fiat_loss": args.max_overall_fiat_loss}
+
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    halt_event = context.Event()
+    request_queue = context.Queue()
+    response_queues = [context.Queue() for _ in args.symbols]
+    shared_books = {}
+    processes = []
+    coordinator = None
+    workers = []
+    try:
+        for symbol in args.symbols:
+            for name in args.exchanges:
+                shared_book = shared_order_book.SharedOrderBook(None, args.depth, create=True)
+                shared_books[(name, symbol)] = shared_book
+                processes.append(context.Process(
+                    target=run_book_publisher, name="books_{}_{}".format(name, symbol),
+                    args=(name, symbol, shared_book.name, args.depth, args.book_interval, args.streams,
+                          args.exchanges, publisher_shares, stop_event)))
+        coordinator = context.Process(
+            target=run_coordinator, name="risk_coordinator",
+            args=(request_queue, response_queues, halt_event, args.exchanges, currencies, tolerances,
+                  args.max_overall_fiat_loss, coordinator_shares, args.simulate, engine.paper_balances))
+        workers = []
+        for index, symbol in enumerate(args.symbols):
+            risk_client = RiskClient(index, request_queue, response_queues[index], halt_event)
+            shared_book_names = {name: shared_books[(name, symbol)].name for name in args.exchanges}
+            workers.append(context.Process(
+                target=run_worker, name="worker_{}".format(symbol),
+                args=(index, symbol, args.exchanges, shared_book_names, args.depth, risk_client, worker_shares,
+                      settings)))
+        for process in [coordinator] + processes + workers:
+            process.start()
+        print("Started {:d} workers, {:d} book publishers and the risk coordinator".format(
+            len(workers), len(processes)))
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        request_queue.put(None)
+        for process in processes + [coordinator] + workers:
+            if process is None or process.pid is None:
+                continue
+            process.join(5.0)
+            if process.is_alive():
+                process.terminate()
+        for shared_book in shared_books.values():
+            shared_book.close()
+            shared_book.unlink()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
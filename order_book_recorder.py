@@ -0,0 +1,254 @@
+import os
+import json
+import datetime
+import numpy as np
+
+
+# Column name -> (dtype, number of values per record (None for one value per book level))
+COLUMNS = {
+    "request_time": ("<f8", 1),
+    "response_time": ("<f8", 1),
+    "ask_prices": ("<f4", None),
+    "ask_volumes": ("<f4", None),
+    "bid_prices": ("<f4", None),
+    "bid_volumes": ("<f4", None),
+}
+
+
+def get_symbol_folder_name(symbol):
+    return symbol.replace("/", "_")
+
+
+def get_segment_name(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y%m%d")
+
+
+def get_column_filename(segment_folder, column):
+    dtype, _ = COLUMNS[column]
+    return os.path.join(segment_folder, "{}.{}".format(column, dtype.lstrip("<")))
+
+
+def levels_to_arrays(levels, num_levels):
+    # Top levels of one book side as fixed size price and volume arrays (NaN price and 0 volume as padding)
+    prices = np.full(num_levels, np.nan, dtype=np.float32)
+    volumes = np.zeros(num_levels, dtype=np.float32)
+    levels = levels[:num_levels]
+    if len(levels) > 0:
+        levels = np.asarray([level[:2] for level in levels], dtype=np.float64)
+        prices[:len(levels)] = levels[:, 0]
+        volumes[:len(levels)] = levels[:, 1]
+    return prices, volumes
+
+
+def get_record_size(column, num_levels):
+    dtype, width = COLUMNS[column]
+    return np.dtype(dtype).itemsize * (num_levels if width is None else width)
+
+
+def get_num_records(segment_folder, num_levels):
+    # Number of complete records of a segment. Columns are flushed independently and can differ in length
+    # after a crash, so this is the smallest number of whole records over all columns.
+    num_records = None
+    for column in COLUMNS:
+        filename = get_column_filename(segment_folder, column)
+        column_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        column_records = column_size // get_record_size(column, num_levels)
+        num_records = column_records if num_records is None else min(num_records, column_records)
+    return num_records
+
+
+class OrderBookRecorder(object):
+    # Append-only columnar recorder for order book snapshots.
+    # There is one folder per exchange, symbol and UTC day with one raw file per column, so a segment can
+    # be mapped with numpy.memmap without any parsing. Records are appended in time order so the
+    # response_time column doubles as the time index of a segment.
+
+    def __init__(self, folder, num_levels=20, flush_interval=100):
+        self.folder = folder
+        self.num_levels = num_levels
+        self.flush_interval = flush_interval
+        self.streams = {}
+        self.num_records = 0
+
+    def _open_segment(self, exchange_name, symbol, segment_name):
+        segment_folder = os.path.join(self.folder, exchange_name, get_symbol_folder_name(symbol), segment_name)
+        if not os.path.exists(segment_folder):
+            os.makedirs(segment_folder)
+        meta_filename = os.path.join(segment_folder, "meta.json")
+        if os.path.exists(meta_filename):
+            with open(meta_filename, "r") as fin:
+                meta = json.load(fin)
+            assert meta["num_levels"] == self.num_levels, \
+                "Segment {} was recorded with {} levels".format(segment_folder, meta["num_levels"])
+            # Cut the columns to the complete records, else the records appended now would be misaligned
+            num_records = get_num_records(segment_folder, self.num_levels)
+            for column in COLUMNS:
+                filename = get_column_filename(segment_folder, column)
+                if os.path.exists(filename):
+                    size = num_records * get_record_size(column, self.num_levels)
+                    if os.path.getsize(filename) > size:
+                        os.truncate(filename, size)
+        else:
+            with open(meta_filename, "w") as fout:
+                json.dump({"exchange": exchange_name, "symbol": symbol, "num_levels": self.num_levels,
+                           "columns": {column: dtype for column, (dtype, _) in COLUMNS.items()}}, fout)
+        files = {}
+        for column in COLUMNS:
+            files[column] = open(get_column_filename(segment_folder, column), "ab")
+        return {"segment_name": segment_name, "files": files}
+
+    def _close_stream(self, stream):
+        for fout in stream["files"].values():
+            fout.close()
+
+    def record(self, exchange_name, symbol, snapshot):
+        # snapshot as returned by ccxt_utils.fetch_order_book_snapshot or OrderBookStream.get_snapshot
+        response_time = snapshot["response_time"]
+        segment_name = get_segment_name(response_time)
+        key = (exchange_name, symbol)
+        stream = self.streams.get(key)
+        if stream is None or stream["segment_name"] != segment_name:
+            if stream is not None:
+                self._close_stream(stream)
+            stream = self._open_segment(exchange_name, symbol, segment_name)
+            self.streams[key] = stream
+        order_book = snapshot["order_book"]
+        ask_prices, ask_volumes = levels_to_arrays(order_book["asks"], self.num_levels)
+        bid_prices, bid_volumes = levels_to_arrays(order_book["bids"], self.num_levels)
+        values = {
+            "request_time": np.array([snapshot["request_time"]], dtype=np.float64),
+            "response_time": np.array([response_time], dtype=np.float64),
+            "ask_prices": ask_prices,
+            "ask_volumes": ask_volumes,
+            "bid_prices": bid_prices,
+            "bid_volumes": bid_volumes,
+        }
+        files = stream["files"]
+        for column, array in values.items():
+            files[column].write(array.tobytes())
+        self.num_records += 1
+        if self.num_records % self.flush_interval == 0:
+            self.flush()
+
+    def flush(self):
+        for stream in self.streams.values():
+            for fout in stream["files"].values():
+                fout.flush()
+
+    def close(self):
+        for stream in self.streams.values():
+            self._close_stream(stream)
+        self.streams = {}
+
+
+class OrderBookArchive(object):
+    # Read access to the segments written by OrderBookRecorder
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def get_segment_names(self, exchange_name, symbol):
+        symbol_folder = os.path.join(self.folder, exchange_name, get_symbol_folder_name(symbol))
+        if not os.path.exists(symbol_folder):
+            return []
+        return sorted(name for name in os.listdir(symbol_folder)
+                      if os.path.exists(os.path.join(symbol_folder, name, "meta.json")))
+
+    def open_segment(self, exchange_name, symbol, segment_name):
+        # Memory map all columns of a segment. Columns can differ in length after a crash,
+        # so all columns are cut to the number of complete records.
+        segment_folder = os.path.join(self.folder, exchange_name, get_symbol_folder_name(symbol), segment_name)
+        with open(os.path.join(segment_folder, "meta.json"), "r") as fin:
+            meta = json.load(fin)
+        num_levels = meta["num_levels"]
+        num_records = get_num_records(segment_folder, num_levels)
+        segment = {}
+        for column, (dtype, width) in COLUMNS.items():
+            width = num_levels if width is None else width
+            if num_records == 0:
+                segment[column] = np.zeros((0, width) if width > 1 else 0, dtype=dtype)
+                continue
+            array = np.memmap(get_column_filename(segment_folder, column), dtype=dtype, mode="r")
+            array = array[:num_records * width]
+            segment[column] = array.reshape(num_records, width) if width > 1 else array
+        return segment
+
+    def load_segments(self, exchange_name, symbol, start_time=None, end_time=None):
+        # Memory maps of the records with start_time <= response_time < end_time, one dict per segment.
+        # Only the segments (days) in the time range are opened and the records within a segment are found
+        # by binary search on response_time.
+        start_segment = get_segment_name(start_time) if start_time is not None else None
+        end_segment = get_segment_name(end_time) if end_time is not None else None
+        segments = []
+        for segment_name in self.get_segment_names(exchange_name, symbol):
+            if start_segment is not None and segment_name < start_segment:
+                continue
+            if end_segment is not None and segment_name > end_segment:
+                continue
+            segment = self.open_segment(exchange_name, symbol, segment_name)
+            times = segment["response_time"]
+            begin = 0 if start_time is None else np.searchsorted(times, start_time, side="left")
+            end = len(times) if end_time is None else np.searchsorted(times, end_time, side="left")
+            if end > begin:
+                segments.append({column: array[begin:end] for column, array in segment.items()})
+        return segments
+
+    def load(self, exchange_name, symbol, start_time=None, end_time=None):
+        # All records in the time range as SegmentedRecords (nothing is copied out of the memory maps)
+        return SegmentedRecords(self.load_segments(exchange_name, symbol, start_time, end_time))
+
+
+class SegmentedRecords(object):
+    # Records of consecutive segments addressed by one record index over all of them. The columns of every
+    # segment stay views of its memory maps, so processes that load the same range share the pages of the
+    # OS page cache and a range of any length costs no private memory except for the time index.
+
+    def __init__(self, segments):
+        # Plain array views of the memory maps (indexing a numpy.memmap is several times slower)
+        self.segments = [{column: np.asarray(array) for column, array in segment.items()} for segment in segments]
+        self.offsets = np.cumsum([0] + [len(segment["response_time"]) for segment in self.segments])
+        # The time index (8 bytes per record) is the only column that is concatenated
+        if len(self.segments) > 0:
+            self.response_time = np.concatenate([segment["response_time"] for segment in self.segments])
+        else:
+            self.response_time = np.zeros(0, dtype=np.float64)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, index):
+        # Segment and index within the segment of a record
+        segment_index = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        return self.segments[segment_index], int(index - self.offsets[segment_index])
+
+    def get(self, column, index):
+        segment, record_index = self.locate(index)
+        return segment[column][record_index]
+
+    def take(self, column, indices, level=None):
+        # Values of a column at many record indices (only the selected rows, or one level of them, are copied)
+        indices = np.asarray(indices, dtype=np.int64)
+        segment_indices = np.searchsorted(self.offsets, indices, side="right") - 1
+        first_column = self.segments[0][column] if len(self.segments) > 0 else np.zeros(0, dtype=COLUMNS[column][0])
+        shape = first_column.shape[1:] if level is None else ()
+        values = np.empty((len(indices),) + shape, dtype=first_column.dtype)
+        for segment_index in np.unique(segment_indices):
+            selected = segment_indices == segment_index
+            record_indices = indices[selected] - self.offsets[segment_index]
+            array = self.segments[segment_index][column]
+            values[selected] = array[record_indices] if level is None else array[record_indices, level]
+        return values
+
+
+def get_order_book(data, index):
+    # Record index of loaded SegmentedRecords as a ccxt order book
+    segment, record_index = data.locate(index)
+    order_book = {}
+    for side in ("ask", "bid"):
+        prices = segment["{}_prices".format(side)][record_index]
+        volumes = segment["{}_volumes".format(side)][record_index]
+        valid = ~np.isnan(prices)
+        order_book["{}s".format(side)] = np.column_stack(
+            (prices[valid].astype(np.float64), volumes[valid].astype(np.float64))).tolist()
+    order_book["timestamp"] = float(segment["response_time"][record_index])
+    return order_book
@@ -0,0 +1,85 @@
+import sys
+import json
+import time
+import argparse
+import threading
+import socketserver
+
+
+def read_messages(filename):
+    # One JSON message per line (raw exchange messages or normalized snapshot/update messages)
+    messages = []
+    with open(filename, "r") as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                messages.append(line)
+    return messages
+
+
+class ReplayHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        interval = 1.0 / server.rate if server.rate > 0 else 0.0
+        next_time = time.time()
+        while True:
+            for message in server.messages:
+                if interval > 0:
+                    now = time.time()
+                    if now < next_time:
+                        time.sleep(next_time - now)
+                    next_time = max(next_time + interval, now)
+                try:
+                    self.wfile.write((message + "\n").encode("utf-8"))
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                server.num_sent += 1
+            if not server.loop:
+                return
+
+
+class ReplayServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # Local server that sends recorded order book messages to every client as newline delimited JSON
+    # at a configurable rate (messages per second, 0 for as fast as possible).
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, messages, host="127.0.0.1", port=0, rate=100.0, loop=False):
+        socketserver.TCPServer.__init__(self, (host, port), ReplayHandler)
+        self.messages = messages
+        self.rate = rate
+        self.loop = loop
+        self.num_sent = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="order_book_replay")
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay recorded order book messages over TCP")
+    parser.add_argument("filename")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--rate", type=float, default=100.0, help="Messages per second (0 for unlimited)")
+    parser.add_argument("--loop", action="store_true")
+    args = parser.parse_args(argv)
+    server = ReplayServer(read_messages(args.filename), args.host, args.port, args.rate, args.loop)
+    print("Replaying {:d} messages on {}:{:d}".format(len(server.messages), args.host, server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
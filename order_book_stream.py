@@ -0,0 +1,327 @@
+import json
+import time
+import socket
+import logging
+import threading
+
+import local_order_book
+
+
+KRAKEN_WEBSOCKET_URL = "wss://ws.kraken.com"
+GDAX_WEBSOCKET_URL = "wss://ws-feed.gdax.com"
+
+
+class SequenceGapError(Exception):
+    pass
+
+
+class ChecksumError(SequenceGapError):
+    pass
+
+
+def kraken_subscribe_message(symbol, depth=100):
+    return {"event": "subscribe", "pair": [symbol], "subscription": {"name": "book", "depth": depth}}
+
+
+def gdax_subscribe_message(symbol):
+    return {"type": "subscribe", "product_ids": [symbol.replace("/", "-")], "channels": ["level2"]}
+
+
+def parse_kraken_message(message):
+    # Kraken book messages look like [channel_id, {"as": [...], "bs": [...]}, "book-100", "ETH/EUR"]
+    # for snapshots and [channel_id, {"a": [...]}, {"b": [...]}, "book-100", "ETH/EUR"] for updates.
+    # Levels are [price, volume, timestamp] strings and a volume of 0 removes the level.
+    if not isinstance(message, list):
+        return None
+    asks = []
+    bids = []
+    snapshot = False
+    timestamp = None
+    checksum = None
+    for data in message[1:-2]:
+        if not isinstance(data, dict):
+            continue
+        for key, side in (("as", asks), ("a", asks), ("bs", bids), ("b", bids)):
+            for level in data.get(key, []):
+                side.append((float(level[0]), float(level[1])))
+                timestamp = max(timestamp or 0.0, float(level[2]))
+        if "as" in data or "bs" in data:
+            snapshot = True
+        if "c" in data:
+            checksum = int(data["c"])
+    return {
+        "type": "snapshot" if snapshot else "update",
+        "asks": asks,
+        "bids": bids,
+        "sequence": None,
+        "timestamp": timestamp,
+        "checksum": checksum,
+    }
+
+
+def parse_gdax_message(message):
+    # Gdax level2 channel: "snapshot" with full bids/asks and "l2update" with [side, price, size] changes
+    if not isinstance(message, dict):
+        return None
+    if message.get("type") == "snapshot":
+        return {
+            "type": "snapshot",
+            "asks": [(float(price), float(volume)) for price, volume in message["asks"]],
+            "bids": [(float(price), float(volume)) for price, volume in message["bids"]],
+            "sequence": message.get("sequence"),
+            "timestamp": None,
+            "checksum": None,
+        }
+    if message.get("type") == "l2update":
+        asks = []
+        bids = []
+        for side, price, volume in message["changes"]:
+            if side == "buy":
+                bids.append((float(price), float(volume)))
+            else:
+                asks.append((float(price), float(volume)))
+        return {
+            "type": "update",
+            "asks": asks,
+            "bids": bids,
+            "sequence": message.get("sequence"),
+            "timestamp": None,
+            "checksum": None,
+        }
+    return None
+
+
+def parse_normalized_message(message):
+    # Messages that are already in the normalized format (e.g. from the replay server)
+    if not isinstance(message, dict) or message.get("type") not in ("snapshot", "update"):
+        return None
+    return {
+        "type": message["type"],
+        "asks": [tuple(level) for level in message.get("asks", [])],
+        "bids": [tuple(level) for level in message.get("bids", [])],
+        "sequence": message.get("sequence"),
+        "timestamp": message.get("timestamp"),
+        "checksum": message.get("checksum"),
+    }
+
+
+MESSAGE_PARSERS = {
+    "kraken": parse_kraken_message,
+    "gdax": parse_gdax_message,
+    "normalized": parse_normalized_message,
+}
+
+
+class StreamingOrderBook(object):
+    # Local L2 order book that is maintained from a snapshot and incremental updates.
+    # If updates carry sequence numbers, a gap marks the book as out of sync until the next snapshot.
+    # The same happens if an update carries a checksum (Kraken) that doesn't match the local book.
+
+    def __init__(self, tick_size=0.01, lot_size=1e-8, num_checksum_levels=10):
+        self.book = local_order_book.LocalOrderBook(tick_size, lot_size)
+        self.num_checksum_levels = num_checksum_levels
+        self.sequence = None
+        self.synced = False
+        self.update_time = None
+        self.exchange_timestamp = None
+        self.num_updates = 0
+        self.num_gaps = 0
+
+    def apply_snapshot(self, asks, bids, sequence=None, timestamp=None):
+        self.book.apply_snapshot(asks, bids)
+        self.sequence = sequence
+        self.synced = True
+        self.update_time = time.time()
+        self.exchange_timestamp = timestamp
+
+    def apply_update(self, asks, bids, sequence=None, timestamp=None, checksum=None):
+        if not self.synced:
+            return
+        if sequence is not None and self.sequence is not None:
+            if sequence <= self.sequence:
+                # Old message that is already part of the snapshot
+                return
+            if sequence != self.sequence + 1:
+                self.synced = False
+                self.num_gaps += 1
+                raise SequenceGapError("Expected sequence {} but got {}".format(self.sequence + 1, sequence))
+        self.book.apply_update(asks, bids)
+        if checksum is not None and self.book.checksum(self.num_checksum_levels) != checksum:
+            self.synced = False
+            self.num_gaps += 1
+            raise ChecksumError("Checksum mismatch")
+        if sequence is not None:
+            self.sequence = sequence
+        self.num_updates += 1
+        self.update_time = time.time()
+        if timestamp is not None:
+            self.exchange_timestamp = timestamp
+
+    def apply_message(self, message):
+        if message["type"] == "snapshot":
+            self.apply_snapshot(message["asks"], message["bids"], message["sequence"], message["timestamp"])
+        else:
+            self.apply_update(message["asks"], message["bids"], message["sequence"], message["timestamp"],
+                              message.get("checksum"))
+
+    def get_order_book(self, depth=None):
+        # Order book in ccxt format (best levels first)
+        order_book = self.book.get_order_book(depth)
+        order_book["timestamp"] = self.update_time
+        return order_book
+
+
+def iter_websocket_messages(url, subscribe_message, timeout=10.0):
+    # Optional dependency, only needed when streaming from the exchanges directly
+    import websocket
+    connection = websocket.create_connection(url, timeout=timeout)
+    try:
+        connection.send(json.dumps(subscribe_message))
+        while True:
+            yield json.loads(connection.recv())
+    finally:
+        connection.close()
+
+
+def iter_tcp_messages(host, port, timeout=10.0):
+    # Newline delimited JSON messages (as sent by order_book_replay)
+    connection = socket.create_connection((host, port), timeout=timeout)
+    try:
+        reader = connection.makefile("r")
+        for line in reader:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    finally:
+        connection.close()
+
+
+class OrderBookStream(object):
+    # Keeps a StreamingOrderBook up to date from a message source on a background thread.
+    # message_source_fn is called to (re)connect and returns an iterator over raw messages.
+    # snapshot_fn is an optional callable that returns a ccxt order book (e.g. over REST) to resync
+    # after a sequence gap when the feed itself does not send a new snapshot.
+
+    def __init__(self, name, message_source_fn, parser="normalized", snapshot_fn=None,
+                 reconnect_interval=1.0, depth=None, update_event=None, tick_size=0.01, lot_size=1e-8):
+        self.name = name
+        self.message_source_fn = message_source_fn
+        if isinstance(parser, str):
+            parser = MESSAGE_PARSERS[parser]
+        self.parser = parser
+        self.snapshot_fn = snapshot_fn
+        self.reconnect_interval = reconnect_interval
+        self.depth = depth
+        self.book = StreamingOrderBook(tick_size, lot_size)
+        self.lock = threading.Lock()
+        # Can be shared between streams to wait for an update on any of them
+        if update_event is None:
+            update_event = threading.Event()
+        self.update_event = update_event
+        self.num_messages = 0
+        self.num_resyncs = 0
+        self.num_reconnects = 0
+        self._stop = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="order_book_stream_{}".format(self.name))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop = True
+
+    def resync(self):
+        if self.snapshot_fn is None:
+            return
+        order_book = self.snapshot_fn()
+        if order_book is None:
+            return
+        # The nonce of the snapshot (if the exchange has one) is the sequence number of its last update, so
+        # older updates that are still on their way are dropped and the next one is checked for a gap
+        with self.lock:
+            self.book.apply_snapshot(
+                [level[:2] for level in order_book["asks"]],
+                [level[:2] for level in order_book["bids"]],
+                order_book.get("nonce"))
+        self.num_resyncs += 1
+
+    def process_message(self, raw_message):
+        message = self.parser(raw_message)
+        if message is None:
+            return
+        self.num_messages += 1
+        try:
+            with self.lock:
+                self.book.apply_message(message)
+        except SequenceGapError as err:
+            logging.warning("Order book stream {}: {}. Resyncing.".format(self.name, err))
+            self.resync()
+        self.update_event.set()
+
+    def _run(self):
+        while not self._stop:
+            try:
+                for raw_message in self.message_source_fn():
+                    if self._stop:
+                        break
+                    self.process_message(raw_message)
+            except Exception as err:
+                logging.warning("Order book stream {} failed: {}".format(self.name, err))
+            if self._stop:
+                break
+            # The book can't be trusted until we got a new snapshot
+            with self.lock:
+                self.book.synced = False
+            self.num_reconnects += 1
+            time.sleep(self.reconnect_interval)
+
+    @property
+    def synced(self):
+        return self.book.synced
+
+    def wait_for_update(self, timeout=None):
+        updated = self.update_event.wait(timeout)
+        self.update_event.clear()
+        return updated
+
+    def get_snapshot(self, symbol=None):
+        # Same format as ccxt_utils.fetch_order_book_snapshot so the rest of the loop doesn't care where
+        # the book came from. A synced book is current when it is read (a quiet market just has no updates),
+        # so that is its request and response time, and update_time is the time of the last applied update.
+        with self.lock:
+            if not self.book.synced:
+                return None
+            order_book = self.book.get_order_book(self.depth)
+            read_time = time.time()
+        return {
+            "symbol": symbol,
+            "order_book": order_book,
+            "request_time": read_time,
+            "response_time": read_time,
+            "update_time": order_book["timestamp"],
+        }
+
+
+def create_exchange_stream(name, symbol, snapshot_fn=None, depth=100, update_event=None,
+                           tick_size=0.01, lot_size=1e-8):
+    if name == "kraken":
+        subscribe_message = kraken_subscribe_message(symbol, depth)
+        url = KRAKEN_WEBSOCKET_URL
+    elif name == "gdax":
+        subscribe_message = gdax_subscribe_message(symbol)
+        url = GDAX_WEBSOCKET_URL
+    else:
+        raise ValueError("No order book stream for exchange: {}".format(name))
+    return OrderBookStream(name, lambda: iter_websocket_messages(url, subscribe_message),
+                           parser=name, snapshot_fn=snapshot_fn, depth=depth, update_event=update_event,
+                           tick_size=tick_size, lot_size=lot_size)
+
+
+def create_replay_stream(name, host, port, parser="normalized", snapshot_fn=None, depth=100, update_event=None,
+                         tick_size=0.01, lot_size=1e-8):
+    return OrderBookStream(name, lambda: iter_tcp_messages(host, port),
+                           parser=parser, snapshot_fn=snapshot_fn, depth=depth, update_event=update_event,
+                           tick_size=tick_size, lot_size=lot_size)
@@ -0,0 +1,177 @@
+import time
+import logging
+
+import kraken_wrapper
+
+
+class KrakenOrderSource(object):
+    # Kraken orders over the krakenex client.
+    # OpenOrders and ClosedOrders can be filtered by userref, so a lookup only returns our own order.
+    # The closed order cursor is a unix time (ClosedOrders "start" is exclusive).
+
+    client_ref_param = "userref"
+
+    def __init__(self, client, timeout=10.0, max_trials=3):
+        self.client = client
+        self.timeout = timeout
+        self.max_trials = max_trials
+
+    def _query(self, method, data):
+        return kraken_wrapper.retry_on_error(
+            self.client.query_private, method, data=data, timeout=self.timeout, _max_trials=self.max_trials)
+
+    def _to_orders(self, order_dict):
+        orders = []
+        for order_id, order in (order_dict or {}).items():
+            orders.append((order_id, order.get("userref"), order.get("closetm"), order))
+        return orders
+
+    def lookup(self, client_ref, cursor):
+        # Open orders first, they are the cheap (and most likely) case right after a submission
+        result = self._query("OpenOrders", {"userref": client_ref})
+        orders = self._to_orders(result["open"]) if result is not None else []
+        if len(orders) == 0:
+            data = {"userref": client_ref}
+            if cursor is not None:
+                data["start"] = cursor
+            result = self._query("ClosedOrders", data)
+            orders = self._to_orders(result["closed"]) if result is not None else []
+        return orders
+
+    def fetch_open(self):
+        result = self._query("OpenOrders", {})
+        return self._to_orders(result["open"]) if result is not None else []
+
+    def fetch_closed(self, cursor):
+        data = {}
+        if cursor is not None:
+            data["start"] = cursor
+        result = self._query("ClosedOrders", data)
+        if result is None:
+            return [], cursor
+        orders = self._to_orders(result["closed"])
+        close_times = [close_time for _, _, close_time, _ in orders if close_time is not None]
+        if close_times:
+            cursor = max(float(max(close_times)), cursor or 0.0)
+        return orders, cursor
+
+
+class CcxtOrderSource(object):
+    # Orders of any ccxt exchange. The client reference is read from the raw order info.
+    # If the exchange has a native lookup by client id (e.g. Gdax "orders/client:{client_oid}") that
+    # is used, otherwise the registry scans open orders and the closed orders since the cursor (ms timestamp).
+
+    def __init__(self, exchange, symbol, client_ref_param, native_lookup_method=None, retry_fn=None):
+        self.exchange = exchange
+        self.symbol = symbol
+        self.client_ref_param = client_ref_param
+        self.native_lookup_fn = None
+        if native_lookup_method is not None:
+            self.native_lookup_fn = getattr(exchange, native_lookup_method, None)
+        self.retry_fn = retry_fn
+
+    def _request(self, fn, *args, **kwargs):
+        if self.retry_fn is None:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as err:
+                logging.warning("Order request failed: {}".format(err))
+                return None
+        return self.retry_fn(fn, *args, _max_trials=1, **kwargs)
+
+    def _to_orders(self, orders):
+        return [(order["id"], order["info"].get(self.client_ref_param), order.get("timestamp"), order)
+                for order in orders or []]
+
+    def lookup(self, client_ref, cursor):
+        # None if the exchange has no lookup by client id
+        if self.native_lookup_fn is None:
+            return None
+        info = self._request(self.native_lookup_fn, {"client_oid": client_ref})
+        if info is None or "id" not in info:
+            return []
+        return [(info["id"], client_ref, None, {"id": info["id"], "info": info})]
+
+    def fetch_open(self):
+        return self._to_orders(self._request(self.exchange.fetchOpenOrders, self.symbol))
+
+    def fetch_closed(self, cursor):
+        orders = self._to_orders(self._request(self.exchange.fetchClosedOrders, self.symbol, cursor))
+        timestamps = [timestamp for _, _, timestamp, _ in orders if timestamp is not None]
+        if timestamps:
+            cursor = max(max(timestamps) + 1, cursor or 0)
+        return orders, cursor
+
+
+class OrderRegistry(object):
+    # Our orders per venue indexed by client reference (Kraken userref, Gdax client_oid).
+    # Orders we submitted are registered with their reference before submission, so a failed submission
+    # can be recovered with a lookup of that single reference instead of downloading the order history.
+    # Orders seen while scanning closed orders are indexed as well and the scan continues from a cursor.
+
+    def __init__(self):
+        self.sources = {}
+        self.client_refs = {}
+        self.order_infos = {}
+        self.cursors = {}
+        self.num_lookups = 0
+        self.num_index_hits = 0
+
+    def add_venue(self, name, source, cursor=None):
+        self.sources[name] = source
+        self.client_refs[name] = {}
+        self.order_infos[name] = {}
+        self.cursors[name] = cursor
+
+    def advance_cursor(self, name, cursor):
+        # Closed orders before cursor are not of interest anymore (e.g. they are older than the session)
+        if self.cursors[name] is None or cursor > self.cursors[name]:
+            self.cursors[name] = cursor
+
+    def register(self, name, client_ref, order_id=None):
+        self.client_refs[name][client_ref] = order_id
+
+    def _index(self, name, orders):
+        client_refs = self.client_refs[name]
+        for order_id, client_ref, _, info in orders:
+            self.order_infos[name][order_id] = info
+            if client_ref is not None and client_refs.get(client_ref) is None:
+                client_refs[client_ref] = order_id
+
+    def get_order_id(self, name, client_ref):
+        return self.client_refs[name].get(client_ref)
+
+    def scan_closed(self, name):
+        # Index all closed orders since the cursor and move the cursor past them
+        orders, self.cursors[name] = self.sources[name].fetch_closed(self.cursors[name])
+        self._index(name, orders)
+        return orders
+
+    def find_order_id(self, name, client_ref, max_wait_time=0.0, retry_interval=1.0):
+        # Order id of our order with client_ref or None if it can't be found within max_wait_time
+        start_time = time.time()
+        while True:
+            order_id = self.get_order_id(name, client_ref)
+            if order_id is not None:
+                self.num_index_hits += 1
+                return order_id
+            self.num_lookups += 1
+            logging.info("Looking up {} order with {}={}".format(
+                name, self.sources[name].client_ref_param, client_ref))
+            source = self.sources[name]
+            orders = source.lookup(client_ref, self.cursors[name])
+            if orders is None:
+                orders = source.fetch_open() + self.scan_closed(name)
+            self._index(name, orders)
+            matching_order_ids = [order_id for order_id, order_client_ref, _, _ in orders
+                                  if order_client_ref == client_ref]
+            if len(matching_order_ids) > 1:
+                logging.warning("WARNING: Multiple matching orders found: {}".format(matching_order_ids))
+            if len(matching_order_ids) > 0:
+                self.client_refs[name][client_ref] = matching_order_ids[0]
+                return matching_order_ids[0]
+            remaining_time = max_wait_time - (time.time() - start_time)
+            if remaining_time <= 0:
+                return None
+            # One last lookup at the end of max_wait_time
+            time.sleep(min(retry_interval, remaining_time))
@@ -0,0 +1,324 @@
+import time
+import random
+import logging
+import threading
+import collections
+
+import balance_ledger
+
+
+class LatencyModel(object):
+    # Time from sending an order until it reaches the matching engine of the venue:
+    # a fixed latency plus an exponential jitter with mean jitter (long tail like real venues)
+
+    def __init__(self, latency=0.1, jitter=0.05, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def sample(self):
+        if self.jitter <= 0:
+            return self.latency
+        return self.latency + self.random.expovariate(1.0 / self.jitter)
+
+
+class PaperOrder(object):
+
+    def __init__(self, id, venue, side, price, volume, submit_time, arrival_time):
+        self.id = id
+        self.venue = venue
+        self.side = side
+        self.price = price
+        self.volume = volume
+        self.filled = 0.0
+        self.cost = 0.0
+        self.fee = 0.0
+        # "pending" (on its way to the venue), "open", "closed" or "canceled"
+        self.status = "pending"
+        self.submit_time = submit_time
+        self.arrival_time = arrival_time
+        self.cancel_time = None
+        self.close_time = None
+        # Volume at the price level of the order that is ahead of it in the queue
+        self.queue_ahead = 0.0
+        self.level_volume = 0.0
+
+    @property
+    def remaining(self):
+        return self.volume - self.filled
+
+
+def get_level_volume(levels, price, is_bid):
+    # Volume of the level at price (None if price is beyond the levels of the book)
+    for level in levels:
+        if level[0] == price:
+            return level[1]
+        if is_bid and level[0] < price or not is_bid and level[0] > price:
+            return 0.0
+    return None
+
+
+class PaperTradingEngine(object):
+    # Simulated execution of limit orders against real order books.
+    # An order reaches the venue after a delay from the latency model. There it takes the liquidity of the
+    # latest order book up to its limit price (taker fee) and the rest rests at its limit price (maker fee)
+    # behind the volume that was at that price already. Resting orders fill when the market trades through
+    # their price or when the volume ahead of them is gone: decreases of their level are assumed to be trades
+    # at the front of the queue. Fills are booked by the caller (e.g. in a ledger from create_paper_ledger).
+    # Books are passed in with update_order_book() (only the latest book of a venue is kept, so the engine keeps
+    # up with any book rate) and/or pulled with book_fns while orders are open. Matching runs on a background
+    # thread, on_order_update(venue, order_info) is called with the ccxt order info of every order that changed.
+
+    def __init__(self, base, quote, fee_rates, latency_model=None, book_fns=None, book_interval=1.0,
+                 on_order_update=None):
+        # fee_rates: venue name -> (maker fee, taker fee)
+        self.base = base
+        self.quote = quote
+        self.fee_rates = fee_rates
+        self.latency_model = latency_model or LatencyModel()
+        self.book_fns = book_fns or {}
+        self.book_interval = book_interval
+        self.on_order_update = on_order_update
+        self.orders = collections.OrderedDict()
+        self.active_orders = {}
+        self.books = {}
+        self.new_books = {}
+        self.book_fetch_times = {}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.sequence = 0
+        self.num_orders = 0
+        self.num_fills = 0
+        self.num_book_updates = 0
+        self.num_skipped_books = 0
+        # (mode, expected gain, realized gain) of the simulated arbitrages
+        self.arbitrages = []
+        self._stop = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="paper_trading")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self._stop = True
+            self.condition.notify()
+
+    def update_order_book(self, venue, order_book):
+        # Non-blocking: the book is matched against the orders of the venue on the background thread
+        if order_book is None:
+            return
+        with self.condition:
+            if venue in self.new_books:
+                self.num_skipped_books += 1
+            self.new_books[venue] = order_book
+            self.condition.notify()
+
+    def submit(self, venue, side, volume, price):
+        now = time.time()
+        with self.condition:
+            self.sequence += 1
+            order = PaperOrder("P{:08d}".format(self.sequence), venue, side, float(price), float(volume), now,
+                               now + self.latency_model.sample())
+            self.orders[order.id] = order
+            self.active_orders[order.id] = order
+            self.num_orders += 1
+            self.condition.notify()
+        return self.get_order_info(order.id)
+
+    def cancel(self, order_id):
+        # The cancellation reaches the venue after a delay from the latency model as well
+        with self.condition:
+            order = self.orders.get(order_id)
+            if order is None:
+                raise KeyError("Unknown order: {}".format(order_id))
+            if order.cancel_time is None:
+                # A cancellation can't overtake the order
+                order.cancel_time = max(time.time() + self.latency_model.sample(), order.arrival_time)
+                self.condition.notify()
+        return self.get_order_info(order_id)
+
+    def get_order_info(self, order_id):
+        # Order in the ccxt format
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None:
+                return None
+            return self._format_order(order)
+
+    def _format_order(self, order):
+        return {
+            "id": order.id,
+            "timestamp": int(order.submit_time * 1000),
+            "status": "open" if order.status == "pending" else order.status,
+            "symbol": "{}/{}".format(self.base, self.quote),
+            "type": "limit",
+            "side": order.side,
+            "price": order.price,
+            "amount": order.volume,
+            "filled": order.filled,
+            "remaining": order.remaining,
+            "cost": order.cost,
+            "fee": {"cost": order.fee, "currency": self.quote},
+            "info": {"paper": True, "queue_ahead": order.queue_ahead},
+        }
+
+    def record_arbitrage(self, mode, expected_gain, realized_gain):
+        self.arbitrages.append((mode, expected_gain, realized_gain))
+
+    def get_gain_stats(self):
+        # Number of simulated arbitrages, sum of their expected and of their realized gains
+        return (len(self.arbitrages), sum(expected for _, expected, _ in self.arbitrages),
+                sum(realized for _, _, realized in self.arbitrages))
+
+    def format_stats(self):
+        num_arbitrages, expected_gain, realized_gain = self.get_gain_stats()
+        return "{:d} orders, {:d} fills, {:d} books ({:d} skipped), {:d} arbitrages (expected gain {:.2f}, " \
+               "realized gain {:.2f})".format(self.num_orders, self.num_fills, self.num_book_updates,
+                                              self.num_skipped_books, num_arbitrages, expected_gain, realized_gain)
+
+    def _fill(self, order, volume, price, is_taker):
+        fee_rate = self.fee_rates[order.venue][1 if is_taker else 0]
+        order.filled += volume
+        order.cost += volume * price
+        order.fee += volume * price * fee_rate
+        if order.remaining <= 1e-12:
+            order.status = "closed"
+
+    def _take_liquidity(self, order, book):
+        # Walk the opposite side of the book up to the limit price
+        levels = book["asks"] if order.side == "buy" else book["bids"]
+        for price, volume in ((level[0], level[1]) for level in levels):
+            if order.remaining <= 1e-12:
+                break
+            if order.side == "buy" and price > order.price or order.side == "sell" and price < order.price:
+                break
+            self._fill(order, min(volume, order.remaining), price, True)
+
+    def _update_resting(self, order, book):
+        # The market traded through the price of the order
+        levels = book["asks"] if order.side == "buy" else book["bids"]
+        through_volume = 0.0
+        for price, volume in ((level[0], level[1]) for level in levels):
+            if order.side == "buy" and price > order.price or order.side == "sell" and price < order.price:
+                break
+            through_volume += volume
+        if through_volume > 0:
+            self._fill(order, min(through_volume, order.remaining), order.price, False)
+        # Queue position at the price level of the order
+        level_volume = get_level_volume(book["bids"] if order.side == "buy" else book["asks"], order.price,
+                                        order.side == "buy")
+        if level_volume is None or order.status != "open":
+            return
+        order.queue_ahead -= max(order.level_volume - level_volume, 0.0)
+        order.level_volume = level_volume
+        if order.queue_ahead < 0:
+            self._fill(order, min(-order.queue_ahead, order.remaining), order.price, False)
+            order.queue_ahead = 0.0
+
+    def _process_order(self, order, now, book, book_updated):
+        # Returns True if the order changed
+        if order.status == "pending":
+            if now < order.arrival_time or book is None:
+                return False
+            order.status = "open"
+            self._take_liquidity(order, book)
+            if order.status == "open":
+                same_side = book["bids"] if order.side == "buy" else book["asks"]
+                order.level_volume = get_level_volume(same_side, order.price, order.side == "buy") or 0.0
+                order.queue_ahead = order.level_volume
+            changed = True
+        elif order.status == "open" and book_updated:
+            filled = order.filled
+            self._update_resting(order, book)
+            changed = order.filled != filled
+        else:
+            changed = False
+        if order.status == "open" and order.cancel_time is not None and now >= order.cancel_time:
+            order.status = "canceled"
+            changed = True
+        if order.status != "open":
+            order.close_time = now
+        return changed
+
+    def _pull_books(self, now):
+        # Fetch books of venues with active orders (outside of the lock)
+        with self.lock:
+            venues = set(order.venue for order in self.active_orders.values())
+        for venue in venues:
+            book_fn = self.book_fns.get(venue)
+            if book_fn is None or now < self.book_fetch_times.get(venue, 0.0) + self.book_interval:
+                continue
+            self.book_fetch_times[venue] = now
+            try:
+                self.update_order_book(venue, book_fn())
+            except Exception as err:
+                logging.warning("Unable to get {} order book for paper trading ({}).".format(venue, err))
+
+    def _get_wait_time(self, now):
+        wait_time = self.book_interval if self.active_orders else None
+        for order in self.active_orders.values():
+            for event_time in (order.arrival_time if order.status == "pending" else None, order.cancel_time):
+                if event_time is not None:
+                    wait_time = max(0.0, min(wait_time, event_time - now))
+        return wait_time
+
+    def _run(self):
+        while True:
+            self._pull_books(time.time())
+            updates = []
+            with self.condition:
+                if self._stop:
+                    break
+                now = time.time()
+                new_books = self.new_books
+                self.new_books = {}
+                self.books.update(new_books)
+                self.num_book_updates += len(new_books)
+                for order in list(self.active_orders.values()):
+                    if self._process_order(order, now, self.books.get(order.venue), order.venue in new_books):
+                        updates.append((order, self._format_order(order)))
+                    if order.status not in ("pending", "open"):
+                        del self.active_orders[order.id]
+                if not updates and not self.new_books:
+                    self.condition.wait(self._get_wait_time(now))
+            for order, order_info in updates:
+                if order.status not in ("pending", "open") and order.filled > 0:
+                    self.num_fills += 1
+                if self.on_order_update is not None:
+                    self.on_order_update(order.venue, order_info)
+
+
+class PaperExchange(object):
+    # The order methods of a ccxt exchange on top of a PaperTradingEngine (for one venue), so the trading loop
+    # runs the same code with and without paper trading
+
+    def __init__(self, engine, name):
+        self.engine = engine
+        self.name = name
+        # Not the id of the venue, so the venue's rate limiter isn't used for simulated calls
+        self.id = "paper_{}".format(name)
+
+    def createLimitBuyOrder(self, symbol, amount, price, params=None):
+        return self.engine.submit(self.name, "buy", amount, price)
+
+    def createLimitSellOrder(self, symbol, amount, price, params=None):
+        return self.engine.submit(self.name, "sell", amount, price)
+
+    def cancelOrder(self, id, symbol=None, params=None):
+        return self.engine.cancel(id)
+
+    def fetchOrder(self, id, symbol=None, params=None):
+        return self.engine.get_order_info(id)
+
+
+def create_paper_ledger(balances, currencies):
+    # Ledger with the given starting balances (venue name -> {currency: amount}) that is never reconciled
+    ledger = balance_ledger.BalanceLedger({name: (lambda: None) for name in balances}, currencies)
+    for name, venue_balances in balances.items():
+        ledger.set_balance(name, {currency: {"free": amount, "total": amount}
+                                  for currency, amount in venue_balances.items()})
+    return ledger
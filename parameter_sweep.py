@@ -0,0 +1,209 @@
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import itertools
+import concurrent.futures
+
+import arbitrage_engine
+import backtest
+
+
+# Parameters that can be swept and their default values (same meaning as in ccxt_arbitration_new)
+DEFAULT_PARAMETERS = {
+    "min_gains_percentage": [2.0, 1.5, 1.0, 0.75],
+    "min_fiat_reserves": [0.0, 0.4, 0.6, 0.75],
+    "max_volume_crypto": 0.5,
+    "limit_price_safety_factor": 1.05,
+    "buy_safety_factor_fiat": 1.25,
+}
+
+# Default grid: every combination of these values is evaluated
+DEFAULT_GRID = {
+    "min_gains_percentage": [
+        [2.0, 1.5, 1.0, 0.75],
+        [1.5, 1.0, 0.75, 0.5],
+        [1.0, 0.75, 0.5, 0.25],
+        [0.5, 0.25, 0.0, -0.2],
+    ],
+    "min_fiat_reserves": [
+        [0.0, 0.4, 0.6, 0.75],
+        [0.0, 0.25, 0.4, 0.6],
+    ],
+    "max_volume_crypto": [0.1, 0.25, 0.5, 1.0],
+    "limit_price_safety_factor": [1.01, 1.05],
+    "buy_safety_factor_fiat": [1.1, 1.25, 1.5],
+}
+
+REPORT_COLUMNS = ["pnl", "trade_gain_fiat", "num_trades", "max_drawdown"]
+# Columns where a higher value ranks first (the others rank the lowest value first)
+DESCENDING_COLUMNS = {"pnl", "trade_gain_fiat", "num_trades"}
+
+
+def get_grid_configs(grid):
+    # All combinations of the grid values (missing parameters keep their default)
+    names = sorted(grid.keys())
+    configs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        config = dict(DEFAULT_PARAMETERS)
+        config.update(zip(names, values))
+        configs.append(config)
+    return configs
+
+
+def get_random_configs(grid, num_configs, seed=None):
+    # Random search: every parameter is drawn independently from its grid values.
+    # A {"low": ..., "high": ...} dict draws a float uniformly instead.
+    rng = random.Random(seed)
+    configs = []
+    for _ in range(num_configs):
+        config = dict(DEFAULT_PARAMETERS)
+        for name, values in grid.items():
+            if isinstance(values, dict):
+                config[name] = rng.uniform(values["low"], values["high"])
+            else:
+                config[name] = rng.choice(values)
+        configs.append(config)
+    return configs
+
+
+def create_parameters(config):
+    # The ladders of a config are used for all exchange pairs
+    return arbitrage_engine.ArbitrageParameters(
+        {}, {},
+        [gain / 100.0 for gain in config["min_gains_percentage"]],
+        config["min_fiat_reserves"],
+        max_volume_crypto=config["max_volume_crypto"],
+        limit_price_safety_factor=config["limit_price_safety_factor"],
+        buy_safety_factor_fiat=config["buy_safety_factor_fiat"])
+
+
+# Market data of a worker process. The record arrays are memory maps of the archive so all workers
+# share the same pages of the OS page cache read-only and nothing is copied between processes.
+_worker_data = None
+_worker_settings = None
+
+
+def _init_worker(folder, venue_names, symbol, fees, start_time, end_time, max_skew, settings):
+    global _worker_data, _worker_settings
+    _worker_data = backtest.BacktestData.load(folder, venue_names, symbol, fees, start_time, end_time, max_skew)
+    _worker_settings = settings
+
+
+def _run_configs(config_indices, configs):
+    results = []
+    for config_index, config in zip(config_indices, configs):
+        backtester = backtest.Backtester(
+            _worker_settings["venue_names"], create_parameters(config),
+            _worker_settings["balances_fiat"], _worker_settings["balances_crypto"],
+            cooldown=_worker_settings["cooldown"])
+        report = backtester.run(_worker_data)
+        result = {"index": config_index, "config": config}
+        for column in REPORT_COLUMNS:
+            result[column] = report[column]
+        results.append(result)
+    return results
+
+
+def run_sweep(configs, folder, venue_names, symbol, fees, balances_fiat, balances_crypto,
+              start_time=None, end_time=None, max_skew=2.0, cooldown=10.0, max_workers=None, chunk_size=16):
+    # Evaluate all configs on a process pool. Configs are sent in chunks to keep the overhead per task low.
+    settings = {
+        "venue_names": list(venue_names),
+        "balances_fiat": list(balances_fiat),
+        "balances_crypto": list(balances_crypto),
+        "cooldown": cooldown,
+    }
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker,
+            initargs=(folder, venue_names, symbol, fees, start_time, end_time, max_skew, settings)) as executor:
+        futures = []
+        for begin in range(0, len(configs), chunk_size):
+            end = min(begin + chunk_size, len(configs))
+            futures.append(executor.submit(_run_configs, list(range(begin, end)), configs[begin:end]))
+        for future in concurrent.futures.as_completed(futures):
+            results += future.result()
+    return results
+
+
+def rank_results(results, sort_by="pnl", max_drawdown=None):
+    if max_drawdown is not None:
+        results = [result for result in results if result["max_drawdown"] <= max_drawdown]
+    return sorted(results, key=lambda result: result[sort_by], reverse=sort_by in DESCENDING_COLUMNS)
+
+
+def format_config(config):
+    return "gains={} reserves={} volume={:g} limit={:g} safety={:g}".format(
+        "/".join("{:g}".format(gain) for gain in config["min_gains_percentage"]),
+        "/".join("{:g}".format(reserve) for reserve in config["min_fiat_reserves"]),
+        config["max_volume_crypto"], config["limit_price_safety_factor"], config["buy_safety_factor_fiat"])
+
+
+def print_table(results, top=20):
+    print("{:>5s} {:>10s} {:>10s} {:>7s} {:>10s}  {}".format("rank", "pnl", "gains", "trades", "drawdown", "config"))
+    for rank, result in enumerate(results[:top]):
+        print("{:5d} {:10.2f} {:10.2f} {:7d} {:10.2f}  {}".format(
+            rank + 1, result["pnl"], result["trade_gain_fiat"], result["num_trades"], result["max_drawdown"],
+            format_config(result["config"])))
+
+
+def write_csv(results, filename):
+    with open(filename, "w") as fout:
+        writer = csv.writer(fout)
+        writer.writerow(["rank"] + REPORT_COLUMNS + sorted(DEFAULT_PARAMETERS.keys()))
+        for rank, result in enumerate(results):
+            config = result["config"]
+            writer.writerow([rank + 1] + [result[column] for column in REPORT_COLUMNS]
+                            + [json.dumps(config[name]) for name in sorted(DEFAULT_PARAMETERS.keys())])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Sweep the arbitrage parameters over recorded order books")
+    parser.add_argument("folder", help="Record folder of order_book_recorder")
+    parser.add_argument("--symbol", default="ETH/EUR")
+    parser.add_argument("--exchanges", default="kraken,gdax")
+    parser.add_argument("--fees", default="0.0026,0.003", help="Fee ratio per exchange")
+    parser.add_argument("--balances-fiat", default="5000,5000")
+    parser.add_argument("--balances-crypto", default="5,5")
+    parser.add_argument("--start-time", type=float, default=None)
+    parser.add_argument("--end-time", type=float, default=None)
+    parser.add_argument("--max-skew", type=float, default=2.0)
+    parser.add_argument("--cooldown", type=float, default=10.0)
+    parser.add_argument("--grid", default=None, help="JSON file with the values of each parameter")
+    parser.add_argument("--random", type=int, default=None, help="Number of random configs instead of the grid")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--sort-by", default="pnl", choices=REPORT_COLUMNS)
+    parser.add_argument("--max-drawdown", type=float, default=None)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--csv", default=None, help="Write the full ranked table to this file")
+    args = parser.parse_args(argv)
+
+    grid = DEFAULT_GRID
+    if args.grid is not None:
+        with open(args.grid, "r") as fin:
+            grid = json.load(fin)
+    if args.random is not None:
+        configs = get_random_configs(grid, args.random, args.seed)
+    else:
+        configs = get_grid_configs(grid)
+
+    start_time = time.time()
+    results = run_sweep(configs, args.folder, args.exchanges.split(","), args.symbol,
+                        [float(fee) for fee in args.fees.split(",")],
+                        [float(balance) for balance in args.balances_fiat.split(",")],
+                        [float(balance) for balance in args.balances_crypto.split(",")],
+                        args.start_time, args.end_time, args.max_skew, args.cooldown, args.workers)
+    sweep_time = time.time() - start_time
+    results = rank_results(results, args.sort_by, args.max_drawdown)
+    print("Evaluated {:d} configs in {:.1f} s".format(len(configs), sweep_time))
+    print_table(results, args.top)
+    if args.csv is not None:
+        write_csv(results, args.csv)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
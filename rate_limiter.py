@@ -0,0 +1,218 @@
+import time
+import random
+import threading
+
+
+class TokenBucket(object):
+    # Classic token bucket: up to capacity tokens, refilled at rate tokens per second
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.update_time = time.time()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.update_time) * self.rate)
+        self.update_time = now
+
+    def get_wait_time(self, cost, now):
+        self._refill(now)
+        wait_time = max(self.blocked_until - now, 0.0)
+        if self.tokens < cost:
+            wait_time = max(wait_time, (cost - self.tokens) / self.rate)
+        return wait_time
+
+    def consume(self, cost):
+        self.tokens -= cost
+
+    def block(self, seconds, now):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class DecayingCounter(object):
+    # Kraken style call counter: every call adds its cost to the counter, the counter decays by
+    # decay_rate per second and calls are refused while the counter would exceed max_counter.
+
+    def __init__(self, max_counter, decay_rate):
+        self.max_counter = max_counter
+        self.decay_rate = decay_rate
+        self.counter = 0.0
+        self.update_time = time.time()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _decay(self, now):
+        self.counter = max(0.0, self.counter - (now - self.update_time) * self.decay_rate)
+        self.update_time = now
+
+    def get_wait_time(self, cost, now):
+        self._decay(now)
+        wait_time = max(self.blocked_until - now, 0.0)
+        if self.counter + cost > self.max_counter:
+            wait_time = max(wait_time, (self.counter + cost - self.max_counter) / self.decay_rate)
+        return wait_time
+
+    def consume(self, cost):
+        self.counter += cost
+
+    def block(self, seconds, now):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+def get_backoff_time(num_failures, base=0.5, max_time=30.0, jitter=0.5):
+    # Exponential backoff (base * 2^(n-1), at most max_time) where the last jitter part is random,
+    # so callers that failed together don't retry together
+    if num_failures <= 0:
+        return 0.0
+    backoff = min(max_time, base * 2 ** (num_failures - 1))
+    return backoff * (1 - jitter) + random.uniform(0, backoff * jitter)
+
+
+def normalize_endpoint(endpoint):
+    # ccxt methods are called by camel case (fetchOrderBook) or snake case (fetch_order_book) names
+    if endpoint is None:
+        return None
+    return endpoint.replace("_", "").lower()
+
+
+class ExchangeRateLimiter(object):
+    # Rate limits of one exchange as one or more named limits (e.g. "public" and "private").
+    # Every endpoint maps to a limit and a cost. Endpoints are ccxt method names (fetchOrderBook) or
+    # raw API method names (OpenOrders). Implicit ccxt API methods starting with "public" use the
+    # "public" limit. All callers of the exchange share one limiter.
+
+    def __init__(self, limits, endpoint_costs=None, default_limit="private", default_cost=1.0,
+                 backoff_base=0.5, backoff_max=30.0, backoff_jitter=0.5, penalty_time=10.0):
+        self.limits = limits
+        self.endpoint_costs = {normalize_endpoint(endpoint): limit_and_cost
+                               for endpoint, limit_and_cost in (endpoint_costs or {}).items()}
+        self.default_limit = default_limit
+        self.default_cost = default_cost
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.backoff_jitter = backoff_jitter
+        self.penalty_time = penalty_time
+        self.num_acquires = 0
+        self.num_waits = 0
+        self.wait_time = 0.0
+        self.num_penalties = 0
+
+    def get_limit_and_cost(self, endpoint):
+        endpoint = normalize_endpoint(endpoint)
+        if endpoint in self.endpoint_costs:
+            limit_name, cost = self.endpoint_costs[endpoint]
+        elif endpoint is not None and endpoint.startswith("public") and "public" in self.limits:
+            limit_name, cost = "public", self.default_cost
+        else:
+            limit_name, cost = self.default_limit, self.default_cost
+        return self.limits[limit_name], cost
+
+    def acquire(self, endpoint=None, deadline=None):
+        # Block until a call to endpoint is allowed. Returns False (without consuming) if that would be
+        # after deadline.
+        limit, cost = self.get_limit_and_cost(endpoint)
+        while True:
+            with limit.lock:
+                now = time.time()
+                wait_time = limit.get_wait_time(cost, now)
+                if wait_time <= 0:
+                    limit.consume(cost)
+                    self.num_acquires += 1
+                    return True
+            if deadline is not None and now + wait_time > deadline:
+                return False
+            self.num_waits += 1
+            self.wait_time += wait_time
+            time.sleep(wait_time)
+
+    def try_acquire(self, endpoint=None):
+        # Take the call if it is allowed right now (e.g. for a server that rejects calls over the limit)
+        limit, cost = self.get_limit_and_cost(endpoint)
+        with limit.lock:
+            if limit.get_wait_time(cost, time.time()) > 0:
+                return False
+            limit.consume(cost)
+            self.num_acquires += 1
+            return True
+
+    def penalize(self, endpoint=None, seconds=None):
+        # The exchange reported that we exceeded its limit: block the limit of the endpoint for a while
+        limit, _ = self.get_limit_and_cost(endpoint)
+        with limit.lock:
+            limit.block(self.penalty_time if seconds is None else seconds, time.time())
+        self.num_penalties += 1
+
+    def get_backoff_time(self, num_failures):
+        return get_backoff_time(num_failures, self.backoff_base, self.backoff_max, self.backoff_jitter)
+
+    def scale(self, shares):
+        # Keep only a share of some limits ({limit name: share}), e.g. when several processes use the
+        # same API key. A limit still allows the most expensive single call.
+        max_cost = max([cost for _, cost in self.endpoint_costs.values()] + [self.default_cost])
+        for limit_name, share in shares.items():
+            limit = self.limits.get(limit_name)
+            if limit is None:
+                continue
+            with limit.lock:
+                if isinstance(limit, TokenBucket):
+                    limit.rate *= share
+                    limit.capacity = max(limit.capacity * share, max_cost)
+                    limit.tokens = min(limit.tokens, limit.capacity)
+                else:
+                    limit.decay_rate *= share
+                    limit.max_counter = max(limit.max_counter * share, max_cost)
+
+
+def create_kraken_rate_limiter(max_counter=15, decay_rate=0.33):
+    # Private API: decaying call counter (starter tier: max 15, -0.33 per second). Ledger and trade
+    # history queries cost 2, order placement and cancellation are limited by the matching engine
+    # instead and cost nothing here. Public API: about one call per second.
+    endpoint_costs = {
+        "Ledgers": ("private", 2.0), "QueryLedgers": ("private", 2.0), "TradesHistory": ("private", 2.0),
+        "fetchLedger": ("private", 2.0), "fetchMyTrades": ("private", 2.0),
+        "AddOrder": ("private", 0.0), "CancelOrder": ("private", 0.0),
+        "createOrder": ("private", 0.0), "createLimitBuyOrder": ("private", 0.0),
+        "createLimitSellOrder": ("private", 0.0), "cancelOrder": ("private", 0.0),
+    }
+    for endpoint in ("Time", "Assets", "AssetPairs", "Ticker", "OHLC", "Depth", "Trades", "Spread",
+                     "fetchOrderBook", "fetchL2OrderBook", "fetchTicker", "fetchTickers", "fetchTrades",
+                     "fetchOHLCV", "loadMarkets", "fetchMarkets"):
+        endpoint_costs[endpoint] = ("public", 1.0)
+    return ExchangeRateLimiter(
+        {"private": DecayingCounter(max_counter, decay_rate), "public": TokenBucket(1.0, 2.0)}, endpoint_costs)
+
+
+def create_gdax_rate_limiter():
+    # Public API: 3 requests per second (bursts of 6), private API: 5 per second (bursts of 10)
+    endpoint_costs = {}
+    for endpoint in ("fetchOrderBook", "fetchL2OrderBook", "fetchTicker", "fetchTickers", "fetchTrades",
+                     "fetchOHLCV", "loadMarkets", "fetchMarkets"):
+        endpoint_costs[endpoint] = ("public", 1.0)
+    return ExchangeRateLimiter({"private": TokenBucket(5.0, 10.0), "public": TokenBucket(3.0, 6.0)}, endpoint_costs)
+
+
+RATE_LIMITER_FACTORIES = {
+    "kraken": create_kraken_rate_limiter,
+    "gdax": create_gdax_rate_limiter,
+}
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name, create=True):
+    # Shared limiter of an exchange (ccxt id). None for exchanges without known limits.
+    if name is None:
+        return None
+    with _rate_limiters_lock:
+        if name not in _rate_limiters and create and name in RATE_LIMITER_FACTORIES:
+            _rate_limiters[name] = RATE_LIMITER_FACTORIES[name]()
+        return _rate_limiters.get(name)
+
+
+def set_rate_limiter(name, rate_limiter):
+    with _rate_limiters_lock:
+        _rate_limiters[name] = rate_limiter
@@ -0,0 +1,105 @@
+import time
+import multiprocessing.shared_memory
+import numpy as np
+
+
+# Header of a shared order book: sequence, publish time, update time, number of asks, number of bids
+HEADER_SIZE = 5
+
+
+class SharedOrderBook(object):
+    # Order book (top depth levels per side) in a shared memory block with one writer and any number of readers.
+    # The writer makes the sequence odd while it writes (seqlock), readers copy the levels and retry if the
+    # sequence changed in the meantime, so neither side ever waits for the other.
+
+    def __init__(self, name=None, depth=100, create=False):
+        size = 8 * (HEADER_SIZE + 4 * depth)
+        self.shm = multiprocessing.shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.depth = depth
+        self.data = np.ndarray((HEADER_SIZE + 4 * depth,), dtype=np.float64, buffer=self.shm.buf)
+        if create:
+            self.data[:] = 0.0
+        self.header = self.data[:HEADER_SIZE]
+        self.asks = self.data[HEADER_SIZE:HEADER_SIZE + 2 * depth].reshape(depth, 2)
+        self.bids = self.data[HEADER_SIZE + 2 * depth:].reshape(depth, 2)
+        self.num_publishes = 0
+        self.num_read_retries = 0
+        # Sequence of the last consistent read (to wait for the next publish)
+        self.read_sequence = 0.0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def publish(self, order_book, update_time=None):
+        asks = [level[:2] for level in order_book["asks"][:self.depth]]
+        bids = [level[:2] for level in order_book["bids"][:self.depth]]
+        if update_time is None:
+            update_time = order_book.get("timestamp") / 1000.0 if order_book.get("timestamp") else np.nan
+        sequence = self.header[0]
+        self.header[0] = sequence + 1
+        if asks:
+            self.asks[:len(asks)] = asks
+        if bids:
+            self.bids[:len(bids)] = bids
+        self.header[1:] = (time.time(), update_time, len(asks), len(bids))
+        self.header[0] = sequence + 2
+        self.num_publishes += 1
+
+    def read(self, max_trials=100):
+        # (sequence, publish time, update time, asks, bids) or None if no consistent copy could be read
+        for _ in range(max_trials):
+            sequence = self.header[0]
+            if int(sequence) % 2 == 1:
+                self.num_read_retries += 1
+                time.sleep(0)
+                continue
+            publish_time, update_time, num_asks, num_bids = self.header[1:].tolist()
+            asks = self.asks[:int(num_asks)].copy()
+            bids = self.bids[:int(num_bids)].copy()
+            if self.header[0] == sequence:
+                self.read_sequence = sequence
+                return sequence, publish_time, update_time, asks, bids
+            self.num_read_retries += 1
+        return None
+
+    def get_snapshot(self, symbol=None, max_age=None):
+        # Same format as ccxt_utils.fetch_order_book_snapshot (None before the first publish or if the book is
+        # older than max_age seconds)
+        result = self.read()
+        if result is None or result[0] == 0:
+            return None
+        _, publish_time, update_time, asks, bids = result
+        if max_age is not None and time.time() - publish_time > max_age:
+            return None
+        return {
+            "symbol": symbol,
+            "order_book": {"asks": asks.tolist(), "bids": bids.tolist(),
+                           "timestamp": None if np.isnan(update_time) else int(update_time * 1000)},
+            "request_time": publish_time,
+            "response_time": publish_time,
+            "update_time": None if np.isnan(update_time) else update_time,
+        }
+
+    def is_published(self):
+        # Whether the book was published (or is being published) since the last read
+        return self.header[0] != self.read_sequence
+
+    def close(self):
+        self.data = self.header = self.asks = self.bids = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def wait_for_publish(shared_books, timeout, poll_interval=0.005):
+    # Wait until any of the books was published since its last read. There is no event across processes,
+    # so the sequences are polled. Returns False if none was published within timeout seconds.
+    deadline = time.time() + timeout
+    while True:
+        if any(shared_book.is_published() for shared_book in shared_books):
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(poll_interval)
@@ -0,0 +1,90 @@
+import numpy as np
+
+import ccxt_utils
+import arbitrage_engine
+
+
+VENUE_NAMES = ["kraken", "gdax", "bitstamp"]
+FEES = [0.0026, 0.003, 0.0025]
+
+
+def make_depths(rng, mid_price, num_levels=30):
+    # Both sides of a random book around mid_price as ccxt_utils.OrderBookDepth
+    spread = mid_price * rng.uniform(0.0005, 0.003)
+    ask_prices = np.round(mid_price + spread / 2 + np.cumsum(rng.uniform(0.01, 0.5, num_levels)), 2)
+    bid_prices = np.round(mid_price - spread / 2 - np.cumsum(rng.uniform(0.01, 0.5, num_levels)), 2)
+    ask_volumes = rng.exponential(2.0, num_levels) + 0.01
+    bid_volumes = rng.exponential(2.0, num_levels) + 0.01
+    return ccxt_utils.get_order_book_depths({
+        "asks": np.column_stack((ask_prices, ask_volumes)).tolist(),
+        "bids": np.column_stack((bid_prices, bid_volumes)).tolist(),
+    })
+
+
+def decide_both(depths, balances_fiat, balances_crypto, use_vwap_prices):
+    # The solver path at a fixed volume and the kernel path with a one volume grid see the same volume,
+    # so they have to come to the same decision
+    kwargs = dict(default_min_relative_gains=(0.01, 0.005, 0.002, 0.0), max_volume_crypto=0.5,
+                  use_vwap_prices=use_vwap_prices)
+    solver_parameters = arbitrage_engine.ArbitrageParameters({}, {}, optimize_order_volume=False, **kwargs)
+    kernel_parameters = arbitrage_engine.ArbitrageParameters({}, {}, use_decision_kernel=True, volume_grid_size=1,
+                                                             **kwargs)
+    return [arbitrage_engine.decide(VENUE_NAMES, depths, FEES, balances_fiat, balances_crypto, parameters)
+            for parameters in (solver_parameters, kernel_parameters)]
+
+
+def test_solver_and_kernel_paths_agree():
+    rng = np.random.RandomState(0)
+    num_trades = 0
+    for _ in range(500):
+        mid_prices = 400.0 * (1 + rng.uniform(-0.03, 0.03, len(VENUE_NAMES)))
+        depths = [make_depths(rng, mid_price) for mid_price in mid_prices]
+        # Around the 200 to 250 fiat that buying 0.5 (with the safety factor) needs
+        balances_fiat = rng.uniform(100.0, 400.0, len(VENUE_NAMES))
+        balances_crypto = rng.uniform(0.0, 1.0, len(VENUE_NAMES))
+        for use_vwap_prices in (False, True):
+            solver_result, kernel_result = decide_both(depths, balances_fiat, balances_crypto, use_vwap_prices)
+            assert solver_result["status"] == kernel_result["status"]
+            if solver_result["status"] == "no_volume":
+                continue
+            off_diagonal = ~np.eye(len(VENUE_NAMES), dtype=bool)
+            np.testing.assert_allclose(solver_result["exp_relative_gains"][off_diagonal],
+                                       kernel_result["exp_relative_gains"][off_diagonal], rtol=1e-9, atol=1e-12)
+            assert np.array_equal(solver_result["feasible"], kernel_result["feasible"])
+            feasible = solver_result["feasible"]
+            assert np.array_equal(solver_result["tier_indices"][feasible], kernel_result["tier_indices"][feasible])
+            assert solver_result["best_pair"] == kernel_result["best_pair"]
+            if solver_result["status"] == "trade":
+                num_trades += 1
+                assert solver_result["order_volume_crypto"] == kernel_result["order_volume_crypto"]
+    # The random books have to exercise the trade decision as well
+    assert num_trades > 100
+
+
+def test_feasibility_counts_the_volume_once():
+    # Buying 0.5 at 400 (no fee) costs 200 fiat and needs 250 with a safety factor of 1.25
+    relative_gains = np.array([[-np.inf, 0.01], [-np.inf, -np.inf]])
+    buy_volumes_fiat = np.full((2, 2), 200.0)
+    volumes = np.full((2, 2), 0.5)
+    tiers = np.zeros((2, 2, 1))
+    for balance_fiat, expected in ((250.0, True), (249.0, False)):
+        feasible, _ = arbitrage_engine.compute_feasibility(
+            relative_gains, buy_volumes_fiat, volumes, [balance_fiat, 1000.0], [1.0, 1.0], tiers, tiers, 1.25)
+        assert feasible[0, 1] == expected
+
+
+def test_solver_and_kernel_paths_choose_the_mode_alike():
+    # Buying on 0 and selling on 2 has the highest relative gain (3.0 %), buying on 1 and selling on 3 the
+    # highest fiat gain (2.95 % of a larger amount) once buying on 0 and selling on 3 is excluded by its ladder
+    venue_names = ["v0", "v1", "v2", "v3"]
+    depths = [ccxt_utils.get_order_book_depths({"asks": [[ask_price, 100.0]], "bids": [[bid_price, 100.0]]})
+              for ask_price, bid_price in ((100.0, 99.9), (102.0, 101.9), (103.1, 103.0), (105.1, 105.01))]
+    best_pairs = []
+    for use_decision_kernel in (False, True):
+        parameters = arbitrage_engine.ArbitrageParameters(
+            {("v0", "v3"): [1.0]}, {("v0", "v3"): [0.0]}, default_min_relative_gains=(0.0,),
+            default_min_fiat_reserves=(0.0,), max_volume_crypto=0.5, optimize_order_volume=False,
+            use_decision_kernel=use_decision_kernel, volume_grid_size=1)
+        result = arbitrage_engine.decide(venue_names, depths, [0.0] * 4, [1000.0] * 4, [1.0] * 4, parameters)
+        best_pairs.append(result["best_pair"])
+    assert best_pairs == [(0, 2), (0, 2)]
@@ -0,0 +1,158 @@
+import sys
+import atexit
+import json
+import queue
+import logging
+import logging.handlers
+
+
+# Root of the loggers of the trading loop. Subsystems log to children like "arbitrage.orders"
+# so their levels can be set independently.
+ROOT_LOGGER_NAME = "arbitrage"
+
+
+class BraceMessage(object):
+    # Message with str.format() style arguments that is only formatted when a handler emits it
+
+    def __init__(self, fmt, args, kwargs):
+        self.fmt = fmt
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        if not self.args and not self.kwargs:
+            return self.fmt
+        return self.fmt.format(*self.args, **self.kwargs)
+
+
+class BraceLogger(logging.LoggerAdapter):
+    # Logger that takes the same format strings as the rest of the code but defers the formatting:
+    #   log.info("Order id: {}", order_id)
+    # A disabled level costs one level check. With setup_logging(use_queue=True) enabled messages are
+    # formatted on the listener thread, so arguments must not be modified after the call.
+
+    def __init__(self, logger):
+        logging.LoggerAdapter.__init__(self, logger, {})
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(level):
+            self._log(level, msg, args, kwargs)
+
+    def _log(self, level, msg, args, kwargs):
+        log_kwargs = {key: kwargs.pop(key) for key in ("exc_info", "stack_info", "extra") if key in kwargs}
+        self.logger._log(level, BraceMessage(msg, args, kwargs), (), **log_kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, msg, args, kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, msg, args, kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, msg, args, kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, msg, args, kwargs)
+
+    def event(self, event, level=logging.INFO, **fields):
+        # Structured event with named fields. The fields are kept on the record for StructuredFormatter
+        # and rendered as "event key=value ..." by the plain formatters.
+        if not self.logger.isEnabledFor(level):
+            return
+        self.logger._log(level, EventMessage(event, fields), (), extra={"event": event, "fields": fields})
+
+
+class EventMessage(object):
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join([self.event] + ["{}={}".format(key, value) for key, value in self.fields.items()])
+
+
+def get_logger(subsystem=None):
+    name = ROOT_LOGGER_NAME if subsystem is None else "{}.{}".format(ROOT_LOGGER_NAME, subsystem)
+    return BraceLogger(logging.getLogger(name))
+
+
+def _to_json_value(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+class StructuredFormatter(logging.Formatter):
+    # One compact JSON object per line: time, level, logger and message or event fields
+
+    def format(self, record):
+        data = {"t": round(record.created, 6), "l": record.levelname, "n": record.name}
+        fields = getattr(record, "fields", None)
+        if fields is not None:
+            data["e"] = record.event
+            for key, value in fields.items():
+                data[key] = _to_json_value(value)
+        else:
+            data["m"] = record.getMessage()
+        if record.exc_info:
+            data["x"] = self.formatException(record.exc_info)
+        return json.dumps(data, separators=(",", ":"))
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The standard QueueHandler formats the message on the calling thread. Here the record is queued
+    # as it is and formatted by the handlers on the listener thread. A full queue drops the record.
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.num_dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.num_dropped += 1
+
+
+def setup_logging(filename, level=logging.DEBUG, console=True, use_queue=True, structured=False,
+                  subsystem_levels=None, max_queue_size=100000):
+    # Configure the root logger with a file handler and optionally a console handler.
+    # With use_queue the handlers run on a QueueListener thread and the calling thread only enqueues
+    # records. Returns the listener (stopped at exit, which writes all queued records) or None.
+    handlers = [logging.FileHandler(filename)]
+    if console:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    if structured:
+        for handler in handlers:
+            handler.setFormatter(StructuredFormatter())
+    else:
+        handlers[0].setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.setLevel(level)
+    listener = None
+    if use_queue:
+        log_queue = queue.Queue(max_queue_size)
+        root_logger.addHandler(DeferredQueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        for handler in handlers:
+            root_logger.addHandler(handler)
+    for subsystem, subsystem_level in (subsystem_levels or {}).items():
+        name = ROOT_LOGGER_NAME if subsystem is None else "{}.{}".format(ROOT_LOGGER_NAME, subsystem)
+        logging.getLogger(name).setLevel(subsystem_level)
+    return listener